@@ -1,38 +1,128 @@
+import threading
+import time
 import cv2
 import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
 
-def calculate_descriptors(image_path):
+DOMINANT_COLOR_MODES = ('kmeans', 'sample', 'histogram')
+
+# Extraction settings an index is built with; queries must use the same ones
+DEFAULT_EXTRACTION_PARAMS = {
+    "scale": 1.0,
+    "dominant_colors_mode": 'kmeans',
+    "descriptors": ['color', 'texture', 'shape'],
+    # None: 4 kernels with 8-bit mean responses, the layout of existing indexes
+    "gabor": None
+}
+
+# GaborFilterBank settings, completing a partial "gabor" extraction setting
+DEFAULT_GABOR_PARAMS = {"scales": [8.0], "orientations": 4, "use_dft": None}
+
+def normalize_gabor_params(gabor=None):
     """
-    Calculate comprehensive image descriptors from an input image.
+    Canonical form of the "gabor" extraction setting.
+    
+    None keeps the legacy Gabor features. A dict with any of "scales",
+    "orientations" and "use_dft" selects a GaborFilterBank, whose float32 mean
+    and variance per filter are stored instead.
+    """
+    if gabor is None:
+        return None
+    params = {**DEFAULT_GABOR_PARAMS, **gabor}
+    return {
+        "scales": [float(sigma) for sigma in params["scales"]],
+        "orientations": int(params["orientations"]),
+        "use_dft": None if params["use_dft"] is None else bool(params["use_dft"])
+    }
+
+def normalize_extraction_params(extraction_params=None):
+    """
+    Fill in default extraction settings and give them a canonical, JSON-friendly form.
+    """
+    params = {**DEFAULT_EXTRACTION_PARAMS, **(extraction_params or {})}
+    params["scale"] = float(params["scale"])
+    params["descriptors"] = list(params["descriptors"])
+    params["gabor"] = normalize_gabor_params(params["gabor"])
+    return params
+
+# Scales OpenCV can decode directly at reduced size (JPEG decodes via DCT scaling)
+REDUCED_DECODE_FLAGS = {
+    0.5: cv2.IMREAD_REDUCED_COLOR_2,
+    0.25: cv2.IMREAD_REDUCED_COLOR_4,
+    0.125: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def load_image(image, scale=1.0):
+    """
+    Decode an image at a working resolution.
     
     Args:
-        image_path (str): Path to the input image
+        image (str, bytes or numpy.ndarray): Path to the input image, encoded image bytes
+            (e.g. straight from an upload) or an already decoded image
+        scale (float): Working resolution relative to the original size. 1/2, 1/4 and 1/8
+            use OpenCV's reduced decode flags, other values resize right after decoding.
     
     Returns:
-        dict: Dictionary of image descriptors
+        numpy.ndarray: BGR image
     """
-    # Load image
-    image = cv2.imread(image_path)
-    if image is None:
-        raise FileNotFoundError(f"Image at {image_path} not found.")
+    flags = REDUCED_DECODE_FLAGS.get(scale, cv2.IMREAD_COLOR)
+    resize = scale not in REDUCED_DECODE_FLAGS and scale != 1.0
+    
+    if isinstance(image, np.ndarray):
+        decoded = image
+        if decoded.ndim == 2:
+            decoded = cv2.cvtColor(decoded, cv2.COLOR_GRAY2BGR)
+        elif decoded.shape[2] == 4:
+            decoded = cv2.cvtColor(decoded, cv2.COLOR_BGRA2BGR)
+        resize = scale != 1.0
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        decoded = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), flags)
+        if decoded is None:
+            raise ValueError("Could not decode the image data.")
+    else:
+        decoded = cv2.imread(image, flags)
+        if decoded is None:
+            raise FileNotFoundError(f"Image at {image} not found.")
+    
+    if resize:
+        decoded = cv2.resize(decoded, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return decoded
 
-    # Calculate descriptors
-    color_features = calculate_color_features(image)
-    texture_features = calculate_texture_features(image)
-    shape_features = calculate_shape_features(image)
+def init_extraction_worker():
+    """
+    Initializer of the processes of an extraction pool.
+    
+    Each worker handles one image at a time, OpenCV's own threads would only
+    oversubscribe the cores.
+    """
+    cv2.setNumThreads(1)
 
-    return {
-        "color": color_features,
-        "texture": texture_features,
-        "shape": shape_features
-    }
+def calculate_descriptors(image, scale=1.0, dominant_colors_mode='kmeans',
+                          descriptors=('color', 'texture', 'shape'), gabor=None):
+    """
+    Calculate comprehensive image descriptors from an input image.
+    
+    Args:
+        image (str, bytes or numpy.ndarray): Path to the input image, encoded image bytes
+            or an already decoded BGR image
+        scale (float): Working resolution relative to the original size, see load_image
+        dominant_colors_mode (str): How dominant colors are clustered, see calculate_dominant_colors
+        descriptors (iterable of str): Registered descriptor plugins to run, see register_descriptor
+        gabor (dict, optional): Gabor filter bank of the texture features, see normalize_gabor_params
+    
+    Returns:
+        dict: Dictionary of image descriptors
+    """
+    return get_pipeline(scale, dominant_colors_mode, tuple(descriptors), gabor).compute(image)
 
-def calculate_color_features(image):
+def calculate_color_features(image, dominant_colors_mode='kmeans'):
     """
     Extract color-based features from an image.
     
     Args:
         image (numpy.ndarray): Input image
+        dominant_colors_mode (str): How dominant colors are clustered, see calculate_dominant_colors
     
     Returns:
         dict: Color-based features
@@ -49,40 +139,133 @@ def calculate_color_features(image):
         hist_r / (np.sum(hist_r) + 1e-10)
     ])
 
-    # Dominant colors using K-means
-    reshaped_image = image.reshape((-1, 3)).astype(np.float32)
-    k = 3  # Number of dominant colors
+    return {
+        "histogram": color_histogram,
+        "dominant_colors": calculate_dominant_colors(image, mode=dominant_colors_mode)
+    }
+
+def calculate_dominant_colors(image, mode='kmeans', k=3, sample_size=4096, histogram_bins=16, seed=None):
+    """
+    Find the dominant colors of an image.
+    
+    Args:
+        image (numpy.ndarray): Input image
+        mode (str): 'kmeans' clusters every pixel with 10 attempts (reference output),
+            'sample' clusters a random sample of `sample_size` pixels,
+            'histogram' clusters the non-empty bins of a coarse color histogram
+            weighted by their pixel counts. The last two bound the work regardless of image size.
+        k (int): Number of dominant colors
+        sample_size (int): Number of pixels clustered in 'sample' mode
+        histogram_bins (int): Bins per channel in 'histogram' mode
+        seed (int, optional): Seed for the random initialisation and sampling. The fast
+            modes default to seed 0 so they are deterministic.
+    
+    Returns:
+        numpy.ndarray: k color centers (BGR) followed by the k color percentages
+    """
+    if mode not in DOMINANT_COLOR_MODES:
+        raise ValueError(f"Unknown dominant colors mode {mode!r}, expected one of {DOMINANT_COLOR_MODES}")
+    
+    reshaped_image = image.reshape((-1, 3))
     criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+    
+    if mode == 'histogram':
+        centers, percentages = _histogram_kmeans(reshaped_image, k, histogram_bins, seed or 0)
+        return np.concatenate([centers.flatten(), percentages])
+    
+    if mode == 'sample':
+        seed = seed or 0
+        if len(reshaped_image) > sample_size:
+            rng = np.random.default_rng(seed)
+            reshaped_image = reshaped_image[rng.integers(0, len(reshaped_image), sample_size)]
+    
+    if seed is not None:
+        cv2.setRNGSeed(seed)
+    
+    # Dominant colors using K-means
     _, labels, centers = cv2.kmeans(
-        reshaped_image, k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS
+        reshaped_image.astype(np.float32), k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS
     )
     
-    # Prepare dominant colors feature
-    dominant_colors = np.concatenate([
-        centers.flatten(),  # Color centers
-        np.array([np.sum(labels == i) / len(labels) for i in range(k)])  # Color percentages
+    # Color centers followed by color percentages
+    return np.concatenate([
+        centers.flatten(),
+        np.array([np.sum(labels == i) / len(labels) for i in range(k)])
     ])
 
-    return {
-        "histogram": color_histogram,
-        "dominant_colors": dominant_colors
-    }
+def _histogram_kmeans(pixels, k, bins, seed, attempts=5, iterations=10):
+    """
+    Weighted k-means over the non-empty bins of a coarse color histogram.
+    
+    Like the pixel K-means, the best of several initialisations (lowest weighted
+    inertia) is kept.
+    
+    Returns:
+        tuple: (centers of shape (k, 3), percentages of shape (k,))
+    """
+    bin_width = 256 // bins
+    quantized = pixels.astype(np.intp) // bin_width
+    counts = np.bincount(
+        (quantized[:, 0] * bins + quantized[:, 1]) * bins + quantized[:, 2], minlength=bins ** 3
+    )
+    occupied = np.flatnonzero(counts)
+    weights = counts[occupied].astype(np.float64)
+    points = (np.column_stack(np.unravel_index(occupied, (bins, bins, bins))) + 0.5) * bin_width
+    
+    def squared_distances(centers):
+        return ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    
+    rng = np.random.default_rng(seed)
+    best_centers, best_inertia = None, np.inf
+    for _ in range(attempts):
+        # k-means++ initialisation over the weighted bins
+        centers = [points[rng.choice(len(points), p=weights / weights.sum())]]
+        for _ in range(1, k):
+            probabilities = weights * squared_distances(np.array(centers)).min(axis=1)
+            if probabilities.sum() == 0:
+                centers.append(centers[-1])
+                continue
+            centers.append(points[rng.choice(len(points), p=probabilities / probabilities.sum())])
+        centers = np.array(centers)
+        
+        for _ in range(iterations):
+            labels = np.argmin(squared_distances(centers), axis=1)
+            new_centers = centers.copy()
+            for i in range(k):
+                mask = labels == i
+                if mask.any():
+                    new_centers[i] = np.average(points[mask], axis=0, weights=weights[mask])
+            converged = np.allclose(new_centers, centers, atol=1.0)
+            centers = new_centers
+            if converged:
+                break
+        
+        inertia = np.sum(weights * squared_distances(centers).min(axis=1))
+        if inertia < best_inertia:
+            best_centers, best_inertia = centers, inertia
+    
+    labels = np.argmin(squared_distances(best_centers), axis=1)
+    percentages = np.bincount(labels, weights=weights, minlength=k) / weights.sum()
+    return best_centers.astype(np.float32), percentages
 
-def calculate_texture_features(image):
+def calculate_texture_features(image, gabor_bank=None, gray_image=None):
     """
     Extract texture-based features from an image.
     
     Args:
         image (numpy.ndarray): Input image
+        gabor_bank (GaborFilterBank, optional): Filter bank for the Gabor features
+        gray_image (numpy.ndarray, optional): Grayscale version of the image, if already computed
     
     Returns:
         dict: Texture-based features
     """
     # Convert to grayscale
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if gray_image is None:
+        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     # Gabor filter features
-    gabor_features = calculate_gabor_features(gray_image)
+    gabor_features = calculate_gabor_features(gray_image, gabor_bank)
 
     # GLCM features
     glcm_features = calculate_glcm_features(gray_image)
@@ -92,41 +275,234 @@ def calculate_texture_features(image):
         "glcm_features": glcm_features
     }
 
-def calculate_gabor_features(gray_image):
+class GaborFilterBank:
+    """
+    Bank of Gabor kernels built once per configuration and reused across images.
+    
+    Filtering is done in float32 so negative responses are kept, and each
+    filter contributes its mean and variance to the descriptor.
+    
+    On the DFT path, images are padded up to sizes getOptimalDFTSize picks,
+    which are faster to transform and shared by many image sizes, and the
+    kernel spectra of the `max_cached_shapes` most recently used padded
+    shapes are kept. Banks are shared across request threads.
+    """
+    def __init__(self, scales=(8.0,), orientations=4, ksize=None, gamma=0.5, psi=0, use_dft=None,
+                 max_cached_shapes=4):
+        """
+        Args:
+            scales (iterable of float): Gaussian sigma of each scale, the wavelength is 1.25 * sigma
+            orientations (int): Number of orientations evenly spread over [0, pi)
+            ksize (int, optional): Kernel size, defaults to 2 * int(1.25 * sigma) + 1 per scale
+            gamma (float): Spatial aspect ratio
+            psi (float): Phase offset
+            use_dft (bool, optional): Filter through the DFT; by default only for kernels of 31x31 and up
+            max_cached_shapes (int): Padded image shapes whose kernel spectra are kept
+        """
+        self.scales = tuple(scales)
+        self.orientations = orientations
+        self.kernels = []
+        for sigma in self.scales:
+            size = ksize or 2 * int(1.25 * sigma) + 1
+            for theta in range(orientations):
+                theta_rad = theta / float(orientations) * np.pi
+                self.kernels.append(cv2.getGaborKernel(
+                    (size, size), sigma, theta_rad, 1.25 * sigma, gamma, psi, ktype=cv2.CV_32F
+                ))
+        largest = max(kernel.shape[0] for kernel in self.kernels)
+        self.use_dft = largest >= 31 if use_dft is None else use_dft
+        self.max_cached_shapes = max_cached_shapes
+        self._spectra = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.kernels)
+    
+    def _kernel_spectra(self, shape):
+        """
+        Return the kernel spectra for a padded image shape, from a small LRU cache.
+        """
+        with self._lock:
+            if shape in self._spectra:
+                self._spectra.move_to_end(shape)
+                return self._spectra[shape]
+        
+        spectra = []
+        for kernel in self.kernels:
+            # filter2D correlates, so flip the kernel to get the same result from a convolution
+            padded = np.zeros(shape, dtype=np.float32)
+            padded[:kernel.shape[0], :kernel.shape[1]] = kernel[::-1, ::-1]
+            spectra.append(np.fft.rfft2(padded))
+        spectra = np.stack(spectra)
+        
+        with self._lock:
+            self._spectra[shape] = spectra
+            while len(self._spectra) > self.max_cached_shapes:
+                self._spectra.popitem(last=False)
+        return spectra
+    
+    def responses(self, gray_image):
+        """
+        Filter an image with every kernel of the bank.
+        
+        Args:
+            gray_image (numpy.ndarray): Grayscale input image
+        
+        Returns:
+            numpy.ndarray: float32 responses of shape (len(bank), height, width)
+        """
+        image = gray_image.astype(np.float32)
+        height, width = image.shape
+        if not self.use_dft:
+            return np.stack([cv2.filter2D(image, cv2.CV_32F, kernel) for kernel in self.kernels])
+        
+        # Kernels of different scales share one padding large enough for the biggest one
+        pad = max(kernel.shape[0] for kernel in self.kernels) // 2
+        padded = cv2.copyMakeBorder(image, pad, pad, pad, pad, cv2.BORDER_REFLECT_101)
+        # Zeros up to a fast DFT size; they come after every input the kept responses read
+        padded = cv2.copyMakeBorder(
+            padded, 0, cv2.getOptimalDFTSize(padded.shape[0]) - padded.shape[0],
+            0, cv2.getOptimalDFTSize(padded.shape[1]) - padded.shape[1], cv2.BORDER_CONSTANT, value=0
+        )
+        filtered = np.fft.irfft2(np.fft.rfft2(padded) * self._kernel_spectra(padded.shape), s=padded.shape)
+        
+        responses = np.empty((len(self.kernels), height, width), dtype=np.float32)
+        for idx, kernel in enumerate(self.kernels):
+            half = kernel.shape[0] // 2
+            responses[idx] = filtered[idx, pad + half:pad + half + height, pad + half:pad + half + width]
+        return responses
+    
+    def compute(self, gray_image):
+        """
+        Compute the mean and variance of every filter response.
+        
+        Args:
+            gray_image (numpy.ndarray): Grayscale input image
+        
+        Returns:
+            numpy.ndarray: [mean_0, var_0, mean_1, var_1, ...] for each filter
+        """
+        responses = self.responses(gray_image).reshape(len(self.kernels), -1)
+        return np.column_stack([
+            responses.mean(axis=1, dtype=np.float64),
+            responses.var(axis=1, dtype=np.float64)
+        ]).ravel()
+
+@lru_cache(maxsize=8)
+def get_gabor_bank(scales=(8.0,), orientations=4, ksize=None, use_dft=None):
+    """
+    Return the shared GaborFilterBank for a configuration, building it on first use.
+    
+    Only the 8 most recently used configurations keep their bank.
+    """
+    return GaborFilterBank(scales=scales, orientations=orientations, ksize=ksize, use_dft=use_dft)
+
+def calculate_gabor_features(gray_image, bank=None):
     """
     Compute Gabor filter features.
     
     Args:
         gray_image (numpy.ndarray): Grayscale input image
+        bank (GaborFilterBank, optional): Filter bank giving mean and variance per filter.
+            When omitted, the 4 default kernels are applied with 8-bit output, which is the
+            layout stored in existing descriptor files.
     
     Returns:
         numpy.ndarray: Gabor filter responses
     """
-    kernels = []
-    responses = []
+    if bank is not None:
+        return bank.compute(gray_image)
     
-    for theta in range(4):
-        theta_rad = theta / 4.0 * np.pi
-        kernel = cv2.getGaborKernel(
-            (21, 21), 8.0, theta_rad, 10.0, 0.5, 0, ktype=cv2.CV_32F
-        )
-        kernels.append(kernel)
-        
+    responses = []
+    for kernel in get_gabor_bank().kernels:
         # Apply Gabor filter and compute mean response
         filtered = cv2.filter2D(gray_image, cv2.CV_8UC1, kernel)
         responses.append(np.mean(filtered))
     
     return np.array(responses)
 
-def calculate_glcm_features(gray_image):
+GLCM_ANGLES = (0, np.pi/4, np.pi/2, 3*np.pi/4)
+
+@lru_cache(maxsize=None)
+def _glcm_index_grids(levels):
+    """
+    Precompute the (i - j)^2 and i * j weight grids for a GLCM.
+    
+    Args:
+        levels (int): Number of gray levels of the GLCM
+    
+    Returns:
+        tuple: (contrast_grid, correlation_grid), both float32 arrays of shape (levels, levels)
+    """
+    i, j = np.indices((levels, levels)).astype(np.float32)
+    return (i - j) ** 2, i * j
+
+def _quantize_gray(gray_image, levels):
+    """
+    Map 8-bit gray values onto `levels` evenly spaced bins.
+    """
+    if levels == 256:
+        return gray_image.astype(np.intp)
+    return (gray_image.astype(np.intp) * levels) >> 8
+
+def _glcm_pairs(gray_image, offset_x, offset_y):
+    """
+    Return the reference and neighbour pixel arrays for a given offset.
+    """
+    height, width = gray_image.shape
+    row_start, row_end = max(0, -offset_y), height - max(0, offset_y)
+    col_start, col_end = max(0, -offset_x), width - max(0, offset_x)
+    reference = gray_image[row_start:row_end, col_start:col_end]
+    neighbour = gray_image[row_start + offset_y:row_end + offset_y,
+                           col_start + offset_x:col_end + offset_x]
+    return reference, neighbour
+
+def calculate_glcm_features(gray_image, distances=(1,), levels=256):
     """
     Compute Gray Level Co-occurrence Matrix (GLCM) features.
     
+    The co-occurrence matrices are built with a single bincount over the
+    shifted pixel-pair index arrays, and contrast, correlation and energy
+    are computed against cached index grids.
+    
     Args:
         gray_image (numpy.ndarray): Grayscale input image
+        distances (iterable of int): Pixel distances to build a GLCM for
+        levels (int): Number of gray levels (e.g. 32 or 64 to quantize, 256 to keep full range)
     
     Returns:
-        numpy.ndarray: GLCM-based texture features
+        numpy.ndarray: GLCM-based texture features, 3 per (distance, angle) pair
+    """
+    quantized = _quantize_gray(gray_image, levels)
+    contrast_grid, correlation_grid = _glcm_index_grids(levels)
+    
+    all_features = []
+    
+    for distance in distances:
+        for angle in GLCM_ANGLES:
+            # Offsets are truncated the same way the original per-pixel loop did
+            offset_x = int(np.cos(angle) * distance)
+            offset_y = int(np.sin(angle) * distance)
+            reference, neighbour = _glcm_pairs(quantized, offset_x, offset_y)
+            
+            # Compute and normalize GLCM
+            glcm = np.bincount(
+                (reference * levels + neighbour).ravel(), minlength=levels * levels
+            ).astype(np.float32).reshape(levels, levels)
+            glcm /= (np.sum(glcm) + 1e-10)
+            
+            # Contrast, correlation, energy
+            all_features.extend([
+                np.sum(contrast_grid * glcm),
+                np.sum(correlation_grid * glcm),
+                np.sum(glcm * glcm)
+            ])
+    
+    return np.array(all_features)
+
+def _calculate_glcm_features_loop(gray_image):
+    """
+    Reference per-pixel GLCM implementation, kept to validate calculate_glcm_features.
     """
     # Define GLCM parameters
     distances = [1]
@@ -164,19 +540,21 @@ def calculate_glcm_features(gray_image):
     
     return np.array(all_features)
 
-def calculate_shape_features(image):
+def calculate_shape_features(image, binary_image=None):
     """
     Extract shape-based features from an image.
     
     Args:
         image (numpy.ndarray): Input image
+        binary_image (numpy.ndarray, optional): Thresholded grayscale image, if already computed
     
     Returns:
         dict: Shape-based features
     """
     # Convert to grayscale and threshold
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    _, binary_image = cv2.threshold(gray_image, 127, 255, cv2.THRESH_BINARY)
+    if binary_image is None:
+        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, binary_image = cv2.threshold(gray_image, 127, 255, cv2.THRESH_BINARY)
     
     # Find contours
     contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -204,4 +582,229 @@ def calculate_shape_features(image):
     return {
         "hu_moments": hu_moments,
         "shape_descriptors": shape_descriptors
-    }
\ No newline at end of file
+    }
+
+class ImageContext:
+    """
+    A decoded image plus intermediates shared by the descriptor plugins.
+    
+    Intermediates are computed on first access, so each one is computed at
+    most once per image whatever the number of plugins using it.
+    """
+    def __init__(self, image, params):
+        self.image = image
+        self.params = params
+        self._intermediates = {}
+    
+    def intermediate(self, name, compute):
+        """
+        Return a named intermediate, computing it with `compute()` on first access.
+        """
+        if name not in self._intermediates:
+            self._intermediates[name] = compute()
+        return self._intermediates[name]
+    
+    @property
+    def gray(self):
+        return self.intermediate('gray', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+    
+    @property
+    def binary(self):
+        return self.intermediate(
+            'binary', lambda: cv2.threshold(self.gray, 127, 255, cv2.THRESH_BINARY)[1]
+        )
+    
+    @property
+    def hsv(self):
+        return self.intermediate('hsv', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV))
+
+# Descriptor plugins by name, each called as plugin(context) -> {sub_descriptor: array}
+DESCRIPTOR_PLUGINS = {}
+# Ranking weight of every plugin, used when the weights in use have no entry for it
+DESCRIPTOR_WEIGHTS = {}
+
+def register_descriptor(name, weight=0.2):
+    """
+    Decorator registering a descriptor plugin under `name`.
+    
+    A plugin receives an ImageContext and returns a dict of sub-descriptor
+    arrays. Indexes opt into it by listing `name` in their "descriptors"
+    extraction setting, the search classes need no change: when the ranking
+    weights have no entry for the plugin, it is ranked with `weight` and
+    equal weights for its sub-descriptors (see indexed_weights).
+    """
+    def decorator(plugin):
+        DESCRIPTOR_PLUGINS[name] = plugin
+        DESCRIPTOR_WEIGHTS[name] = weight
+        return plugin
+    return decorator
+
+class DescriptorPipeline:
+    """
+    Decodes an image once and runs the selected descriptor plugins against it.
+    
+    Wall time is accumulated per stage (decode and each plugin) across calls.
+    """
+    def __init__(self, scale=1.0, dominant_colors_mode='kmeans', descriptors=('color', 'texture', 'shape'),
+                 gabor=None):
+        unknown = [name for name in descriptors if name not in DESCRIPTOR_PLUGINS]
+        if unknown:
+            raise ValueError(f"Unknown descriptors {unknown}, registered: {list(DESCRIPTOR_PLUGINS)}")
+        self.params = normalize_extraction_params({
+            "scale": scale,
+            "dominant_colors_mode": dominant_colors_mode,
+            "descriptors": descriptors,
+            "gabor": gabor
+        })
+        self.descriptors = tuple(descriptors)
+        self.images = 0
+        self.timings = {name: 0.0 for name in ('decode',) + self.descriptors}
+        self._lock = threading.Lock()
+    
+    def compute(self, image):
+        """
+        Calculate the descriptors of one image.
+        
+        Args:
+            image (str, bytes or numpy.ndarray): Image path, encoded bytes or decoded image
+        
+        Returns:
+            dict: {descriptor_name: {sub_descriptor: numpy.ndarray}}
+        """
+        timings = {}
+        start = time.perf_counter()
+        context = ImageContext(load_image(image, self.params["scale"]), self.params)
+        timings['decode'] = time.perf_counter() - start
+        
+        descriptors = {}
+        for name in self.descriptors:
+            start = time.perf_counter()
+            descriptors[name] = DESCRIPTOR_PLUGINS[name](context)
+            timings[name] = time.perf_counter() - start
+        
+        with self._lock:
+            self.images += 1
+            for name, elapsed in timings.items():
+                self.timings[name] += elapsed
+        return descriptors
+    
+    def timing_report(self):
+        """
+        Return the total and mean wall time of every stage.
+        """
+        with self._lock:
+            return {
+                "images": self.images,
+                "stages": {
+                    name: {
+                        "total_s": total,
+                        "mean_ms": 1000 * total / self.images if self.images else 0.0
+                    }
+                    for name, total in self.timings.items()
+                }
+            }
+
+def get_pipeline(scale=1.0, dominant_colors_mode='kmeans', descriptors=('color', 'texture', 'shape'), gabor=None):
+    """
+    Return the shared DescriptorPipeline for a configuration.
+    """
+    gabor = normalize_gabor_params(gabor)
+    gabor_key = None if gabor is None else (tuple(gabor["scales"]), gabor["orientations"], gabor["use_dft"])
+    return _get_pipeline(scale, dominant_colors_mode, tuple(descriptors), gabor_key)
+
+@lru_cache(maxsize=None)
+def _get_pipeline(scale, dominant_colors_mode, descriptors, gabor_key):
+    # lru_cache needs hashable arguments, the Gabor setting comes as a tuple
+    gabor = None if gabor_key is None else dict(zip(("scales", "orientations", "use_dft"), gabor_key))
+    return DescriptorPipeline(scale, dominant_colors_mode, descriptors, gabor)
+
+def extraction_gabor_bank(params):
+    """
+    Return the GaborFilterBank of normalized extraction settings, or None for the legacy features.
+    """
+    gabor = params["gabor"]
+    if gabor is None:
+        return None
+    return get_gabor_bank(tuple(gabor["scales"]), gabor["orientations"], use_dft=gabor["use_dft"])
+
+@register_descriptor('color')
+def _color_descriptor(context):
+    return calculate_color_features(context.image, context.params["dominant_colors_mode"])
+
+@register_descriptor('texture')
+def _texture_descriptor(context):
+    return calculate_texture_features(
+        context.image, gabor_bank=extraction_gabor_bank(context.params), gray_image=context.gray
+    )
+
+@register_descriptor('shape')
+def _shape_descriptor(context):
+    return calculate_shape_features(context.image, binary_image=context.binary)
+
+def test_glcm_features(image_paths=None):
+    """
+    Check that the vectorized GLCM matches the reference per-pixel implementation.
+    
+    Args:
+        image_paths (list, optional): Paths to images to compare on
+    """
+    if image_paths is None:
+        image_paths = [
+            '../../Dataset/RSSCN7-master/aGrass/a001.jpg',
+            '../../Dataset/RSSCN7-master/cIndustry/c001.jpg'
+        ]
+    
+    gray_images = [np.random.default_rng(0).integers(0, 256, (37, 53), dtype=np.uint8)]
+    for path in image_paths:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"Skipping missing image {path}")
+            continue
+        gray_images.append(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    
+    for gray_image in gray_images:
+        expected = _calculate_glcm_features_loop(gray_image)
+        actual = calculate_glcm_features(gray_image)
+        assert np.allclose(actual, expected, rtol=1e-5, atol=1e-8), (actual, expected)
+        print(f"GLCM features match for image of shape {gray_image.shape}")
+
+def test_gabor_filter_bank(image_paths=None):
+    """
+    Check that the DFT path of GaborFilterBank matches cv2.filter2D in float32.
+    
+    Args:
+        image_paths (list, optional): Paths to images to compare on
+    """
+    if image_paths is None:
+        image_paths = [
+            '../../Dataset/RSSCN7-master/aGrass/a001.jpg',
+            '../../Dataset/RSSCN7-master/cIndustry/c001.jpg'
+        ]
+    
+    rng = np.random.default_rng(0)
+    gray_images = [rng.integers(0, 256, shape, dtype=np.uint8) for shape in ((37, 53), (120, 97))]
+    for path in image_paths:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"Skipping missing image {path}")
+            continue
+        gray_images.append(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    
+    scales, orientations = (4.0, 8.0, 16.0), 6
+    direct = GaborFilterBank(scales, orientations, use_dft=False)
+    dft = GaborFilterBank(scales, orientations, use_dft=True)
+    for gray_image in gray_images:
+        expected = direct.responses(gray_image)
+        actual = dft.responses(gray_image)
+        assert actual.dtype == expected.dtype == np.float32
+        # Relative to the largest response of each filter, float32 FFT rounding stays far below
+        error = np.abs(actual - expected).max(axis=(1, 2)) / np.abs(expected).max(axis=(1, 2))
+        assert error.max() < 1e-4, error
+        assert np.allclose(dft.compute(gray_image), direct.compute(gray_image), rtol=1e-4, atol=1e-3)
+        print(f"Gabor DFT responses match filter2D for image of shape {gray_image.shape} "
+              f"(relative error {error.max():.1e})")
+
+# Run the tests when script is executed directly
+if __name__ == "__main__":
+    test_glcm_features()
+    test_gabor_filter_bank()
@@ -1,5 +1,5 @@
 import numpy as np
-from Descriptors_calcul import calculate_descriptors
+from Descriptors_calcul import DESCRIPTOR_WEIGHTS, calculate_descriptors
 def update_weights(weights, IR_t, INR_t, Lc):
     """
     Update descriptor weights based on user feedback.
@@ -34,6 +34,14 @@ def update_weights(weights, IR_t, INR_t, Lc):
                 weights[descriptor][sub_desc] *= lambda_negative
 
     return weights
+def normalize_rows(matrix):
+    """
+    Min-max normalize every row of a matrix, as calculate_distance normalizes a vector.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    minimum = matrix.min(axis=1, keepdims=True)
+    return (matrix - minimum) / (matrix.max(axis=1, keepdims=True) - minimum + 1e-10)
+
 def calculate_distance(value1, value2):
     """Enhanced distance calculation with more robust normalization."""
     def normalize(x):
@@ -56,29 +64,64 @@ def calculate_distance(value1, value2):
         print(f"Distance calculation error: {e}")
         return 1.0
 
+# Default weights of calculate_global_distance
+DEFAULT_WEIGHTS = {
+    "color": {
+        "weight": 0.6,  # Highest priority for color
+        "histogram": 0.8,  # Very strong emphasis on color distribution
+        "dominant_colors": 0.2
+    },
+    "texture": {
+        "weight": 0.3,
+        "gabor_filters": 0.7,  # Strong texture feature extraction
+        "glcm_features": 0.3
+    },
+    "shape": {
+        "weight": 0.1,  # Minimal shape impact
+        "hu_moments": 0.6,
+        "shape_descriptors": 0.4
+    }
+}
+
+def indexed_weights(weights, keys):
+    """
+    Restrict descriptor weights to the (descriptor_type, sub_descriptor) blocks of an index.
+
+    Entries the index has no data for are dropped. Indexed descriptors without
+    an entry (plugins) get their registered weight and equal sub-descriptor weights.
+
+    Args:
+        weights (dict): Descriptor weights, like DEFAULT_WEIGHTS
+        keys (iterable): Indexed (descriptor_type, sub_descriptor) pairs
+
+    Returns:
+        dict: Weights covering exactly the indexed blocks
+    """
+    sub_descriptors = {}
+    for descriptor_type, sub_descriptor in keys:
+        sub_descriptors.setdefault(descriptor_type, []).append(sub_descriptor)
+
+    result = {}
+    for descriptor, descriptor_weights in weights.items():
+        indexed = {
+            sub_desc: sub_weight for sub_desc, sub_weight in descriptor_weights.items()
+            if sub_desc in sub_descriptors.get(descriptor, ())
+        }
+        if indexed:
+            result[descriptor] = {"weight": descriptor_weights.get("weight", 1.0), **indexed}
+    for descriptor, subs in sub_descriptors.items():
+        if descriptor not in result and descriptor not in weights:
+            result[descriptor] = {"weight": DESCRIPTOR_WEIGHTS.get(descriptor, 0.2),
+                                  **{sub_desc: 1.0 for sub_desc in subs}}
+    return result
+
 def calculate_global_distance(desc1, desc2, weights=None):
     """
     Calculate the overall similarity between two image descriptors.
     """
     # Default weights if not provided
     if weights is None:
-        weights = {
-            "color": {
-                "weight": 0.6,  # Highest priority for color
-                "histogram": 0.8,  # Very strong emphasis on color distribution
-                "dominant_colors": 0.2
-            },
-            "texture": {
-                "weight": 0.3,
-                "gabor_filters": 0.7,  # Strong texture feature extraction
-                "glcm_features": 0.3
-            },
-            "shape": {
-                "weight": 0.1,  # Minimal shape impact
-                "hu_moments": 0.6,
-                "shape_descriptors": 0.4
-            }
-        }
+        weights = DEFAULT_WEIGHTS
     
     global_distance = 0.0
     total_weight = 0.0
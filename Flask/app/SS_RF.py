@@ -1,6 +1,4 @@
 from flask import Flask, request, jsonify
-from werkzeug.utils import secure_filename
-import os
 import json
 
 # Import the updated SemiSupervisedImageSearch class
@@ -9,10 +7,7 @@ from semi_supervised_search import SemiSupervisedImageSearch
 # Flask App Configuration
 app = Flask(__name__)
 
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 DATASET_PATH = '../../Dataset/RSSCN7-master'
 
@@ -36,10 +31,6 @@ def search_similar_images():
         return jsonify({"error": "No selected file"}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         # Parse feedback from the request
         feedback = request.form.get('feedback')
         parsed_feedback = None
@@ -51,15 +42,14 @@ def search_similar_images():
 
         try:
             # Perform image search
+            # Decode straight from the request stream, nothing is written to disk
             similar_images = image_search.find_similar_images(
-                filepath, 
+                file.read(), 
                 top_k=5, 
                 feedback=parsed_feedback
             )
-            os.remove(filepath)
             return jsonify({"similar_images": similar_images})
         except Exception as e:
-            os.remove(filepath)
             return jsonify({"error": str(e)}), 500
     
     return jsonify({"error": "File type not allowed"}), 400
@@ -1,47 +1,90 @@
 import os
-import json
 import numpy as np
 from flask import Flask, request, jsonify
-from werkzeug.utils import secure_filename
 from Descriptors_calcul import calculate_descriptors
-from Global_distance_calcul import calculate_global_distance
+from ranking import RankingEngine, top_k_indices
+from batch_search import batch_search
+from sharded_search import ShardedSearch
+from pq_index import load_or_build_pq_index, pq_index_path
+from cascade import ShortlistAudit, cascade_path, load_or_build_prefilter
+from knn_graph import knn_graph_path, load_knn_graph
+from query_cache import QueryDescriptorCache, ScoreCache, cached_query_descriptors, query_key
+from descriptor_store import (
+    DEFAULT_PRECISION, BinaryDescriptorStore, DescriptorJournal, binary_store_path, check_extraction_params,
+    compact_journal, convert_json_to_binary, iter_image_paths, load_descriptor_file,
+    open_descriptors, raw_dtype, read_extraction_params, serialize_descriptors, to_numpy
+)
 
 class ImageSimilaritySearch:
-    def __init__(self, dataset_path, descriptors_file='image_descriptors.json'):
+    def __init__(self, dataset_path, descriptors_file='image_descriptors.json', query_cache=None,
+                 extraction_params=None, score_cache=None, pq_shortlist=None, pq_subvectors=32,
+                 shards=None, precision=DEFAULT_PRECISION, cascade_shortlist=None, cascade_dims=32,
+                 audit_every=50):
         """
         Initialize the image similarity search system.
         
         Args:
             dataset_path (str): Path to the directory containing images
             descriptors_file (str): Path to the JSON file storing precomputed descriptors
+            query_cache (QueryDescriptorCache, optional): Cache of query descriptors, a private one by default
+            extraction_params (dict, optional): Extraction settings (e.g. {"scale": 0.5}) used when
+                building a new index. An existing index always uses the settings it was built with.
+            score_cache (ScoreCache, optional): Cache of per-query score arrays used for paging,
+                a private one by default
+            pq_shortlist (int, optional): Rank through product-quantized codes, re-scoring only
+                this many images exactly; None scans the whole collection exactly
+            pq_subvectors (int): Bytes per image of the PQ codes when the PQ index is (re)built
+            shards (int, optional): Scan the collection in this many row ranges over a pool of
+                worker processes sharing the descriptor matrices; None scans in-process
+            precision (str): 'float32', 'float16' or 'float64' storage of the ranking blocks
+                when building a new index; an existing index keeps the precision it was built with
+            cascade_shortlist (int, optional): Rank every image by a cheap low-dimensional projection
+                first and re-score only this many exactly; ignored when pq_shortlist is set
+            cascade_dims (int): Dimensions of the projection when the cascade prefilter is (re)built
+            audit_every (int): Also run the exact scan on one shortlisted query out of this many
+                and count the exact top-k results the shortlist missed; 0 disables it
         """
         self.dataset_path = dataset_path
         self.descriptors_file = descriptors_file
         self.image_descriptors = {}
         self.image_paths = []
+        self.query_cache = query_cache if query_cache is not None else QueryDescriptorCache()
+        self.score_cache = score_cache if score_cache is not None else ScoreCache()
+        self.extraction_params = extraction_params
+        self.precision = precision
         
         # Load or precompute descriptors
         self._load_or_precompute_descriptors()
+        self.ranking_engine = RankingEngine.from_descriptors(self.image_descriptors, precision=self.precision)
+        self.pq_shortlist = pq_shortlist
+        self.pq_index = None
+        if pq_shortlist is not None:
+            self.pq_index = load_or_build_pq_index(
+                pq_index_path(self.descriptors_file), self.ranking_engine.normalized,
+                self.ranking_engine.paths, pq_subvectors
+            )
+        self.cascade_shortlist = cascade_shortlist
+        self.prefilter = None
+        if cascade_shortlist is not None and pq_shortlist is None:
+            self.prefilter = load_or_build_prefilter(
+                cascade_path(self.descriptors_file), self.ranking_engine.normalized,
+                self.ranking_engine.paths, cascade_dims
+            )
+        self.shortlist_audit = ShortlistAudit(audit_every)
+        self.sharded_search = ShardedSearch(self.ranking_engine, shards) if shards else None
+        # Row of every indexed image, and its precomputed neighbours when knn_graph.py was run
+        self.path_rows = {path: row for row, path in enumerate(self.ranking_engine.paths)}
+        self.knn_graph = load_knn_graph(knn_graph_path(self.descriptors_file), self.ranking_engine.paths)
     
     def _load_or_precompute_descriptors(self):
         """
         Load descriptors from a file or precompute them if not available.
         """
-        if os.path.exists(self.descriptors_file):
+        if os.path.exists(self.descriptors_file) or os.path.exists(binary_store_path(self.descriptors_file)):
             print("Loading descriptors from disk...")
-            with open(self.descriptors_file, 'r') as file:
-                data = json.load(file)
-                self.image_descriptors = {
-                    k: {
-                        descriptor_type: {
-                            sub_k: np.array(sub_v) 
-                            for sub_k, sub_v in descriptor_data.items()
-                        }
-                        for descriptor_type, descriptor_data in v.items()
-                    }
-                    for k, v in data.items()
-                }
-                self.image_paths = list(self.image_descriptors.keys())
+            self.image_descriptors = open_descriptors(self.descriptors_file)
+            self.image_paths = list(self.image_descriptors.keys())
+            self.extraction_params = read_extraction_params(self.descriptors_file)
             print(f"Loaded descriptors for {len(self.image_descriptors)} images")
         else:
             print("Descriptors file not found. Precomputing descriptors...")
@@ -51,134 +94,198 @@ class ImageSimilaritySearch:
     
     def _precompute_descriptors(self):
         """
-        Precompute descriptors for all images in the dataset and save incrementally.
+        Precompute descriptors for all images in the dataset and journal them incrementally.
         """
-        # Initialize or load existing descriptors
-        if os.path.exists(self.descriptors_file):
-            with open(self.descriptors_file, 'r') as file:
-                self.image_descriptors = json.load(file)
-        else:
-            self.image_descriptors = {}
+        # Resume from whatever the descriptors file and its journal already hold
+        self.extraction_params = check_extraction_params(self.descriptors_file, self.extraction_params)
+        self.image_descriptors = load_descriptor_file(self.descriptors_file)
 
-        # Process images and save descriptors incrementally
-        for root, _, files in os.walk(self.dataset_path):
-            for filename in files:
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                    full_path = os.path.join(root, filename)
-                    
-                    # Skip if already processed
-                    if full_path in self.image_descriptors:
-                        continue
+        with DescriptorJournal(self.descriptors_file) as journal:
+            for full_path in iter_image_paths(self.dataset_path):
+                # Skip if already processed
+                if full_path in self.image_descriptors:
+                    continue
+                
+                try:
+                    print(f"Calculating descriptors for {full_path}...")
+                    descriptors = calculate_descriptors(full_path, **self.extraction_params)
                     
-                    try:
-                        print(f"Calculating descriptors for {full_path}...")
-                        descriptors = calculate_descriptors(full_path)
-                        
-                        # Convert descriptors to JSON-serializable format
-                        serializable_descriptors = {
-                            descriptor_type: {
-                                k: v.tolist() if hasattr(v, 'tolist') else v 
-                                for k, v in descriptor_data.items()
-                            }
-                            for descriptor_type, descriptor_data in descriptors.items()
-                        }
-                        
-                        # Add to image descriptors
-                        self.image_descriptors[full_path] = serializable_descriptors
-                        self.image_paths.append(full_path)
-                        
-                        # Save to file after each image
-                        with open(self.descriptors_file, 'w') as file:
-                            json.dump(self.image_descriptors, file)
-                        
-                        print(f"Saved descriptors for {full_path}")
+                    # Convert descriptors to JSON-serializable format and journal them
+                    serializable_descriptors = serialize_descriptors(descriptors)
+                    self.image_descriptors[full_path] = serializable_descriptors
+                    journal.append(full_path, serializable_descriptors)
                     
-                    except Exception as e:
-                        print(f"Error processing {full_path}: {e}")
+                    print(f"Saved descriptors for {full_path}")
+                
+                except Exception as e:
+                    print(f"Error processing {full_path}: {e}")
 
+        self.image_descriptors = to_numpy(self.image_descriptors, raw_dtype(self.precision))
+        self.image_paths = list(self.image_descriptors.keys())
         print(f"Precomputed descriptors for {len(self.image_descriptors)} images")
     
     def _save_descriptors(self):
         """
-        Save descriptors to a JSON file to avoid recalculating them.
+        Compact the descriptor journal into the descriptors file and build the binary store.
         """
         print("Saving descriptors to disk...")
-        # Convert nested descriptors to a serializable format
-        serializable_descriptors = {}
-        for path, descriptors in self.image_descriptors.items():
-            serializable_descriptors[path] = {
-                descriptor_type: {
-                    k: v.tolist() if hasattr(v, 'tolist') else v 
-                    for k, v in descriptor_data.items()
-                }
-                for descriptor_type, descriptor_data in descriptors.items()
-            }
-        
-        with open(self.descriptors_file, 'w') as file:
-            json.dump(serializable_descriptors, file)
+        compact_journal(self.descriptors_file)
+        self.image_descriptors = BinaryDescriptorStore(
+            convert_json_to_binary(self.descriptors_file, precision=self.precision)
+        )
+        self.image_paths = list(self.image_descriptors.keys())
         print("Descriptors saved successfully")
 
-    def find_similar_images(self, query_image_path, top_k=5):
+    def find_similar_images_batch(self, images, top_k=5, workers=None, query_block=16, pool=None):
+        """
+        Rank the dataset against many query images, yielding results per query as they complete.
+        
+        Args:
+            images: Query images: a directory, a zip/tar archive (path or bytes), or a list
+                of image paths, encoded images or (name, image) pairs
+            top_k (int): Number of similar images to return per query
+            workers (int, optional): Descriptor extraction processes, defaults to the CPU count
+            query_block (int): Number of queries ranked together in one distance matrix
+            pool (ExtractionPool, optional): Long-lived extraction pool shared between batches
+        
+        Yields:
+            dict: {"query": name, "similar_images": [...]} or {"query": name, "error": message}
+        """
+        return batch_search(
+            self.ranking_engine, images, top_k, None, self.extraction_params, workers, query_block, pool
+        )
+
+    def find_similar_images(self, query_image, top_k=5, offset=0):
         """
         Find the most similar images to the query image.
         
         Args:
-            query_image_path (str): Path to the query image
+            query_image (str, bytes or numpy.ndarray): Path to the query image, its encoded
+                bytes (e.g. an upload) or the decoded image
             top_k (int): Number of similar images to return
+            offset (int): Number of better-ranked images to skip, for paging. Further
+                pages of a recent query reuse its cached scores instead of ranking again.
         
         Returns:
             list: Detailed information about the most similar images
         """
         try:
-            print(f"Calculating descriptors for query image: {query_image_path}...")
-            query_descriptors = calculate_descriptors(query_image_path)
-            
-            print("Calculating distances to dataset images...")
-            distances = []
-            for path, dataset_descriptors in self.image_descriptors.items():
-                try:
-                    # Convert the nested dictionary back to a format compatible with calculate_global_distance
-                    normalized_descriptors = {
-                        descriptor_type: {
-                            k: np.array(v) for k, v in descriptor_group.items()
-                        }
-                        for descriptor_type, descriptor_group in dataset_descriptors.items()
-                    }
-                    
-                    distance = calculate_global_distance(query_descriptors, normalized_descriptors)
-                    distances.append((path, distance))
-                except Exception as e:
-                    print(f"Error processing {path}: {e}")
-            
-            # Sort distances and get top k
-            distances.sort(key=lambda x: x[1])
-            print(f"Found {len(distances)} similar images. Returning top {top_k}.")
-            
-            # Return detailed results with file path and similarity score
+            key = query_key(query_image, self.extraction_params)
+
+            def describe():
+                source = query_image if isinstance(query_image, str) else "uploaded image"
+                print(f"Calculating descriptors for query image: {source}...")
+                return cached_query_descriptors(self.query_cache, query_image, self.extraction_params, key=key)
+
+            return self._search(key, describe, top_k, offset)
+        
+        except Exception as e:
+            print(f"Error finding similar images: {e}")
+            return []
+
+    def find_similar_by_id(self, image_id, top_k=5, offset=0):
+        """
+        Find the images most similar to an indexed image, without extracting its descriptors again.
+
+        Ranks covered by the precomputed neighbour graph (see knn_graph.py) are read
+        from it; otherwise the stored descriptors are ranked like an uploaded query.
+
+        Args:
+            image_id (int): Row of the image in the index
+            top_k (int): Number of similar images to return
+            offset (int): Number of better-ranked images to skip, for paging
+
+        Returns:
+            list: Detailed information about the most similar images
+        """
+        if not 0 <= image_id < len(self.ranking_engine):
+            raise KeyError(f"No indexed image with id {image_id}")
+        path = self.ranking_engine.paths[image_id]
+
+        if self.knn_graph is not None and self.knn_graph.covers(offset + top_k):
+            rows, distances = self.knn_graph.neighbors_of(image_id, top_k, offset)
             return [
-                {
-                    "image_path": path, 
-                    "similarity_score": float(distance)  # Convert to float for JSON serialization
-                } 
-                for path, distance in distances[:top_k]
+                {"image_id": int(idx), "image_path": self.ranking_engine.paths[idx],
+                 "similarity_score": float(distance)}
+                for idx, distance in zip(rows, distances)
             ]
-        
+
+        try:
+            return self._search(f"dataset:{path}", lambda: self.image_descriptors[path], top_k, offset)
         except Exception as e:
             print(f"Error finding similar images: {e}")
             return []
+
+    def find_similar_by_path(self, image_path, top_k=5, offset=0):
+        """
+        Find the images most similar to an indexed image given by its path, see find_similar_by_id.
+        """
+        if image_path not in self.path_rows:
+            raise KeyError(f"Image not in the index: {image_path}")
+        return self.find_similar_by_id(self.path_rows[image_path], top_k, offset)
+
+    def _search(self, key, describe, top_k, offset):
+        """
+        Rank the collection against a query, reusing the cached scores of its key.
+
+        Args:
+            key (str): Score cache key of the query
+            describe (callable): Returns the query descriptors, only called on a cache miss
+            top_k (int): Number of similar images to return
+            offset (int): Number of better-ranked images to skip
+        """
+        distances = self.score_cache.get(key)
+        if distances is None:
+            query_descriptors = describe()
+            
+            if self.sharded_search is not None and self.pq_index is None and self.prefilter is None:
+                # Workers only return their local top ranks, there is no score array to cache
+                print(f"Calculating distances over {self.sharded_search.shards} shards...")
+                rows, row_distances = self.sharded_search.top_k(query_descriptors, offset + top_k)
+                return [
+                    {"image_id": int(idx), "image_path": self.ranking_engine.paths[idx],
+                     "similarity_score": float(distance)}
+                    for idx, distance in zip(rows[offset:], row_distances[offset:])
+                ]
+            
+            if self.pq_index is None and self.prefilter is None:
+                print("Calculating distances to dataset images...")
+                distances = self.ranking_engine.distances(query_descriptors)
+            else:
+                # Shortlist with the compressed codes or the cascade projection, then re-score it exactly
+                if self.pq_index is not None:
+                    print(f"Re-scoring a PQ shortlist of {self.pq_shortlist} images...")
+                    shortlist = self.pq_index.shortlist(query_descriptors, self.pq_shortlist)
+                else:
+                    print(f"Re-scoring a cascade shortlist of {self.cascade_shortlist} images...")
+                    shortlist = self.prefilter.shortlist(query_descriptors, self.cascade_shortlist)
+                distances = np.full(len(self.ranking_engine), np.inf)
+                distances[shortlist] = self.ranking_engine.distances(query_descriptors, rows=shortlist)
+                if self.shortlist_audit.due():
+                    exact_top = top_k_indices(self.ranking_engine.distances(query_descriptors), offset + top_k)
+                    missed = self.shortlist_audit.record(shortlist, exact_top)
+                    print(f"Shortlist audit: {missed} of the exact top {len(exact_top)} missed")
+            self.score_cache.put(key, distances)
+        
+        # Select and sort only the requested ranks, images outside a shortlist are not results
+        ranked = [idx for idx in top_k_indices(distances, top_k, offset) if np.isfinite(distances[idx])]
+        print(f"Found {len(distances)} similar images. Returning ranks {offset + 1} to {offset + len(ranked)}.")
+        
+        # Return detailed results with image id, file path and similarity score
+        return [
+            {
+                "image_id": int(idx),
+                "image_path": self.ranking_engine.paths[idx], 
+                "similarity_score": float(distances[idx])  # Convert to float for JSON serialization
+            } 
+            for idx in ranked
+        ]
 # Flask Application
 app = Flask(__name__)
 
-# Configure upload folder and allowed extensions
-UPLOAD_FOLDER = 'uploads'
+# Configure allowed extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
 
-# Ensure upload folder exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-# Configure app
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
 # Configure dataset path (replace with your actual dataset path)
 DATASET_PATH = '../../Dataset/RSSCN7-master'
 
@@ -206,16 +313,11 @@ def search_similar_images():
         return jsonify({"error": "No selected file"}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         try:
-            similar_images = image_search.find_similar_images(filepath, top_k=5)
-            os.remove(filepath)
+            # Decode straight from the request stream, nothing is written to disk
+            similar_images = image_search.find_similar_images(file.read(), top_k=5)
             return jsonify({"similar_images": similar_images})
         except Exception as e:
-            os.remove(filepath)
             return jsonify({"error": str(e)}), 500
     
     return jsonify({"error": "File type not allowed"}), 400
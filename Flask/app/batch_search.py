@@ -0,0 +1,218 @@
+"""
+Batch search: rank the dataset against many query images in one job.
+
+Query images come from a list (paths or encoded bytes), a directory or a
+zip/tar archive. Their descriptors are extracted over a process pool, a
+long-lived ExtractionPool in a server so batches do not each pay for
+starting and stopping worker processes, and queries are ranked
+`query_block` at a time: RankingEngine.batch_distances
+computes the block's Q x N distance matrix in blocked matrix operations
+instead of Q separate scans. Results are yielded per query as soon as its
+block is ranked, so callers can stream them.
+"""
+import atexit
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from Descriptors_calcul import calculate_descriptors, init_extraction_worker
+from descriptor_store import IMAGE_EXTENSIONS, iter_image_paths
+from ranking import top_k_indices
+
+
+def iter_archive_images(archive_bytes):
+    """
+    Yield (member name, encoded bytes) for every image of a zip or tar archive.
+    """
+    buffer = io.BytesIO(archive_bytes)
+    if zipfile.is_zipfile(buffer):
+        with zipfile.ZipFile(buffer) as archive:
+            for name in sorted(archive.namelist()):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield name, archive.read(name)
+        return
+
+    buffer.seek(0)
+    with tarfile.open(fileobj=buffer) as archive:
+        for member in sorted(archive.getmembers(), key=lambda member: member.name):
+            if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield member.name, archive.extractfile(member).read()
+
+
+def iter_query_images(source):
+    """
+    Normalize a batch source into (name, image) pairs, the image being a path or encoded bytes.
+
+    Args:
+        source: A directory path, the path or bytes of a zip/tar archive, or a
+            list of image paths, encoded images or (name, image) pairs
+    """
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            for path in sorted(iter_image_paths(source)):
+                yield path, path
+            return
+        with open(source, 'rb') as file:
+            source = file.read()
+
+    if isinstance(source, (bytes, bytearray)):
+        yield from iter_archive_images(bytes(source))
+        return
+
+    for position, item in enumerate(source):
+        if isinstance(item, tuple):
+            yield item
+        elif isinstance(item, str):
+            yield item, item
+        else:
+            yield f"query_{position}", item
+
+
+def _extract(item, extraction_params):
+    """
+    Worker task: compute the descriptors of one query image without raising.
+
+    Returns:
+        tuple: (name, descriptors or None, error message or None)
+    """
+    name, image = item
+    try:
+        return name, calculate_descriptors(image, **extraction_params), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+class ExtractionPool:
+    """
+    Worker processes extracting query descriptors, shared by every batch of a server.
+
+    The processes are started on first use and kept until close(). Batches of
+    at most `inline_max` images are extracted in the calling process instead,
+    sending them to a worker costs more than it saves.
+    """
+    def __init__(self, workers=None, chunksize=4, inline_max=1):
+        """
+        Args:
+            workers (int, optional): Worker processes, defaults to the CPU count
+            chunksize (int): Number of images sent to a worker at once
+            inline_max (int): Largest batch extracted in the calling process
+        """
+        self.workers = workers
+        self.chunksize = chunksize
+        self.inline_max = inline_max
+        self.executor = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _executor(self):
+        with self._lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_extraction_worker)
+            return self.executor
+
+    def map(self, extract, items):
+        """
+        Yield extract(item) for every item, in order.
+        """
+        items = list(items)
+        if len(items) <= self.inline_max:
+            yield from map(extract, items)
+            return
+
+        executor = self._executor()
+        try:
+            yield from executor.map(extract, items, chunksize=self.chunksize)
+        except BrokenProcessPool:
+            # A worker died: the next batch starts a new pool
+            with self._lock:
+                if self.executor is executor:
+                    self.executor = None
+            raise
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        with self._lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def extract_query_descriptors(source, extraction_params=None, workers=None, chunksize=4, pool=None):
+    """
+    Yield (name, descriptors or None, error or None) for every query image, in input order.
+
+    Args:
+        source: Query images, see iter_query_images
+        extraction_params (dict, optional): Keyword arguments for calculate_descriptors
+        workers (int, optional): Worker processes, defaults to the CPU count; 1 extracts in-process
+        chunksize (int): Number of images sent to a worker at once
+        pool (ExtractionPool, optional): Long-lived pool to extract on, `workers` and `chunksize`
+            being then the pool's; otherwise a pool is started for this call only
+    """
+    extract = partial(_extract, extraction_params=extraction_params or {})
+    items = iter_query_images(source)
+    if workers == 1:
+        yield from map(extract, items)
+        return
+
+    if pool is not None:
+        yield from pool.map(extract, items)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_extraction_worker) as executor:
+        yield from executor.map(extract, items, chunksize=chunksize)
+
+
+def batch_search(engine, source, top_k=10, weights=None, extraction_params=None,
+                 workers=None, query_block=16, pool=None):
+    """
+    Rank the dataset against every query image of a batch.
+
+    Args:
+        engine (RankingEngine): Engine over the indexed images
+        source: Query images, see iter_query_images
+        top_k (int): Number of results per query
+        weights (dict, optional): Descriptor weights, DEFAULT_WEIGHTS by default
+        extraction_params (dict, optional): Extraction settings of the index
+        workers (int, optional): Extraction worker processes
+        query_block (int): Number of queries ranked together
+        pool (ExtractionPool, optional): Long-lived extraction pool, see extract_query_descriptors
+
+    Yields:
+        dict: {"query": name, "similar_images": [{"image_id", "image_path", "similarity_score"}]}
+            or {"query": name, "error": message}, in input order
+    """
+    def rank(block):
+        distances = engine.batch_distances([descriptors for _, descriptors in block], weights)
+        for (name, _), query_distances in zip(block, distances):
+            yield {
+                "query": name,
+                "similar_images": [
+                    {"image_id": int(idx), "image_path": engine.paths[idx],
+                     "similarity_score": float(query_distances[idx])}
+                    for idx in top_k_indices(query_distances, top_k)
+                ]
+            }
+
+    block = []
+    for name, descriptors, error in extract_query_descriptors(source, extraction_params, workers, pool=pool):
+        if error is not None:
+            # Earlier queries are flushed first so results keep the input order
+            if block:
+                yield from rank(block)
+                block = []
+            yield {"query": name, "error": error}
+            continue
+        block.append((name, descriptors))
+        if len(block) == query_block:
+            yield from rank(block)
+            block = []
+    if block:
+        yield from rank(block)
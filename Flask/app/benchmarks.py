@@ -0,0 +1,1000 @@
+"""
+Benchmarks for descriptor extraction and search.
+
+Usage:
+    python benchmarks.py dominant-colors --dataset ../../Dataset/RSSCN7-master --images 50
+    python benchmarks.py resolution --dataset ../../Dataset/RSSCN7-master --per-class 20
+    python benchmarks.py pipeline --dataset ../../Dataset/RSSCN7-master --images 50
+    python benchmarks.py gabor --dataset ../../Dataset/RSSCN7-master --per-class 10 --scales 4 8 16 --orientations 6
+    python benchmarks.py ranking --sizes 10000 100000 1000000
+    python benchmarks.py ivf --descriptors-file image_descriptors.json --n-probe 1 2 4 8 16
+    python benchmarks.py ivf --synthetic 100000 --n-probe 1 2 4 8 16 32
+    python benchmarks.py pq --descriptors-file image_descriptors.json --subvectors 16 32 64
+    python benchmarks.py batch --size 100000 --queries 64 --query-block 16
+    python benchmarks.py sharded --size 1000000 --shards 1 2 4 8
+    python benchmarks.py precision --descriptors-file image_descriptors.json --k 10
+    python benchmarks.py cascade --descriptors-file image_descriptors.json --dims 16 32 --shortlists 50 100 200
+    python benchmarks.py propagation --sizes 1000 5000 20000 100000
+    python benchmarks.py feedback-rounds --size 20000 --rounds 8 --per-round 4
+    python benchmarks.py local-propagation --sizes 5000 20000 100000 --candidates 200 500
+    python benchmarks.py plugins --dataset ../../Dataset/RSSCN7-master --images 20 --descriptors color texture
+"""
+import argparse
+import os
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+from Descriptors_calcul import (
+    DESCRIPTOR_PLUGINS, DOMINANT_COLOR_MODES, DescriptorPipeline, calculate_descriptors, calculate_dominant_colors,
+    register_descriptor
+)
+from Global_distance_calcul import DEFAULT_WEIGHTS, calculate_global_distance, indexed_weights
+from cascade import ProjectionPrefilter, ShortlistAudit
+from descriptor_store import PRECISIONS, iter_image_paths, normalize_matrix, open_descriptors
+from ivf_index import IVFIndex
+from feedback_session import FeedbackSession
+from label_propagation import LabelPropagator, local_relevance
+from pq_index import PQIndex
+from ranking import RankingEngine, top_k_indices
+from sharded_search import ShardedSearch
+
+DATASET_PATH = '../../Dataset/RSSCN7-master'
+
+# Sub-descriptor sizes of the default color/texture/shape pipeline
+DESCRIPTOR_LAYOUT = [
+    ('color', 'histogram', 768), ('color', 'dominant_colors', 12),
+    ('texture', 'gabor_filters', 4), ('texture', 'glcm_features', 12),
+    ('shape', 'hu_moments', 7), ('shape', 'shape_descriptors', 3)
+]
+DESCRIPTOR_ORDER = {(descriptor_type, sub_descriptor): position
+                    for position, (descriptor_type, sub_descriptor, _) in enumerate(DESCRIPTOR_LAYOUT)}
+
+# Largest ranking change accepted per storage precision against float64:
+# (minimum mean top-k overlap, minimum share of queries with the exact same top-k order)
+PRECISION_TOLERANCES = {'float64': (1.0, 1.0), 'float32': (0.999, 0.99), 'float16': (0.99, 0.9)}
+# Largest error accepted on the distance of an image to itself and to its near-duplicate,
+# against calculate_global_distance: float16 rounds the stored rows, not the query
+NEAR_DUPLICATE_TOLERANCES = {'float64': 1e-9, 'float32': 1e-4, 'float16': 2e-2}
+
+
+def sample_image_paths(dataset_path, count, seed=0):
+    """
+    Pick `count` image paths spread over the whole dataset.
+    """
+    paths = sorted(iter_image_paths(dataset_path))
+    if len(paths) <= count:
+        return paths
+    rng = np.random.default_rng(seed)
+    return sorted(rng.choice(paths, count, replace=False))
+
+
+def sample_per_class(dataset_path, per_class, seed=0):
+    """
+    Pick up to `per_class` images from every class directory.
+
+    Returns:
+        list: (image_path, class_name) pairs
+    """
+    by_class = defaultdict(list)
+    for path in sorted(iter_image_paths(dataset_path)):
+        by_class[os.path.basename(os.path.dirname(path))].append(path)
+    rng = np.random.default_rng(seed)
+    samples = []
+    for class_name, paths in sorted(by_class.items()):
+        chosen = paths if len(paths) <= per_class else rng.choice(paths, per_class, replace=False)
+        samples.extend((str(path), class_name) for path in sorted(chosen))
+    return samples
+
+
+def precision_at_k(descriptors, classes, k):
+    """
+    Leave-one-out retrieval precision@k, an image being relevant when it shares the query's class.
+    """
+    count = len(descriptors)
+    distances = np.zeros((count, count))
+    for i in range(count):
+        for j in range(i + 1, count):
+            distances[i, j] = distances[j, i] = calculate_global_distance(descriptors[i], descriptors[j])
+    np.fill_diagonal(distances, np.inf)
+
+    classes = np.array(classes)
+    precisions = []
+    for i in range(count):
+        nearest = np.argsort(distances[i])[:k]
+        precisions.append(np.mean(classes[nearest] == classes[i]))
+    return float(np.mean(precisions))
+
+
+def _sorted_by_share(dominant_colors, k=3):
+    """
+    Order clusters by decreasing share so outputs of different runs can be compared.
+    """
+    centers = dominant_colors[:3 * k].reshape(k, 3)
+    shares = dominant_colors[3 * k:]
+    order = np.argsort(-shares)
+    return centers[order], shares[order]
+
+
+def synthetic_matrices(count, seed=0, dtype=np.float32):
+    """
+    Random descriptor matrices with the layout of the default pipeline.
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        (descriptor_type, sub_descriptor): rng.random((count, dim), dtype=dtype)
+        for descriptor_type, sub_descriptor, dim in DESCRIPTOR_LAYOUT
+    }
+
+
+def clustered_matrices(count, clusters=50, noise=0.05, seed=0, dtype=np.float32, return_labels=False):
+    """
+    Synthetic descriptor matrices drawn around `clusters` random centers, so
+    that approximate indexes see structure like real collections have.
+
+    With `return_labels`, the cluster of every row is returned too.
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, clusters, count)
+    matrices = {}
+    for descriptor_type, sub_descriptor, dim in DESCRIPTOR_LAYOUT:
+        centers = rng.random((clusters, dim), dtype=dtype)
+        matrix = centers[labels]
+        matrix += noise * rng.standard_normal((count, dim), dtype=dtype)
+        matrices[(descriptor_type, sub_descriptor)] = np.abs(matrix, out=matrix)
+    if return_labels:
+        return matrices, labels
+    return matrices
+
+
+def load_matrices(descriptors_file):
+    """
+    Paths and {(descriptor_type, sub_descriptor): N x d} matrices of an existing index.
+    """
+    descriptors = open_descriptors(descriptors_file)
+    paths = list(descriptors.keys())
+    first = descriptors[paths[0]]
+    matrices = {
+        (descriptor_type, sub_descriptor): np.array([descriptors[path][descriptor_type][sub_descriptor] for path in paths])
+        for descriptor_type, descriptor_data in first.items()
+        for sub_descriptor in descriptor_data
+    }
+    return paths, matrices
+
+
+def row_descriptors(matrices, row):
+    """
+    Descriptors dictionary of one row of descriptor matrices.
+    """
+    descriptors = {}
+    for (descriptor_type, sub_descriptor), matrix in matrices.items():
+        descriptors.setdefault(descriptor_type, {})[sub_descriptor] = np.asarray(matrix[row], dtype=float)
+    return descriptors
+
+
+def benchmark_dominant_colors(dataset_path, image_count, seed=0):
+    """
+    Compare the time and output of every dominant-color mode against exact K-means.
+
+    Deviation is measured after ordering clusters by share: the mean absolute
+    difference of the color centers (0-255 units) and of the shares.
+    """
+    paths = sample_image_paths(dataset_path, image_count, seed)
+    images = [image for image in (cv2.imread(path) for path in paths) if image is not None]
+    print(f"Benchmarking dominant colors on {len(images)} images")
+
+    results = {}
+    for mode in DOMINANT_COLOR_MODES:
+        outputs = []
+        start = time.perf_counter()
+        for image in images:
+            outputs.append(calculate_dominant_colors(image, mode=mode, seed=seed))
+        results[mode] = ((time.perf_counter() - start) / len(images), outputs)
+
+    reference_time, reference_outputs = results['kmeans']
+    print(f"{'mode':<10} {'ms/image':>10} {'speedup':>8} {'center dev':>11} {'share dev':>10}")
+    for mode, (mean_time, outputs) in results.items():
+        center_dev, share_dev = [], []
+        for output, reference in zip(outputs, reference_outputs):
+            centers, shares = _sorted_by_share(output)
+            ref_centers, ref_shares = _sorted_by_share(reference)
+            center_dev.append(np.mean(np.abs(centers - ref_centers)))
+            share_dev.append(np.mean(np.abs(shares - ref_shares)))
+        print(f"{mode:<10} {mean_time * 1000:>10.2f} {reference_time / mean_time:>7.1f}x "
+              f"{np.mean(center_dev):>11.2f} {np.mean(share_dev):>10.4f}")
+    return results
+
+
+def benchmark_resolution(dataset_path, per_class, scales=(1.0, 0.5, 0.25), k=10,
+                         dominant_colors_mode='kmeans', seed=0):
+    """
+    Compare extraction time and retrieval precision@k at several working resolutions.
+    """
+    samples = sample_per_class(dataset_path, per_class, seed)
+    print(f"Benchmarking {len(scales)} resolutions on {len(samples)} images, precision@{k}")
+    print(f"{'scale':>6} {'ms/image':>10} {'precision':>10}")
+
+    results = {}
+    for scale in scales:
+        descriptors, classes = [], []
+        start = time.perf_counter()
+        for path, class_name in samples:
+            try:
+                descriptors.append(calculate_descriptors(
+                    path, scale=scale, dominant_colors_mode=dominant_colors_mode
+                ))
+                classes.append(class_name)
+            except Exception as e:
+                print(f"Error processing {path}: {e}")
+        mean_time = (time.perf_counter() - start) / len(samples)
+        precision = precision_at_k(descriptors, classes, k)
+        results[scale] = (mean_time, precision)
+        print(f"{scale:>6} {mean_time * 1000:>10.1f} {precision:>10.3f}")
+    return results
+
+
+def benchmark_pipeline(dataset_path, image_count, scale=1.0, dominant_colors_mode='kmeans',
+                       descriptors=('color', 'texture', 'shape'), seed=0):
+    """
+    Report where extraction time goes, per pipeline stage.
+    """
+    pipeline = DescriptorPipeline(scale, dominant_colors_mode, tuple(descriptors))
+    for path in sample_image_paths(dataset_path, image_count, seed):
+        try:
+            pipeline.compute(path)
+        except Exception as e:
+            print(f"Error processing {path}: {e}")
+
+    report = pipeline.timing_report()
+    total = sum(stage["total_s"] for stage in report["stages"].values())
+    print(f"Pipeline timings over {report['images']} images")
+    print(f"{'stage':<12} {'ms/image':>10} {'share':>7}")
+    for name, stage in report["stages"].items():
+        print(f"{name:<12} {stage['mean_ms']:>10.2f} {stage['total_s'] / total:>7.1%}")
+    return report
+
+
+def benchmark_gabor(dataset_path, per_class, scales=(4.0, 8.0, 16.0), orientations=6, k=10, seed=0):
+    """
+    Extraction time and precision@k of the legacy Gabor features against GaborFilterBank settings.
+
+    The bank is timed filtering directly, through the DFT, and with the
+    automatic choice. Banks and DFT kernel spectra are built by one untimed
+    image first, as they are once per process in an index build or a server.
+    """
+    samples = sample_per_class(dataset_path, per_class, seed)
+    bank = {"scales": list(scales), "orientations": orientations}
+    configs = [
+        ("legacy", None),
+        ("filter2D", {**bank, "use_dft": False}),
+        ("dft", {**bank, "use_dft": True}),
+        ("auto", {**bank, "use_dft": None})
+    ]
+    print(f"Gabor features on {len(samples)} images, {len(scales)} scales x {orientations} orientations, "
+          f"precision@{k}")
+    print(f"{'gabor':<9} {'values':>7} {'texture ms':>11} {'total ms':>9} {'precision':>10}")
+
+    results = {}
+    for name, gabor in configs:
+        DescriptorPipeline(gabor=gabor).compute(samples[0][0])
+        pipeline = DescriptorPipeline(gabor=gabor)
+        descriptors, classes = [], []
+        for path, class_name in samples:
+            try:
+                descriptors.append(pipeline.compute(path))
+                classes.append(class_name)
+            except Exception as e:
+                print(f"Error processing {path}: {e}")
+        stages = pipeline.timing_report()["stages"]
+        texture_ms = stages["texture"]["mean_ms"]
+        total_ms = sum(stage["mean_ms"] for stage in stages.values())
+        values = len(descriptors[0]["texture"]["gabor_filters"])
+        precision = precision_at_k(descriptors, classes, k)
+        results[name] = (values, texture_ms, total_ms, precision)
+        print(f"{name:<9} {values:>7} {texture_ms:>11.1f} {total_ms:>9.1f} {precision:>10.3f}")
+    return results
+
+
+def benchmark_ranking(sizes, loop_rows=2000, block_size=16384, seed=0):
+    """
+    Time the vectorized RankingEngine against the per-pair calculate_global_distance loop.
+
+    The loop is timed on `loop_rows` rows and extrapolated to the full size;
+    the largest score difference between both is reported on those rows. Row
+    normalization is a one-off index-load (or build) cost, reported apart from
+    the per-query time.
+    """
+    print(f"{'rows':>9} {'loop s (est.)':>14} {'normalize s':>12} {'query s':>8} {'speedup':>8} {'max |diff|':>11}")
+    results = {}
+    for size in sizes:
+        matrices = synthetic_matrices(size, seed)
+        rows = min(size, loop_rows)
+        loop_descriptors = [row_descriptors(matrices, row) for row in range(rows)]
+        query = row_descriptors(synthetic_matrices(1, seed + 1), 0)
+
+        # Normalize in place so the largest sizes fit in memory
+        start = time.perf_counter()
+        normalized = {
+            key: normalize_matrix(matrix, block_size, out=matrix) for key, matrix in matrices.items()
+        }
+        normalize_time = time.perf_counter() - start
+        engine = RankingEngine([str(row) for row in range(size)], normalized, block_size)
+
+        start = time.perf_counter()
+        scores = engine.distances(query)
+        query_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loop_scores = [calculate_global_distance(query, descriptors) for descriptors in loop_descriptors]
+        loop_time = (time.perf_counter() - start) * size / rows
+
+        max_diff = float(np.max(np.abs(scores[:rows] - loop_scores)))
+        results[size] = (loop_time, normalize_time, query_time, max_diff)
+        print(f"{size:>9} {loop_time:>14.2f} {normalize_time:>12.3f} {query_time:>8.3f} "
+              f"{loop_time / query_time:>7.0f}x {max_diff:>11.1e}")
+        del matrices, normalized, engine
+    return results
+
+
+def benchmark_ivf(matrices, n_probes=(1, 2, 4, 8, 16), n_lists=None, queries=100, k=10, seed=0):
+    """
+    Recall@k and latency of IVF search against the exact scan, over dataset rows used as queries.
+
+    Recall is the share of the exact top-k (full weighted distance) the IVF
+    candidates still contain; candidates are scored with the same distance.
+    """
+    count = len(next(iter(matrices.values())))
+    paths = [str(row) for row in range(count)]
+    features = np.hstack([matrix for _, matrix in sorted(matrices.items(), key=lambda item: DESCRIPTOR_ORDER[item[0]])])
+
+    start = time.perf_counter()
+    index = IVFIndex.build(features, paths, n_lists, seed)
+    build_time = time.perf_counter() - start
+    engine = RankingEngine.from_matrices(paths, matrices)
+    print(f"IVF over {count} images: {index.n_lists} lists built in {build_time:.1f} s, "
+          f"{min(queries, count)} queries, recall@{k}")
+
+    query_rows = np.random.default_rng(seed).choice(count, min(queries, count), replace=False)
+    exact_time, exact_top = 0.0, []
+    for row in query_rows:
+        start = time.perf_counter()
+        exact_top.append(set(top_k_indices(engine.distances(row_descriptors(matrices, row)), k)))
+        exact_time += time.perf_counter() - start
+
+    print(f"{'n_probe':>8} {'scanned':>8} {'recall':>7} {'ms/query':>9} {'speedup':>8}")
+    print(f"{'exact':>8} {1:>8.1%} {1:>7.3f} {exact_time / len(query_rows) * 1000:>9.1f} {1:>7.1f}x")
+    results = {}
+    for n_probe in n_probes:
+        recalls, scanned, elapsed = [], [], 0.0
+        for row, expected in zip(query_rows, exact_top):
+            query = row_descriptors(matrices, row)
+            start = time.perf_counter()
+            candidates = index.candidates(features[row], n_probe)
+            distances = engine.distances(query, rows=candidates)
+            found = candidates[top_k_indices(distances, k)]
+            elapsed += time.perf_counter() - start
+            recalls.append(len(expected.intersection(found)) / len(expected))
+            scanned.append(len(candidates) / count)
+        results[n_probe] = (float(np.mean(recalls)), elapsed / len(query_rows))
+        print(f"{n_probe:>8} {np.mean(scanned):>8.1%} {np.mean(recalls):>7.3f} "
+              f"{elapsed / len(query_rows) * 1000:>9.1f} {exact_time / elapsed:>7.1f}x")
+    return results
+
+
+def benchmark_pq(matrices, subvectors=(16, 32, 64), shortlists=(50, 100, 200, 500), queries=100, k=10, seed=0):
+    """
+    Memory per image and recall@k of PQ shortlisting with exact re-scoring, against the exact scan.
+    """
+    count = len(next(iter(matrices.values())))
+    paths = [str(row) for row in range(count)]
+    engine = RankingEngine.from_matrices(paths, matrices)
+    float32_bytes = 4 * sum(matrix.shape[1] for matrix in matrices.values())
+    print(f"PQ over {count} images, {min(queries, count)} queries, recall@{k}; "
+          f"full precision: {float32_bytes} bytes/image as float32")
+
+    query_rows = np.random.default_rng(seed).choice(count, min(queries, count), replace=False)
+    exact_time, exact_top = 0.0, []
+    for row in query_rows:
+        start = time.perf_counter()
+        exact_top.append(set(top_k_indices(engine.distances(row_descriptors(matrices, row)), k)))
+        exact_time += time.perf_counter() - start
+    print(f"exact scan: {exact_time / len(query_rows) * 1000:.1f} ms/query")
+
+    print(f"{'bytes/img':>9} {'compress':>9} {'build s':>8} {'shortlist':>9} {'recall':>7} {'ms/query':>9}")
+    results = {}
+    for n_subvectors in subvectors:
+        start = time.perf_counter()
+        index = PQIndex.build(engine.normalized, paths, n_subvectors, seed=seed)
+        build_time = time.perf_counter() - start
+        for shortlist_size in shortlists:
+            recalls, elapsed = [], 0.0
+            for row, expected in zip(query_rows, exact_top):
+                query = row_descriptors(matrices, row)
+                start = time.perf_counter()
+                shortlist = index.shortlist(query, shortlist_size)
+                found = shortlist[top_k_indices(engine.distances(query, rows=shortlist), k)]
+                elapsed += time.perf_counter() - start
+                recalls.append(len(expected.intersection(found)) / len(expected))
+            results[(n_subvectors, shortlist_size)] = (float(np.mean(recalls)), elapsed / len(query_rows))
+            print(f"{index.bytes_per_image:>9} {float32_bytes / index.bytes_per_image:>8.0f}x {build_time:>8.1f} "
+                  f"{shortlist_size:>9} {np.mean(recalls):>7.3f} {elapsed / len(query_rows) * 1000:>9.1f}")
+    return results
+
+
+def benchmark_cascade(matrices, dims=(16, 32, 64), shortlists=(50, 100, 200, 500), queries=100, k=10, seed=0):
+    """
+    Miss rate and latency of the two-stage cascade (projection prefilter, exact re-rank) against the exact scan.
+
+    A query misses when its shortlist lacks at least one image of the exact
+    top-k; recall is the share of exact top-k images the shortlist kept.
+    """
+    count = len(next(iter(matrices.values())))
+    paths = [str(row) for row in range(count)]
+    engine = RankingEngine.from_matrices(paths, matrices)
+    print(f"Cascade over {count} images, {min(queries, count)} queries, top-{k}")
+
+    query_rows = np.random.default_rng(seed).choice(count, min(queries, count), replace=False)
+    query_descriptors = [row_descriptors(matrices, row) for row in query_rows]
+    exact_time, exact_top = 0.0, []
+    for query in query_descriptors:
+        start = time.perf_counter()
+        exact_top.append(top_k_indices(engine.distances(query), k))
+        exact_time += time.perf_counter() - start
+    print(f"exact scan: {exact_time / len(query_rows) * 1000:.1f} ms/query")
+
+    print(f"{'dims':>5} {'build s':>8} {'shortlist':>9} {'miss rate':>10} {'recall':>7} {'ms/query':>9} {'speedup':>8}")
+    results = {}
+    for dim_count in dims:
+        start = time.perf_counter()
+        prefilter = ProjectionPrefilter.build(engine.normalized, paths, dim_count, seed=seed)
+        build_time = time.perf_counter() - start
+        for shortlist_size in shortlists:
+            audit, elapsed = ShortlistAudit(every=1), 0.0
+            for query, expected in zip(query_descriptors, exact_top):
+                start = time.perf_counter()
+                shortlist = prefilter.shortlist(query, shortlist_size)
+                top_k_indices(engine.distances(query, rows=shortlist), k)
+                elapsed += time.perf_counter() - start
+                audit.due()
+                audit.record(shortlist, expected)
+            stats = audit.stats()
+            results[(dim_count, shortlist_size)] = (stats["miss_rate"], stats["recall"], elapsed / len(query_rows))
+            print(f"{prefilter.dims:>5} {build_time:>8.2f} {shortlist_size:>9} {stats['miss_rate']:>10.1%} "
+                  f"{stats['recall']:>7.3f} {elapsed / len(query_rows) * 1000:>9.1f} {exact_time / elapsed:>7.1f}x")
+    return results
+
+
+def benchmark_propagation(sizes, k=10, feedback=5, rounds=5, dense_limit=5000, seed=0):
+    """
+    Feedback-round latency of sparse kNN-graph propagation against dense RBF LabelSpreading.
+
+    Collections are synthetic and clustered; `feedback` images of one cluster
+    are marked relevant and `feedback` of others non-relevant. Precision is the
+    share of the 50 images ranked most relevant that belong to the relevant
+    cluster. LabelSpreading is only run up to `dense_limit` images, its N x N
+    affinity matrix alone needs N^2 x 8 bytes.
+    """
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.semi_supervised import LabelSpreading
+
+    print(f"{'images':>8} {'graph s':>8} {'round ms':>9} {'iters':>6} {'precision':>10} "
+          f"{'dense s':>8} {'dense MB':>9} {'precision':>10}")
+    results = {}
+    for size in sizes:
+        matrices, clusters = clustered_matrices(size, seed=seed, return_labels=True)
+        features = StandardScaler().fit_transform(np.hstack(
+            [matrix for _, matrix in sorted(matrices.items(), key=lambda item: DESCRIPTOR_ORDER[item[0]])]
+        )).astype(np.float32)
+        del matrices
+
+        rng = np.random.default_rng(seed)
+        target = clusters[0]
+        relevant = rng.choice(np.flatnonzero(clusters == target), feedback, replace=False)
+        non_relevant = rng.choice(np.flatnonzero(clusters != target), feedback, replace=False)
+        labels = np.zeros(size)
+        labels[relevant], labels[non_relevant] = 1, -1
+
+        def precision(relevance):
+            return float(np.mean(clusters[top_k_indices(-relevance, 50)] == target))
+
+        start = time.perf_counter()
+        propagator = LabelPropagator.build(features, [str(row) for row in range(size)], k)
+        graph_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(rounds):
+            distributions, stats = propagator.propagate(labels)
+        round_time = (time.perf_counter() - start) / rounds
+        relevance = propagator.relevance(distributions)
+        sparse_precision = precision(relevance)
+
+        dense_time, dense_precision = None, None
+        if size <= dense_limit:
+            # LabelSpreading's encoding: -1 unlabelled, classes 0 (non-relevant) and 1 (relevant)
+            dense_labels = np.full(size, -1)
+            dense_labels[relevant], dense_labels[non_relevant] = 1, 0
+            start = time.perf_counter()
+            model = LabelSpreading(kernel='rbf', alpha=0.8).fit(features, dense_labels)
+            dense_relevance = model.predict_proba(features)[:, 1]
+            dense_time = time.perf_counter() - start
+            dense_precision = precision(dense_relevance)
+
+        results[size] = (graph_time, round_time, stats["iterations"], sparse_precision,
+                         dense_time, dense_precision)
+        dense_columns = (f"{dense_time:>8.2f} {size * size * 8 / 2 ** 20:>9.0f} {dense_precision:>10.2f}"
+                         if dense_time is not None else f"{'-':>8} {size * size * 8 / 2 ** 20:>9.0f} {'-':>10}")
+        print(f"{size:>8} {graph_time:>8.2f} {round_time * 1000:>9.2f} {stats['iterations']:>6} "
+              f"{sparse_precision:>10.2f} {dense_columns}")
+    return results
+
+
+def benchmark_feedback_rounds(size, rounds=8, per_round=4, k=10, seed=0):
+    """
+    Per-round cost of warm-started propagation in a multi-round session against restarting from scratch.
+
+    Every round labels `per_round` new images, half relevant. The warm start
+    only pushes the label change; the restart propagates every label again.
+    Error is the largest P(relevant) difference to a fully converged solution.
+    """
+    from sklearn.preprocessing import StandardScaler
+
+    matrices = clustered_matrices(size, seed=seed)
+    features = StandardScaler().fit_transform(np.hstack(
+        [matrix for _, matrix in sorted(matrices.items(), key=lambda item: DESCRIPTOR_ORDER[item[0]])]
+    )).astype(np.float32)
+    del matrices
+    propagator = LabelPropagator.build(features, [str(row) for row in range(size)], k)
+    session = FeedbackSession(size, {})
+    rng = np.random.default_rng(seed)
+
+    print(f"{rounds} feedback rounds over {size} images, {per_round} new labels per round")
+    print(f"{'round':>6} {'labelled':>9} {'warm it':>8} {'touched':>8} {'sweeps':>7} {'warm ms':>8} {'bound':>8} "
+          f"{'error':>8} {'cold it':>8} {'touched':>8} {'cold ms':>8}")
+    results = []
+    for _ in range(rounds):
+        images = rng.choice(size, per_round, replace=False)
+        session.labels[images[:per_round // 2]] = 1
+        session.labels[images[per_round // 2:]] = -1
+        report = session.propagate(propagator)
+
+        start = time.perf_counter()
+        _, cold = propagator.propagate(session.labels)
+        cold_time = time.perf_counter() - start
+        converged, _ = propagator.propagate(session.labels, max_iter=1000, tol=1e-12, max_error=1e-9,
+                                            max_sweeps=1000)
+        error = np.abs(session.relevance(propagator) - propagator.relevance(converged)).max()
+
+        results.append((report, cold, cold_time, error))
+        print(f"{report['round']:>6} {report['labelled']:>9} {report['iterations']:>8} {report['touched']:>8} "
+              f"{report['sweeps']:>7} {report['ms']:>8.1f} {report['error_bound']:>8.1e} {error:>8.1e} "
+              f"{cold['iterations']:>8} {cold['touched']:>8} {cold_time * 1000:>8.1f}")
+    return results
+
+
+def benchmark_local_propagation(sizes, candidates=(200, 500), feedback=5, k=10, queries=5, seed=0):
+    """
+    Feedback-round latency and precision of query-local propagation against the collection-wide graph.
+
+    For every query, `feedback` images of its cluster are marked relevant and
+    `feedback` of others non-relevant. The global round propagates over the
+    whole kNN graph (built beforehand, its build time is reported apart); a
+    local round builds and propagates over the subgraph of the top-M
+    first-pass candidates and the labelled images. The first-pass ranking is
+    shared by both and timed apart. Precision is the share of the final top 50
+    that belongs to the query's cluster.
+    """
+    from sklearn.preprocessing import StandardScaler
+
+    header = f"{'images':>8} {'graph s':>8} {'1st ms':>7} {'global ms':>10} {'precision':>10}"
+    for size in candidates:
+        header += f" {f'M={size} ms':>10} {'precision':>10}"
+    print(header)
+    results = {}
+    for size in sizes:
+        matrices, clusters = clustered_matrices(size, seed=seed, return_labels=True)
+        features = StandardScaler().fit_transform(np.hstack(
+            [matrix for _, matrix in sorted(matrices.items(), key=lambda item: DESCRIPTOR_ORDER[item[0]])]
+        )).astype(np.float32)
+        engine = RankingEngine.from_matrices([str(row) for row in range(size)], matrices)
+        start = time.perf_counter()
+        propagator = LabelPropagator.build(features, engine.paths, k)
+        graph_time = time.perf_counter() - start
+
+        rng = np.random.default_rng(seed)
+        timings = defaultdict(float)
+        precisions = defaultdict(float)
+        for query in rng.choice(size, queries, replace=False):
+            target = clusters[query]
+            labels = np.zeros(size)
+            labels[rng.choice(np.flatnonzero(clusters == target), feedback, replace=False)] = 1
+            labels[rng.choice(np.flatnonzero(clusters != target), feedback, replace=False)] = -1
+
+            start = time.perf_counter()
+            distances = engine.distances(row_descriptors(matrices, query))
+            timings['first'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            distributions, _ = propagator.propagate(labels)
+            scores = 0.7 * distances + 0.3 * (1 - propagator.relevance(distributions))
+            timings['global'] += time.perf_counter() - start
+            precisions['global'] += np.mean(clusters[top_k_indices(scores, 50)] == target)
+
+            for candidate_count in candidates:
+                start = time.perf_counter()
+                rows = np.union1d(top_k_indices(distances, candidate_count), np.flatnonzero(labels))
+                relevance, _ = local_relevance(features, rows, labels, k)
+                scores = np.full(size, np.inf)
+                scores[rows] = 0.7 * distances[rows] + 0.3 * (1 - relevance)
+                timings[candidate_count] += time.perf_counter() - start
+                precisions[candidate_count] += np.mean(clusters[top_k_indices(scores, 50)] == target)
+
+        results[size] = ({key: value / queries for key, value in timings.items()},
+                         {key: value / queries for key, value in precisions.items()})
+        timings, precisions = results[size]
+        line = (f"{size:>8} {graph_time:>8.2f} {timings['first'] * 1000:>7.1f} "
+                f"{timings['global'] * 1000:>10.1f} {precisions['global']:>10.2f}")
+        for candidate_count in candidates:
+            line += f" {timings[candidate_count] * 1000:>10.1f} {precisions[candidate_count]:>10.2f}"
+        print(line)
+    return results
+
+
+def check_descriptor_plugins(dataset_path, image_count=20, descriptors=('color', 'texture'), seed=0):
+    """
+    Build an index with a non-default descriptor set plus a plugin, and check both search paths rank with it.
+
+    An 'intensity' plugin (gray mean and standard deviation) is registered and
+    indexed next to `descriptors`; the index is built with build_index into a
+    temporary directory. The ranking engine must weight exactly the indexed
+    descriptors, and every sampled image must come back first when searched
+    with SemiSupervisedImageSearch, before and after a feedback round.
+
+    Raises:
+        AssertionError: If the index cannot be searched as built
+    """
+    import tempfile
+    from build_index import build_index
+    from semi_supervised_search import SemiSupervisedImageSearch
+
+    if 'intensity' not in DESCRIPTOR_PLUGINS:
+        @register_descriptor('intensity', weight=0.1)
+        def _intensity_descriptor(context):
+            return {"mean_std": np.array([context.gray.mean(), context.gray.std()])}
+
+    indexed = list(descriptors) + ['intensity']
+    with tempfile.TemporaryDirectory() as directory:
+        image_dir = os.path.join(directory, 'images')
+        os.makedirs(image_dir)
+        for number, path in enumerate(sample_image_paths(dataset_path, image_count, seed)):
+            os.symlink(os.path.abspath(path), os.path.join(image_dir, f"{number:04d}{os.path.splitext(path)[1]}"))
+        descriptors_file = os.path.join(directory, 'index.json')
+        # The deterministic dominant-color mode, so a query's descriptors equal its stored ones
+        build_index(image_dir, descriptors_file, os.path.join(directory, 'failures.json'), workers=1,
+                    extraction_params={"dominant_colors_mode": 'histogram', "descriptors": indexed})
+
+        engine = RankingEngine.from_descriptors(open_descriptors(descriptors_file))
+        ranked = indexed_weights(DEFAULT_WEIGHTS, engine.normalized)
+        assert sorted(ranked) == sorted(indexed), f"Ranked descriptors {sorted(ranked)}, indexed {sorted(indexed)}"
+        print(f"Ranking weights: {ranked}")
+
+        search = SemiSupervisedImageSearch(image_dir, descriptors_file)
+        for row, path in enumerate(search.image_paths):
+            results = search.find_similar_images(path, top_k=3)
+            assert results and results[0] == path, f"{path} ranked {results}"
+            if row == 0:
+                feedback = {"relevant": [results[1]], "non_relevant": [results[2]]}
+                results = search.find_similar_images(path, top_k=3, feedback=feedback)
+                assert results and results[0] == path, f"{path} ranked {results} after feedback"
+        print(f"Indexed {indexed} over {len(search.image_paths)} images: every image is its own best match")
+
+
+def benchmark_batch(size, queries=64, query_blocks=(1, 8, 16, 32), seed=0):
+    """
+    Ranking time per query when queries are ranked together in Q x N distance blocks.
+    """
+    matrices = synthetic_matrices(size, seed)
+    engine = RankingEngine.from_matrices([str(row) for row in range(size)], matrices)
+    query_matrices = synthetic_matrices(queries, seed + 1)
+    batch = [row_descriptors(query_matrices, row) for row in range(queries)]
+
+    start = time.perf_counter()
+    single = np.array([engine.distances(query) for query in batch])
+    single_time = time.perf_counter() - start
+    print(f"{queries} queries over {size} images")
+    print(f"{'block':>6} {'ms/query':>9} {'speedup':>8} {'max |diff|':>11}")
+    print(f"{'single':>6} {single_time / queries * 1000:>9.1f} {1:>7.1f}x {0:>11.1e}")
+
+    results = {}
+    for query_block in query_blocks:
+        start = time.perf_counter()
+        distances = np.vstack([
+            engine.batch_distances(batch[first:first + query_block])
+            for first in range(0, queries, query_block)
+        ])
+        elapsed = time.perf_counter() - start
+        results[query_block] = elapsed / queries
+        print(f"{query_block:>6} {elapsed / queries * 1000:>9.1f} {single_time / elapsed:>7.1f}x "
+              f"{np.max(np.abs(distances - single)):>11.1e}")
+    return results
+
+
+def benchmark_sharded(size, shards=(1, 2, 4), queries=10, k=10, seed=0):
+    """
+    Query latency of sharded multi-process search against the in-process scan.
+    """
+    matrices = synthetic_matrices(size, seed)
+    engine = RankingEngine.from_matrices([str(row) for row in range(size)], matrices)
+    del matrices
+    query_matrices = synthetic_matrices(queries, seed + 1)
+    batch = [row_descriptors(query_matrices, row) for row in range(queries)]
+
+    start = time.perf_counter()
+    expected = [top_k_indices(engine.distances(query), k) for query in batch]
+    single_time = (time.perf_counter() - start) / queries
+    print(f"{queries} queries over {size} images on {os.cpu_count()} CPUs")
+    print(f"{'shards':>7} {'ms/query':>9} {'speedup':>8} {'same top-k':>11}")
+    print(f"{'none':>7} {single_time * 1000:>9.1f} {1:>7.1f}x {'-':>11}")
+
+    results = {}
+    for shard_count in shards:
+        sharded = ShardedSearch(engine, shard_count)
+        sharded.top_k(batch[0], k)  # Workers attach the shared blocks on their first task
+        start = time.perf_counter()
+        found = [sharded.top_k(query, k)[0] for query in batch]
+        elapsed = (time.perf_counter() - start) / queries
+        sharded.close()
+        same = all(np.array_equal(rows, reference) for rows, reference in zip(found, expected))
+        results[shard_count] = elapsed
+        print(f"{shard_count:>7} {elapsed * 1000:>9.1f} {single_time / elapsed:>7.1f}x {str(same):>11}")
+    return results
+
+
+def benchmark_precision(matrices, precisions=PRECISIONS, queries=200, k=10, seed=0):
+    """
+    Ranking drift, memory and latency of every storage precision against float64.
+
+    Dataset rows are used as queries, and a near-duplicate of every query
+    (its descriptors up to a relative 1e-6, like a re-encoded copy) is added
+    to the collection. A precision passes when the mean overlap of its top-k
+    among the original rows with the float64 top-k and the share of queries
+    whose top-k comes out in exactly the same order stay within
+    PRECISION_TOLERANCES, and the distances of the queries to themselves and
+    to their near-duplicates, in both the single and the batch path, stay
+    within NEAR_DUPLICATE_TOLERANCES of calculate_global_distance: a
+    Euclidean term taken from |a|^2 + |b|^2 - 2 a.b loses them to
+    cancellation. The largest score difference is reported too.
+    """
+    rng = np.random.default_rng(seed)
+    count = len(next(iter(matrices.values())))
+    query_rows = rng.choice(count, min(queries, count), replace=False)
+    matrices = {
+        key: np.vstack([matrix, matrix[query_rows] * (1 + 1e-6 * rng.standard_normal(matrix[query_rows].shape))])
+        for key, matrix in matrices.items()
+    }
+    duplicates = count + np.arange(len(query_rows))
+    paths = [str(row) for row in range(count + len(query_rows))]
+    query_descriptors = [row_descriptors(matrices, row) for row in query_rows]
+    weights = indexed_weights(DEFAULT_WEIGHTS, matrices)
+    near_distances = np.array([
+        [calculate_global_distance(query, row_descriptors(matrices, row), weights) for row in (row, duplicate)]
+        for query, row, duplicate in zip(query_descriptors, query_rows, duplicates)
+    ])
+
+    reference = RankingEngine.from_matrices(paths, matrices, precision='float64')
+    reference_scores = [reference.distances(query) for query in query_descriptors]
+    # Rankings are compared over the original rows, float16 cannot always order a query and its copy
+    reference_top = [top_k_indices(scores[:count], k) for scores in reference_scores]
+
+    print(f"Precision over {count} images and {len(query_rows)} near-duplicates, {len(query_rows)} queries, "
+          f"top-{k}")
+    print(f"{'precision':<10} {'bytes/image':>12} {'query ms':>9} {'overlap':>8} {'same order':>11} "
+          f"{'max |diff|':>11} {'near-dup':>9} {'result':>7}")
+    results = {}
+    for precision in precisions:
+        engine = RankingEngine.from_matrices(paths, matrices, precision=precision)
+        bytes_per_image = sum(matrix.itemsize * matrix.shape[1] for matrix, _ in engine.normalized.values())
+
+        overlaps, same_order, max_diff, near_scores, elapsed = [], 0, 0.0, [], 0.0
+        for row, duplicate, query, scores, top in zip(query_rows, duplicates, query_descriptors,
+                                                      reference_scores, reference_top):
+            start = time.perf_counter()
+            precision_scores = engine.distances(query)
+            elapsed += time.perf_counter() - start
+            precision_top = top_k_indices(precision_scores[:count], k)
+            overlaps.append(len(set(top) & set(precision_top)) / len(top))
+            same_order += np.array_equal(top, precision_top)
+            max_diff = max(max_diff, float(np.max(np.abs(precision_scores - scores))))
+            near_scores.append(precision_scores[[row, duplicate]])
+        batch = np.arange(min(32, len(query_rows)))
+        batch_scores = engine.batch_distances([query_descriptors[i] for i in batch])
+        batch_near_scores = np.column_stack([batch_scores[batch, query_rows[batch]],
+                                             batch_scores[batch, duplicates[batch]]])
+        near_error = float(max(np.max(np.abs(np.array(near_scores) - near_distances)),
+                               np.max(np.abs(batch_near_scores - near_distances[batch]))))
+
+        min_overlap, min_same_order = PRECISION_TOLERANCES[precision]
+        passed = (np.mean(overlaps) >= min_overlap and same_order / len(query_rows) >= min_same_order
+                  and near_error <= NEAR_DUPLICATE_TOLERANCES[precision])
+        results[precision] = (bytes_per_image, float(np.mean(overlaps)), same_order / len(query_rows),
+                              max_diff, near_error, passed)
+        print(f"{precision:<10} {bytes_per_image:>12} {elapsed / len(query_rows) * 1000:>9.2f} "
+              f"{np.mean(overlaps):>8.4f} {same_order / len(query_rows):>11.1%} {max_diff:>11.1e} "
+              f"{near_error:>9.1e} {'PASS' if passed else 'FAIL':>7}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Descriptor extraction and search benchmarks.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    dominant = subparsers.add_parser('dominant-colors', help="Fast dominant-color modes vs exact K-means")
+    dominant.add_argument('--dataset', default=DATASET_PATH)
+    dominant.add_argument('--images', type=int, default=50)
+    dominant.add_argument('--seed', type=int, default=0)
+
+    resolution = subparsers.add_parser('resolution', help="Extraction time and precision per working resolution")
+    resolution.add_argument('--dataset', default=DATASET_PATH)
+    resolution.add_argument('--per-class', type=int, default=20)
+    resolution.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.25])
+    resolution.add_argument('--k', type=int, default=10)
+    resolution.add_argument('--dominant-colors-mode', choices=DOMINANT_COLOR_MODES, default='kmeans')
+    resolution.add_argument('--seed', type=int, default=0)
+
+    pipeline = subparsers.add_parser('pipeline', help="Per-stage extraction time")
+    pipeline.add_argument('--dataset', default=DATASET_PATH)
+    pipeline.add_argument('--images', type=int, default=50)
+    pipeline.add_argument('--scale', type=float, default=1.0)
+    pipeline.add_argument('--dominant-colors-mode', choices=DOMINANT_COLOR_MODES, default='kmeans')
+    pipeline.add_argument('--descriptors', nargs='+', default=['color', 'texture', 'shape'])
+    pipeline.add_argument('--seed', type=int, default=0)
+
+    gabor = subparsers.add_parser('gabor', help="Legacy Gabor features vs the float32 filter bank")
+    gabor.add_argument('--dataset', default=DATASET_PATH)
+    gabor.add_argument('--per-class', type=int, default=10)
+    gabor.add_argument('--scales', type=float, nargs='+', default=[4.0, 8.0, 16.0])
+    gabor.add_argument('--orientations', type=int, default=6)
+    gabor.add_argument('--k', type=int, default=10)
+    gabor.add_argument('--seed', type=int, default=0)
+
+    ranking = subparsers.add_parser('ranking', help="Vectorized ranking vs the per-pair loop")
+    ranking.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    ranking.add_argument('--loop-rows', type=int, default=2000, help="Rows timed with the per-pair loop")
+    ranking.add_argument('--block-size', type=int, default=16384)
+    ranking.add_argument('--seed', type=int, default=0)
+
+    ivf = subparsers.add_parser('ivf', help="IVF recall@k and latency vs exact search")
+    source = ivf.add_mutually_exclusive_group()
+    source.add_argument('--descriptors-file', default=None, help="Existing index to search")
+    source.add_argument('--synthetic', type=int, default=20000, help="Size of a synthetic clustered collection")
+    ivf.add_argument('--n-probe', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    ivf.add_argument('--n-lists', type=int, default=None)
+    ivf.add_argument('--queries', type=int, default=100)
+    ivf.add_argument('--k', type=int, default=10)
+    ivf.add_argument('--seed', type=int, default=0)
+
+    pq = subparsers.add_parser('pq', help="PQ memory per image and recall@k vs exact search")
+    source = pq.add_mutually_exclusive_group()
+    source.add_argument('--descriptors-file', default=None, help="Existing index to search")
+    source.add_argument('--synthetic', type=int, default=20000, help="Size of a synthetic clustered collection")
+    pq.add_argument('--subvectors', type=int, nargs='+', default=[16, 32, 64], help="Bytes per image")
+    pq.add_argument('--shortlists', type=int, nargs='+', default=[50, 100, 200, 500])
+    pq.add_argument('--queries', type=int, default=100)
+    pq.add_argument('--k', type=int, default=10)
+    pq.add_argument('--seed', type=int, default=0)
+
+    batch = subparsers.add_parser('batch', help="Blocked Q x N ranking vs one query at a time")
+    batch.add_argument('--size', type=int, default=100000)
+    batch.add_argument('--queries', type=int, default=64)
+    batch.add_argument('--query-block', type=int, nargs='+', default=[1, 8, 16, 32])
+    batch.add_argument('--seed', type=int, default=0)
+
+    sharded = subparsers.add_parser('sharded', help="Sharded multi-process search vs in-process scan")
+    sharded.add_argument('--size', type=int, default=200000)
+    sharded.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    sharded.add_argument('--queries', type=int, default=10)
+    sharded.add_argument('--k', type=int, default=10)
+    sharded.add_argument('--seed', type=int, default=0)
+
+    precision = subparsers.add_parser('precision', help="Ranking drift of float32/float16 storage vs float64")
+    source = precision.add_mutually_exclusive_group()
+    source.add_argument('--descriptors-file', default=None, help="Existing index to search")
+    source.add_argument('--synthetic', type=int, default=20000, help="Size of a synthetic clustered collection")
+    precision.add_argument('--precisions', choices=PRECISIONS, nargs='+', default=list(PRECISIONS))
+    precision.add_argument('--queries', type=int, default=200)
+    precision.add_argument('--k', type=int, default=10)
+    precision.add_argument('--seed', type=int, default=0)
+
+    cascade = subparsers.add_parser('cascade', help="Cascade prefilter miss rate and latency vs exact search")
+    source = cascade.add_mutually_exclusive_group()
+    source.add_argument('--descriptors-file', default=None, help="Existing index to search")
+    source.add_argument('--synthetic', type=int, default=20000, help="Size of a synthetic clustered collection")
+    cascade.add_argument('--dims', type=int, nargs='+', default=[16, 32, 64], help="Projection dimensions")
+    cascade.add_argument('--shortlists', type=int, nargs='+', default=[50, 100, 200, 500])
+    cascade.add_argument('--queries', type=int, default=100)
+    cascade.add_argument('--k', type=int, default=10)
+    cascade.add_argument('--seed', type=int, default=0)
+
+    propagation = subparsers.add_parser('propagation', help="Sparse kNN-graph propagation vs dense LabelSpreading")
+    propagation.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    propagation.add_argument('--k', type=int, default=10, help="Graph neighbours per image")
+    propagation.add_argument('--feedback', type=int, default=5, help="Relevant and non-relevant images marked")
+    propagation.add_argument('--rounds', type=int, default=5)
+    propagation.add_argument('--dense-limit', type=int, default=5000, help="Largest size run with LabelSpreading")
+    propagation.add_argument('--seed', type=int, default=0)
+
+    feedback_rounds = subparsers.add_parser('feedback-rounds', help="Warm-started vs restarted propagation per round")
+    feedback_rounds.add_argument('--size', type=int, default=20000)
+    feedback_rounds.add_argument('--rounds', type=int, default=8)
+    feedback_rounds.add_argument('--per-round', type=int, default=4, help="New labels per round")
+    feedback_rounds.add_argument('--k', type=int, default=10, help="Graph neighbours per image")
+    feedback_rounds.add_argument('--seed', type=int, default=0)
+
+    local = subparsers.add_parser('local-propagation', help="Query-local subgraph propagation vs the whole graph")
+    local.add_argument('--sizes', type=int, nargs='+', default=[5000, 20000])
+    local.add_argument('--candidates', type=int, nargs='+', default=[200, 500], help="First-pass candidates M")
+    local.add_argument('--feedback', type=int, default=5, help="Relevant and non-relevant images marked")
+    local.add_argument('--k', type=int, default=10, help="Graph neighbours per image")
+    local.add_argument('--queries', type=int, default=5)
+    local.add_argument('--seed', type=int, default=0)
+
+    plugins = subparsers.add_parser('plugins', help="Check an index with a non-default descriptor set can be searched")
+    plugins.add_argument('--dataset', default=DATASET_PATH)
+    plugins.add_argument('--images', type=int, default=20)
+    plugins.add_argument('--descriptors', nargs='+', default=['color', 'texture'],
+                         help="Descriptors indexed next to the test plugin")
+    plugins.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.benchmark == 'dominant-colors':
+        benchmark_dominant_colors(args.dataset, args.images, args.seed)
+    elif args.benchmark == 'resolution':
+        benchmark_resolution(args.dataset, args.per_class, args.scales, args.k,
+                             args.dominant_colors_mode, args.seed)
+    elif args.benchmark == 'pipeline':
+        benchmark_pipeline(args.dataset, args.images, args.scale, args.dominant_colors_mode,
+                           args.descriptors, args.seed)
+    elif args.benchmark == 'gabor':
+        benchmark_gabor(args.dataset, args.per_class, args.scales, args.orientations, args.k, args.seed)
+    elif args.benchmark == 'ranking':
+        benchmark_ranking(args.sizes, args.loop_rows, args.block_size, args.seed)
+    elif args.benchmark == 'ivf':
+        if args.descriptors_file:
+            _, matrices = load_matrices(args.descriptors_file)
+        else:
+            matrices = clustered_matrices(args.synthetic, seed=args.seed)
+        benchmark_ivf(matrices, args.n_probe, args.n_lists, args.queries, args.k, args.seed)
+    elif args.benchmark == 'sharded':
+        benchmark_sharded(args.size, args.shards, args.queries, args.k, args.seed)
+    elif args.benchmark == 'batch':
+        benchmark_batch(args.size, args.queries, args.query_block, args.seed)
+    elif args.benchmark == 'pq':
+        if args.descriptors_file:
+            _, matrices = load_matrices(args.descriptors_file)
+        else:
+            matrices = clustered_matrices(args.synthetic, seed=args.seed)
+        benchmark_pq(matrices, args.subvectors, args.shortlists, args.queries, args.k, args.seed)
+    elif args.benchmark == 'precision':
+        if args.descriptors_file:
+            _, matrices = load_matrices(args.descriptors_file)
+        else:
+            matrices = clustered_matrices(args.synthetic, seed=args.seed)
+        benchmark_precision(matrices, args.precisions, args.queries, args.k, args.seed)
+    elif args.benchmark == 'cascade':
+        if args.descriptors_file:
+            _, matrices = load_matrices(args.descriptors_file)
+        else:
+            matrices = clustered_matrices(args.synthetic, seed=args.seed)
+        benchmark_cascade(matrices, args.dims, args.shortlists, args.queries, args.k, args.seed)
+    elif args.benchmark == 'propagation':
+        benchmark_propagation(args.sizes, args.k, args.feedback, args.rounds, args.dense_limit, args.seed)
+    elif args.benchmark == 'feedback-rounds':
+        benchmark_feedback_rounds(args.size, args.rounds, args.per_round, args.k, args.seed)
+    elif args.benchmark == 'plugins':
+        check_descriptor_plugins(args.dataset, args.images, args.descriptors, args.seed)
+    elif args.benchmark == 'local-propagation':
+        benchmark_local_propagation(args.sizes, args.candidates, args.feedback, args.k, args.queries, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Build the image descriptor index in parallel.
+
+Usage:
+    python build_index.py ../../Dataset/RSSCN7-master --workers 8 --chunksize 4
+    python build_index.py ../../Dataset/RSSCN7-master --scale 0.5 --dominant-colors-mode sample
+    python build_index.py ../../Dataset/RSSCN7-master --gabor-scales 4 8 16 --gabor-orientations 6
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from Descriptors_calcul import DOMINANT_COLOR_MODES, calculate_descriptors, init_extraction_worker
+from descriptor_store import (
+    DEFAULT_PRECISION, PRECISIONS, DescriptorJournal, check_extraction_params, compact_journal, convert_json_to_binary,
+    iter_image_paths, load_descriptor_file, serialize_descriptors, write_json_atomic
+)
+
+# --gabor-dft values, as the use_dft setting of the filter bank
+GABOR_DFT_CHOICES = {'auto': None, 'on': True, 'off': False}
+
+
+def _extract(path, extraction_params):
+    """
+    Worker task: compute the descriptors of one image without raising.
+
+    Returns:
+        tuple: (path, serialized descriptors or None, error message or None)
+    """
+    try:
+        return path, serialize_descriptors(calculate_descriptors(path, **extraction_params)), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def build_index(dataset_path, descriptors_file='image_descriptors.json',
+                failures_file='index_failures.json', workers=None, chunksize=4,
+                sync_every=50, progress_every=20, extraction_params=None, precision=DEFAULT_PRECISION):
+    """
+    Compute descriptors for every image of a dataset over a process pool.
+
+    Images already present in the descriptors file or its journal are skipped,
+    and images that fail are recorded in a separate file instead of aborting the
+    run. New descriptors go to the journal, which is compacted into the
+    descriptors file once the run completes; the binary store served by the
+    search classes is then rebuilt from it.
+
+    Args:
+        dataset_path (str): Path to the directory containing images
+        descriptors_file (str): JSON file storing the descriptors
+        failures_file (str): JSON file receiving {path: error} for the images that failed
+            in this run, empty when none did
+        workers (int, optional): Number of worker processes, defaults to the CPU count
+        chunksize (int): Number of images sent to a worker at once
+        sync_every (int): fsync the journal after this many new images
+        progress_every (int): Print progress after this many processed images
+        extraction_params (dict, optional): Extraction settings (scale, dominant_colors_mode, descriptors, gabor);
+            they must match the ones an existing index was built with
+        precision (str): dtype of the normalized ranking blocks of the binary store
+
+    Returns:
+        dict: Summary with the number of processed, skipped and failed images
+    """
+    extraction_params = check_extraction_params(descriptors_file, extraction_params)
+    indexed = load_descriptor_file(descriptors_file).keys()
+
+    all_paths = list(iter_image_paths(dataset_path))
+    pending = [path for path in all_paths if path not in indexed]
+    skipped = len(all_paths) - len(pending)
+    print(f"Found {len(all_paths)} images, {skipped} already indexed, {len(pending)} to process")
+
+    failures = {}
+    processed = 0
+    start = time.perf_counter()
+
+    with DescriptorJournal(descriptors_file, sync_every=sync_every) as journal, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_extraction_worker) as executor:
+        extract = partial(_extract, extraction_params=extraction_params)
+        for path, descriptors, error in executor.map(extract, pending, chunksize=chunksize):
+            processed += 1
+            if error is None:
+                journal.append(path, descriptors)
+            else:
+                failures[path] = error
+                print(f"Error processing {path}: {error}")
+
+            if processed % progress_every == 0 or processed == len(pending):
+                elapsed = time.perf_counter() - start
+                print(f"[{processed}/{len(pending)}] {processed / elapsed:.2f} images/s, "
+                      f"{len(failures)} failed")
+
+    compact_journal(descriptors_file)
+    convert_json_to_binary(descriptors_file, precision=precision)
+    # Written even when empty, so a clean rerun does not leave the failures of an earlier one
+    write_json_atomic(failures_file, failures)
+    if failures:
+        print(f"Recorded {len(failures)} failures in {failures_file}")
+
+    return {"processed": processed, "skipped": skipped, "failed": len(failures)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute image descriptors in parallel.")
+    parser.add_argument('dataset_path', help="Directory containing the images to index")
+    parser.add_argument('--descriptors-file', default='image_descriptors.json')
+    parser.add_argument('--failures-file', default='index_failures.json')
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--chunksize', type=int, default=4, help="Images sent to a worker at once")
+    parser.add_argument('--sync-every', type=int, default=50, help="fsync the journal after this many images")
+    parser.add_argument('--scale', type=float, default=1.0, help="Working resolution, e.g. 0.5 or 0.25")
+    parser.add_argument('--dominant-colors-mode', choices=DOMINANT_COLOR_MODES, default='kmeans')
+    parser.add_argument('--descriptors', nargs='+', default=['color', 'texture', 'shape'],
+                        help="Registered descriptor plugins to compute")
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION,
+                        help="dtype of the normalized ranking blocks in the binary store")
+    parser.add_argument('--gabor-scales', type=float, nargs='+', default=None,
+                        help="Sigmas of a float32 Gabor filter bank (mean and variance per filter); "
+                             "without it, the legacy 8-bit Gabor features")
+    parser.add_argument('--gabor-orientations', type=int, default=4, help="Orientations of the Gabor filter bank")
+    parser.add_argument('--gabor-dft', choices=GABOR_DFT_CHOICES, default='auto',
+                        help="Filter through the DFT: always, never, or for kernels of 31x31 and up")
+    args = parser.parse_args()
+
+    summary = build_index(
+        args.dataset_path,
+        descriptors_file=args.descriptors_file,
+        failures_file=args.failures_file,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        sync_every=args.sync_every,
+        extraction_params={
+            "scale": args.scale,
+            "dominant_colors_mode": args.dominant_colors_mode,
+            "descriptors": args.descriptors,
+            "gabor": None if args.gabor_scales is None else {
+                "scales": args.gabor_scales,
+                "orientations": args.gabor_orientations,
+                "use_dft": GABOR_DFT_CHOICES[args.gabor_dft]
+            }
+        },
+        precision=args.precision
+    )
+    print(f"Done: {summary}")
+
+
+if __name__ == '__main__':
+    main()
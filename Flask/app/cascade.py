@@ -0,0 +1,222 @@
+"""
+Two-stage cascade search.
+
+The first stage ranks every image by a cheap signal: the weighted, min-max
+normalized descriptor vector (the one PQ encodes, see pq_index) projected on
+its `dims` leading principal components. Squared distances in that space
+follow the weighted global distance closely enough to pick a shortlist, and
+cost one N x dims matrix-vector product. The second stage re-scores only the
+shortlist with the full weighted distance of RankingEngine.
+
+ShortlistAudit measures what the first stage loses: on a sample of queries
+the exact scan is run as well, and every exact top-k image missing from the
+shortlist is counted, so the shortlist size can be tuned.
+
+The projection is persisted next to the descriptor store (<base>.cascade.npz)
+and images indexed later are projected with the existing components.
+"""
+import os
+import threading
+
+import numpy as np
+
+from Global_distance_calcul import normalize_rows
+from pq_index import PQIndex, sub_descriptor_scales
+
+
+def cascade_path(descriptors_file):
+    """
+    Return the path of the cascade prefilter built for a descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.cascade.npz"
+
+
+class ProjectionPrefilter:
+    """
+    Low-dimensional projection of every indexed image, used to shortlist candidates for exact re-scoring.
+    """
+    def __init__(self, components, mean, projections, paths, keys, scales):
+        """
+        Args:
+            components (numpy.ndarray): dims x D principal axes of the weighted vectors
+            mean (numpy.ndarray): Mean weighted vector, subtracted before projecting
+            projections (numpy.ndarray): N x dims projected images, rows ordered like `paths`
+            paths (list): Image path of every row
+            keys (list): (descriptor_type, sub_descriptor) blocks of the weighted vector, in order
+            scales (list): Scale of every block
+        """
+        self.components = components
+        self.mean = mean
+        self.projections = projections
+        self.paths = list(paths)
+        self.keys = [tuple(key) for key in keys]
+        self.scales = list(scales)
+        self._squared_norms = None
+
+    @property
+    def dims(self):
+        return self.components.shape[0]
+
+    def project(self, vectors):
+        return ((np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T).astype(np.float32)
+
+    def query_vector(self, query_descriptors):
+        """
+        Weighted vector of a query.
+        """
+        return np.concatenate([
+            scale * normalize_rows(np.reshape(query_descriptors[descriptor_type][sub_descriptor], (1, -1)))[0]
+            for (descriptor_type, sub_descriptor), scale in zip(self.keys, self.scales)
+        ])
+
+    @classmethod
+    def build(cls, normalized, paths, dims=32, weights=None, seed=0, sample_size=100000, block_size=16384):
+        """
+        Fit the principal axes on (a sample of) the normalized blocks of a RankingEngine and project every row.
+        """
+        keys = sorted(normalized)
+        scales = sub_descriptor_scales(keys, weights)
+        count = len(paths)
+        sample = np.sort(np.random.default_rng(seed).choice(count, min(count, sample_size), replace=False))
+        vectors = np.hstack([scale * np.asarray(normalized[key][0][sample], dtype=np.float64)
+                             for key, scale in zip(keys, scales)])
+        mean = vectors.mean(axis=0)
+        # Leading eigenvectors of the D x D covariance, D being small next to N
+        eigenvalues, eigenvectors = np.linalg.eigh(np.cov(vectors - mean, rowvar=False))
+        order = np.argsort(eigenvalues)[::-1][:min(dims, vectors.shape[1])]
+        components = eigenvectors[:, order].T.astype(np.float32)
+
+        prefilter = cls(components, mean.astype(np.float32),
+                        np.empty((0, len(components)), dtype=np.float32), [], keys, scales)
+        prefilter.add(normalized, paths, block_size=block_size)
+        return prefilter
+
+    def add(self, normalized, paths, start=0, block_size=16384):
+        """
+        Project rows `start` onwards of the normalized blocks with the existing axes.
+        """
+        projections = [self.projections]
+        for block_start in range(start, len(paths), block_size):
+            projections.append(self.project(
+                PQIndex.vectors(normalized, self.keys, self.scales, block_start, block_start + block_size)
+            ))
+        self.projections = np.concatenate(projections)
+        self.paths.extend(paths[start:])
+        self._squared_norms = None
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            keys = [tuple(key) for key in data["keys"].tolist()]
+            return cls(data["components"], data["mean"], data["projections"], data["paths"].tolist(),
+                       keys, data["scales"].tolist())
+
+    def save(self, path):
+        """
+        Persist the prefilter atomically.
+        """
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, components=self.components, mean=self.mean, projections=self.projections,
+                 paths=np.array(self.paths), keys=np.array(self.keys), scales=np.array(self.scales))
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def shortlist(self, query_descriptors, size):
+        """
+        Rows of the `size` images nearest to the query in the projected space, sorted by row.
+        """
+        if self._squared_norms is None:
+            self._squared_norms = np.einsum('ij,ij->i', self.projections, self.projections)
+        query = self.project(self.query_vector(query_descriptors)[None])[0]
+        # |p - q|^2 up to the query's own constant |q|^2
+        distances = self._squared_norms - 2 * (self.projections @ query)
+        if size >= len(distances):
+            return np.arange(len(distances))
+        return np.sort(np.argpartition(distances, size - 1)[:size])
+
+
+def load_or_build_prefilter(prefilter_path, normalized, paths, dims=32):
+    """
+    Open the persisted cascade prefilter of a collection, projecting new images or rebuilding it as needed.
+
+    Args:
+        prefilter_path (str): Path of the persisted prefilter
+        normalized (dict): Normalized blocks of a RankingEngine over the collection
+        paths (list): Image path of every row
+        dims (int): Dimensions of the projection when (re)building
+
+    Returns:
+        ProjectionPrefilter: Prefilter covering every image
+    """
+    if os.path.exists(prefilter_path):
+        try:
+            prefilter = ProjectionPrefilter.load(prefilter_path)
+            known = len(prefilter)
+            if known <= len(paths) and prefilter.paths == list(paths[:known]) and set(prefilter.keys) <= set(normalized):
+                if known < len(paths):
+                    print(f"Projecting {len(paths) - known} new images into the cascade prefilter")
+                    prefilter.add(normalized, list(paths), start=known)
+                    prefilter.save(prefilter_path)
+                return prefilter
+            print("Cascade prefilter out of date, rebuilding...")
+        except Exception as e:
+            print(f"Could not load cascade prefilter {prefilter_path}: {e}")
+
+    print(f"Building cascade prefilter over {len(paths)} images...")
+    prefilter = ProjectionPrefilter.build(normalized, list(paths), dims)
+    prefilter.save(prefilter_path)
+    print(f"Cascade prefilter built, {prefilter.dims} dimensions per image")
+    return prefilter
+
+
+class ShortlistAudit:
+    """
+    Counts how often a shortlist misses images of the exact top-k.
+    """
+    def __init__(self, every=50):
+        """
+        Args:
+            every (int): Audit one shortlisted query out of `every`; 0 disables auditing
+        """
+        self.every = every
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.audited = 0
+        self.missed_queries = 0
+        self.missed_results = 0
+        self.expected_results = 0
+
+    def due(self):
+        """
+        Count a shortlisted query and tell whether it should be audited.
+        """
+        with self._lock:
+            self.queries += 1
+            return bool(self.every) and (self.queries - 1) % self.every == 0
+
+    def record(self, shortlist, exact_top):
+        """
+        Record the exact top-k of an audited query against its shortlist.
+        """
+        missed = len(np.setdiff1d(exact_top, shortlist))
+        with self._lock:
+            self.audited += 1
+            self.missed_queries += int(missed > 0)
+            self.missed_results += missed
+            self.expected_results += len(exact_top)
+        return missed
+
+    def stats(self):
+        """
+        Return the audit counters: share of audited queries with a miss, and recall of the exact top-k.
+        """
+        with self._lock:
+            return {
+                "queries": self.queries,
+                "audited": self.audited,
+                "missed_queries": self.missed_queries,
+                "miss_rate": self.missed_queries / self.audited if self.audited else 0.0,
+                "recall": 1 - self.missed_results / self.expected_results if self.expected_results else 1.0
+            }
@@ -0,0 +1,612 @@
+"""
+On-disk storage of precomputed image descriptors.
+
+The main store is a JSON file mapping image paths to descriptors. New
+descriptors are appended to a journal next to it (one JSON record per line)
+and merged into the main file by compaction, so indexing never rewrites the
+whole store per image and a crash loses at most the unsynced tail of the
+journal.
+
+For serving, the JSON file is converted into a binary store: a directory
+holding one contiguous float32 matrix per sub-descriptor, a path manifest and
+a small header describing the layout. The search classes open it through
+np.memmap, so loading it neither parses JSON nor copies the descriptors.
+Every matrix is stored a second time with its rows already min-max normalized,
+together with their squared norms, so ranking only has to normalize the query.
+The header records the size and modification time of the JSON file and the
+size of the journal it was converted from; open_descriptors converts a store
+again when they changed, so journaled images are never silently left out.
+
+The precision setting picks the dtype of those normalized blocks, which are
+what ranking reads: float32 by default, float16 to halve them again, float64
+for reference. Raw descriptors overflow or underflow float16 (shape
+descriptors reach 1e5, Hu moments go down to 1e-15), so below float64 the raw
+matrices always stay float32. Ranking arithmetic on float16 blocks runs in
+float32, and row norms and final scores are accumulated in float64.
+
+Both formats record the extraction settings (working resolution, dominant
+color mode) the index was built with, so query descriptors are computed the
+same way as the dataset ones.
+"""
+import json
+import os
+import shutil
+from collections.abc import Mapping
+
+import numpy as np
+
+from Descriptors_calcul import normalize_extraction_params
+from Global_distance_calcul import normalize_rows
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+PRECISIONS = ('float64', 'float32', 'float16')
+DEFAULT_PRECISION = 'float32'
+
+
+def raw_dtype(precision):
+    """
+    Dtype of the raw descriptor matrices stored at a precision.
+    """
+    return np.float64 if precision == 'float64' else np.float32
+
+
+def compute_dtype(dtype):
+    """
+    Dtype ranking arithmetic runs in on blocks stored as `dtype`: float16 is widened to float32.
+    """
+    return np.result_type(dtype, np.float32)
+
+
+def iter_image_paths(dataset_path):
+    """
+    Yield the path of every image below the dataset directory.
+
+    Args:
+        dataset_path (str): Path to the directory containing images
+
+    Yields:
+        str: Image path, as used to key the descriptors
+    """
+    for root, _, files in os.walk(dataset_path):
+        for filename in files:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, filename)
+
+
+def serialize_descriptors(descriptors):
+    """
+    Convert descriptors to a JSON-serializable format.
+    """
+    return {
+        descriptor_type: {
+            k: v.tolist() if hasattr(v, 'tolist') else v
+            for k, v in descriptor_data.items()
+        }
+        for descriptor_type, descriptor_data in descriptors.items()
+    }
+
+
+def to_numpy(image_descriptors, dtype=np.float32):
+    """
+    Convert the nested descriptor lists of every image back to numpy arrays.
+    """
+    return {
+        path: {
+            descriptor_type: {
+                sub_k: np.array(sub_v, dtype=dtype)
+                for sub_k, sub_v in descriptor_data.items()
+            }
+            for descriptor_type, descriptor_data in descriptors.items()
+        }
+        for path, descriptors in image_descriptors.items()
+    }
+
+
+def journal_path(descriptors_file):
+    """
+    Return the path of the journal belonging to a descriptors file.
+    """
+    return f"{descriptors_file}.journal"
+
+
+class DescriptorJournal:
+    """
+    Append-only journal of image descriptors, one JSON record per line.
+
+    Records are flushed and fsync'd every `sync_every` appends and when the
+    journal is closed.
+    """
+    def __init__(self, descriptors_file, sync_every=50):
+        self.path = journal_path(descriptors_file)
+        self.sync_every = sync_every
+        self._file = None
+        self._unsynced = 0
+
+    def append(self, image_path, descriptors):
+        """
+        Append the serialized descriptors of one image.
+        """
+        if self._file is None:
+            terminate = False
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as file:
+                    file.seek(-1, os.SEEK_END)
+                    terminate = file.read(1) != b"\n"
+            self._file = open(self.path, 'a')
+            # Terminate a record left incomplete by a crash so it does not swallow the next one
+            if terminate:
+                self._file.write("\n")
+        self._file.write(json.dumps({"path": image_path, "descriptors": descriptors}) + "\n")
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush pending records to disk.
+        """
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+def read_journal(path):
+    """
+    Yield the (image_path, descriptors) records of a journal.
+
+    A record cut short by a crash can only be the last line; it is skipped.
+    """
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping incomplete journal record in {path}")
+                continue
+            yield record["path"], record["descriptors"]
+
+
+def load_descriptor_file(descriptors_file):
+    """
+    Load serialized descriptors from the main file and replay its journal on top.
+
+    Args:
+        descriptors_file (str): Path to the JSON descriptors file
+
+    Returns:
+        dict: {image_path: descriptors} with descriptors as nested lists
+    """
+    image_descriptors = {}
+    if os.path.exists(descriptors_file):
+        with open(descriptors_file, 'r') as file:
+            image_descriptors = json.load(file)
+
+    journal = journal_path(descriptors_file)
+    if os.path.exists(journal):
+        replayed = 0
+        for image_path, descriptors in read_journal(journal):
+            image_descriptors[image_path] = descriptors
+            replayed += 1
+        print(f"Replayed {replayed} journal records from {journal}")
+
+    return image_descriptors
+
+
+def write_json_atomic(path, data):
+    """
+    Write JSON to a temporary file first so a crash never leaves a truncated file behind.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def compact_journal(descriptors_file):
+    """
+    Merge the journal into the main descriptors file and remove it.
+
+    Args:
+        descriptors_file (str): Path to the JSON descriptors file
+
+    Returns:
+        int: Number of images in the compacted file, or None when there was no journal
+    """
+    journal = journal_path(descriptors_file)
+    if not os.path.exists(journal):
+        return None
+
+    image_descriptors = load_descriptor_file(descriptors_file)
+    write_json_atomic(descriptors_file, image_descriptors)
+    os.remove(journal)
+    print(f"Compacted {journal} into {descriptors_file}")
+    return len(image_descriptors)
+
+
+def extraction_params_path(descriptors_file):
+    """
+    Return the path of the file recording the extraction settings of a JSON descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.extraction.json"
+
+
+def read_extraction_params(descriptors_file):
+    """
+    Return the extraction settings an index was built with.
+
+    Indexes that predate the settings file were built with the defaults.
+
+    Args:
+        descriptors_file (str): Path to the JSON descriptors file
+
+    Returns:
+        dict: Keyword arguments for calculate_descriptors
+    """
+    params = {}
+    header_path = os.path.join(binary_store_path(descriptors_file), 'header.json')
+    if os.path.exists(header_path):
+        with open(header_path, 'r') as file:
+            params = json.load(file).get("extraction", {})
+    elif os.path.exists(extraction_params_path(descriptors_file)):
+        with open(extraction_params_path(descriptors_file), 'r') as file:
+            params = json.load(file)
+    return normalize_extraction_params(params)
+
+
+def check_extraction_params(descriptors_file, extraction_params=None):
+    """
+    Record the extraction settings of a new index, or check they match an existing one.
+
+    Args:
+        descriptors_file (str): Path to the JSON descriptors file
+        extraction_params (dict, optional): Requested settings, missing keys take the defaults
+
+    Returns:
+        dict: The complete extraction settings
+
+    Raises:
+        ValueError: If the existing index was built with different settings
+    """
+    params = normalize_extraction_params(extraction_params)
+    existing_index = any(
+        os.path.exists(path) for path in
+        (descriptors_file, journal_path(descriptors_file), binary_store_path(descriptors_file))
+    )
+    if existing_index:
+        existing = read_extraction_params(descriptors_file)
+        if existing != params:
+            raise ValueError(
+                f"{descriptors_file} was built with extraction settings {existing}, not {params}"
+            )
+    else:
+        write_json_atomic(extraction_params_path(descriptors_file), params)
+    return params
+
+
+STORE_VERSION = 1
+
+
+def normalize_matrix(matrix, block_size=16384, out=None, dtype=None):
+    """
+    Min-max normalize the rows of a (possibly memory-mapped) matrix block by block.
+
+    Args:
+        matrix (numpy.ndarray): N x d matrix
+        block_size (int): Number of rows normalized at once
+        out (numpy.ndarray, optional): Destination, may be `matrix` itself; a new
+            array of `dtype` by default
+        dtype (optional): Dtype of a new destination, the dtype of `matrix` by default
+
+    Returns:
+        tuple: (normalized N x d matrix, float64 squared norm of every normalized row)
+    """
+    if out is None:
+        out = np.empty(matrix.shape, dtype=dtype or matrix.dtype)
+    squared_norms = np.empty(len(matrix))
+    for start in range(0, len(matrix), block_size):
+        stop = start + block_size
+        out[start:stop] = normalize_rows(matrix[start:stop])
+        # Norms of the stored (possibly rounded) values, consistent with the dot products
+        block = np.asarray(out[start:stop], dtype=float)
+        squared_norms[start:stop] = np.einsum('ij,ij->i', block, block)
+    return out, squared_norms
+
+
+def binary_store_path(descriptors_file):
+    """
+    Return the path of the binary store built from a descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.store"
+
+
+class BinaryDescriptorStore(Mapping):
+    """
+    Read-only, memory-mapped descriptor store.
+
+    Behaves like the {image_path: {descriptor_type: {sub_descriptor: array}}}
+    dictionary the search classes used to build from JSON, but every array is a
+    row view into a memory-mapped matrix.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, 'header.json'), 'r') as file:
+            self.header = json.load(file)
+        if self.header.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported descriptor store version {self.header.get('version')} in {store_path}")
+        with open(os.path.join(store_path, 'paths.json'), 'r') as file:
+            self.paths = json.load(file)
+        self.index = {path: row for row, path in enumerate(self.paths)}
+
+        count = self.header["count"]
+        self.layout = [
+            (entry["descriptor"], entry["sub_descriptor"], entry["dim"])
+            for entry in self.header["layout"]
+        ]
+        self._matrices = {}
+        self._normalized = {}
+        for entry in self.header["layout"]:
+            key = (entry["descriptor"], entry["sub_descriptor"])
+            self._matrices[key] = self._open_matrix(entry["file"], self.header["dtype"], (count, entry["dim"]))
+            # Stores written before normalized blocks existed simply lack them
+            if "normalized_file" in entry:
+                self._normalized[key] = (
+                    self._open_matrix(entry["normalized_file"], self.normalized_dtype, (count, entry["dim"])),
+                    self._open_matrix(entry["squared_norms_file"], 'float64', (count,))
+                )
+
+    def _open_matrix(self, filename, dtype, shape):
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.store_path, filename), dtype=dtype, mode='r', shape=shape)
+
+    @property
+    def normalized_dtype(self):
+        """
+        Dtype of the normalized blocks, set by the precision the store was written at.
+        """
+        return self.header.get("normalized_dtype", self.header["dtype"])
+
+    @property
+    def extraction_params(self):
+        """
+        Extraction settings the stored descriptors were computed with.
+        """
+        return normalize_extraction_params(self.header.get("extraction", {}))
+
+    def matrix(self, descriptor_type, sub_descriptor):
+        """
+        Return the N x d matrix of one sub-descriptor, rows ordered like `paths`.
+        """
+        return self._matrices[(descriptor_type, sub_descriptor)]
+
+    def normalized_matrix(self, descriptor_type, sub_descriptor):
+        """
+        Return the row-normalized matrix of one sub-descriptor and its squared row norms.
+
+        Returns:
+            tuple or None: (N x d matrix, N squared norms), None for stores without them
+        """
+        return self._normalized.get((descriptor_type, sub_descriptor))
+
+    def feature_matrix(self, descriptor_types=('color', 'texture', 'shape')):
+        """
+        Concatenate every sub-descriptor of the given types into one N x D array.
+        """
+        return np.hstack([
+            self.matrix(descriptor_type, sub_descriptor)
+            for descriptor_type in descriptor_types
+            for layout_type, sub_descriptor, _ in self.layout
+            if layout_type == descriptor_type
+        ])
+
+    def __getitem__(self, image_path):
+        row = self.index[image_path]
+        descriptors = {}
+        for descriptor_type, sub_descriptor, _ in self.layout:
+            descriptors.setdefault(descriptor_type, {})[sub_descriptor] = \
+                self._matrices[(descriptor_type, sub_descriptor)][row]
+        return descriptors
+
+    def __contains__(self, image_path):
+        return image_path in self.index
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def source_signature(descriptors_file):
+    """
+    Size and modification time of a descriptors file and size of its journal.
+
+    Recorded in the header of the binary store converted from them, so a store
+    that no longer reflects its sources (new journal records, a JSON file
+    compacted or replaced since) is detected.
+    """
+    signature = {"json": None, "journal": None}
+    if os.path.exists(descriptors_file):
+        stat = os.stat(descriptors_file)
+        signature["json"] = [stat.st_size, stat.st_mtime_ns]
+    if os.path.exists(journal_path(descriptors_file)):
+        signature["journal"] = os.path.getsize(journal_path(descriptors_file))
+    return signature
+
+
+def write_binary_store(store_path, image_descriptors, precision=DEFAULT_PRECISION, extraction_params=None,
+                       source=None):
+    """
+    Write descriptors to a binary store, replacing any previous one.
+
+    Args:
+        store_path (str): Directory of the binary store
+        image_descriptors (dict): {image_path: descriptors}, as nested lists or arrays
+        precision (str): One of PRECISIONS, the dtype of the normalized blocks
+        extraction_params (dict, optional): Extraction settings recorded in the header
+        source (dict, optional): source_signature of the files the descriptors were read from
+
+    Returns:
+        int: Number of images written
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    dtype = raw_dtype(precision)
+
+    layout = []
+    if image_descriptors:
+        first = next(iter(image_descriptors.values()))
+        layout = [
+            (descriptor_type, sub_descriptor, len(values))
+            for descriptor_type, descriptor_data in first.items()
+            for sub_descriptor, values in descriptor_data.items()
+        ]
+
+    # Images whose descriptors do not follow the layout cannot share the matrices
+    paths = []
+    for path, descriptors in image_descriptors.items():
+        try:
+            if all(len(descriptors[d][s]) == dim for d, s, dim in layout):
+                paths.append(path)
+                continue
+        except (KeyError, TypeError):
+            pass
+        print(f"Skipping {path}: descriptors do not match the store layout")
+
+    # Per process, several workers may find the same store stale and convert it at once
+    tmp_path = f"{store_path}.tmp.{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    header_layout = []
+    for descriptor_type, sub_descriptor, dim in layout:
+        filename = f"{descriptor_type}.{sub_descriptor}.bin"
+        matrix = np.empty((len(paths), dim), dtype=dtype)
+        for row, path in enumerate(paths):
+            matrix[row] = image_descriptors[path][descriptor_type][sub_descriptor]
+        matrix.tofile(os.path.join(tmp_path, filename))
+        normalized, squared_norms = normalize_matrix(matrix, dtype=precision)
+        normalized.tofile(os.path.join(tmp_path, f"{descriptor_type}.{sub_descriptor}.normalized.bin"))
+        squared_norms.tofile(os.path.join(tmp_path, f"{descriptor_type}.{sub_descriptor}.sqnorms.bin"))
+        header_layout.append({
+            "descriptor": descriptor_type,
+            "sub_descriptor": sub_descriptor,
+            "dim": dim,
+            "file": filename,
+            "normalized_file": f"{descriptor_type}.{sub_descriptor}.normalized.bin",
+            "squared_norms_file": f"{descriptor_type}.{sub_descriptor}.sqnorms.bin"
+        })
+
+    with open(os.path.join(tmp_path, 'paths.json'), 'w') as file:
+        json.dump(paths, file)
+    with open(os.path.join(tmp_path, 'header.json'), 'w') as file:
+        json.dump({
+            "version": STORE_VERSION,
+            "count": len(paths),
+            "dtype": np.dtype(dtype).name,
+            "normalized_dtype": precision,
+            "extraction": normalize_extraction_params(extraction_params),
+            "source": source,
+            "layout": header_layout
+        }, file, indent=2)
+
+    # Swap the new store in, then drop the old one
+    old_path = f"{store_path}.old.{os.getpid()}"
+    if os.path.exists(store_path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(store_path, old_path)
+    os.replace(tmp_path, store_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return len(paths)
+
+
+def convert_json_to_binary(descriptors_file, store_path=None, precision=DEFAULT_PRECISION):
+    """
+    Convert a JSON descriptors file (and its journal) into a binary store.
+
+    Args:
+        descriptors_file (str): Path to the JSON descriptors file
+        store_path (str, optional): Target directory, defaults to binary_store_path(descriptors_file)
+        precision (str): One of PRECISIONS, the dtype of the normalized ranking blocks
+
+    Returns:
+        str: Path of the binary store
+    """
+    store_path = store_path or binary_store_path(descriptors_file)
+    extraction_params = {}
+    if os.path.exists(extraction_params_path(descriptors_file)):
+        with open(extraction_params_path(descriptors_file), 'r') as file:
+            extraction_params = json.load(file)
+    # Taken before reading, so records appended meanwhile make the store stale rather than lost
+    source = source_signature(descriptors_file)
+    count = write_binary_store(
+        store_path, load_descriptor_file(descriptors_file), precision, extraction_params, source
+    )
+    print(f"Wrote {count} images to {store_path}")
+    return store_path
+
+
+def open_descriptors(descriptors_file):
+    """
+    Open the descriptors of a descriptors file, preferring its binary store.
+
+    A store whose recorded source_signature no longer matches the JSON file and
+    its journal (records journaled by an interrupted build, a compaction not
+    followed by a conversion) is converted again at its precision. If that
+    fails, the JSON file and journal are loaded instead.
+
+    Returns:
+        Mapping: BinaryDescriptorStore if an up-to-date one exists, else a dict of numpy arrays
+    """
+    store_path = binary_store_path(descriptors_file)
+    header_path = os.path.join(store_path, 'header.json')
+    if os.path.exists(header_path):
+        # Checked before anything is memory-mapped, so a stale store can be replaced
+        with open(header_path, 'r') as file:
+            header = json.load(file)
+        source = source_signature(descriptors_file)
+        # Without a JSON file or journal the store is the only copy
+        if header.get("source") == source or source == {"json": None, "journal": None}:
+            return BinaryDescriptorStore(store_path)
+        print(f"Descriptor store {store_path} is out of date with {descriptors_file}, converting again...")
+        try:
+            precision = header.get("normalized_dtype", header["dtype"])
+            return BinaryDescriptorStore(convert_json_to_binary(descriptors_file, precision=precision))
+        except Exception as e:
+            print(f"Could not convert {descriptors_file}: {e}, loading it directly")
+    return to_numpy(load_descriptor_file(descriptors_file))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the descriptor store.")
+    parser.add_argument('command', choices=['compact', 'convert'],
+                        help="compact: merge the journal into the JSON file, "
+                             "convert: build the binary store from the JSON file")
+    parser.add_argument('descriptors_file', nargs='?', default='image_descriptors.json')
+    parser.add_argument('--store', default=None, help="Binary store directory (convert only)")
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION,
+                        help="dtype of the normalized ranking blocks (convert only)")
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        compact_journal(args.descriptors_file)
+    else:
+        convert_json_to_binary(args.descriptors_file, args.store, args.precision)
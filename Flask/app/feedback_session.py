@@ -0,0 +1,135 @@
+"""
+Relevance feedback state of one search session.
+
+The indexed collection, its ranking engine and its label propagation graph
+are shared by every session and never modified by feedback. What a session's
+feedback changes lives here: image labels, descriptor weights, the label
+distributions propagated from the labels (kept so the next round only
+propagates what changed), reports of the last rounds and totals over all of
+them, so neither the state nor the responses grow with the session.
+
+to_state() gives the compact form shared between worker processes: the
+labelled rows only, the weights, the round counter, totals and recent
+reports. Distributions are
+not part of it, a worker rebuilds them from whatever it already has by
+propagating the label difference.
+"""
+import copy
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+class FeedbackSession:
+    """
+    Labels, weights and propagated relevance of one user's feedback rounds.
+    """
+    def __init__(self, image_count, weights, session_id=None, max_rounds=20):
+        """
+        Args:
+            image_count (int): Number of indexed images
+            weights (dict): Initial descriptor weights, copied
+            session_id (str, optional): Identifier, a random one by default
+            max_rounds (int): Round reports kept, the oldest dropped first
+        """
+        self.id = session_id or uuid.uuid4().hex
+        self.labels = np.zeros(image_count, dtype=np.int8)  # +1 relevant, -1 non-relevant, 0 no feedback
+        self.weights = copy.deepcopy(weights)
+        self.distributions = None
+        self.propagated_labels = np.zeros(image_count, dtype=np.int8)
+        self.feedback_round = 0
+        self.max_rounds = max_rounds
+        self.rounds = []
+        self.total_ms = 0.0
+        # Held by the request using the session, the shared index needs no lock
+        self.lock = threading.Lock()
+        self.last_access = time.time()
+
+    def to_state(self):
+        """
+        Compact, JSON-serializable state: labelled rows, weights, round totals and recent reports.
+        """
+        return {
+            "id": self.id,
+            "relevant": np.flatnonzero(self.labels > 0).tolist(),
+            "non_relevant": np.flatnonzero(self.labels < 0).tolist(),
+            "weights": self.weights,
+            "feedback_round": self.feedback_round,
+            "total_ms": self.total_ms,
+            "rounds": self.rounds
+        }
+
+    @classmethod
+    def from_state(cls, state, image_count):
+        """
+        Rebuild a session from to_state().
+        """
+        session = cls(image_count, state["weights"], state["id"])
+        session.restore(state)
+        return session
+
+    def restore(self, state):
+        """
+        Take over a newer state of this session saved by another worker.
+
+        The distributions are kept: only the labels changed since they were
+        propagated remain to push, which relevance() does on first use.
+        """
+        self.labels = np.zeros(len(self.labels), dtype=np.int8)
+        self.labels[state["relevant"]] = 1
+        self.labels[state["non_relevant"]] = -1
+        self.weights = state["weights"]
+        self.feedback_round = state["feedback_round"]
+        self.total_ms = state.get("total_ms", sum(report["ms"] for report in state["rounds"]))
+        self.rounds = state["rounds"][-self.max_rounds:]
+
+    def _sync(self, propagator, max_iter, tol):
+        self.distributions, stats = propagator.update(
+            self.distributions, self.propagated_labels, self.labels, max_iter, tol
+        )
+        self.propagated_labels = self.labels.copy()
+        return stats
+
+    def propagate(self, propagator, max_iter=50, tol=1e-7):
+        """
+        Bring the label distributions up to date with the labels, warm-starting from the last round.
+
+        Returns:
+            dict: Report of the round: iterations, images touched, exact sweeps, bound on the
+                P(relevant) error and milliseconds
+        """
+        start = time.perf_counter()
+        return self.record_round(self._sync(propagator, max_iter, tol), start)
+
+    def record_round(self, stats, start):
+        """
+        Count a feedback round whose propagation started at `start` (time.perf_counter()).
+        """
+        self.feedback_round += 1
+        report = {
+            "round": self.feedback_round,
+            "labelled": int(np.count_nonzero(self.labels)),
+            "iterations": stats["iterations"],
+            "touched": stats["touched"],
+            "sweeps": stats["sweeps"],
+            "error_bound": stats["error_bound"],
+            "ms": (time.perf_counter() - start) * 1000
+        }
+        self.total_ms += report["ms"]
+        self.rounds.append(report)
+        del self.rounds[:-self.max_rounds]
+        return report
+
+    def relevance(self, propagator, max_iter=50, tol=1e-7):
+        """
+        P(relevant) of every image, or None before any feedback.
+
+        Labels set by another worker are propagated first.
+        """
+        if not np.array_equal(self.labels, self.propagated_labels):
+            self._sync(propagator, max_iter, tol)
+        if self.distributions is None:
+            return None
+        return propagator.relevance(self.distributions)
@@ -1,34 +1,59 @@
 import os
 import json
 import numpy as np
-from flask import Flask, request, jsonify, send_from_directory,send_file
-from werkzeug.utils import secure_filename
+from flask import Flask, request, jsonify, send_from_directory,send_file, Response
 from flask_cors import CORS  # Add CORS support
 
 # Import descriptor calculation function
-from Descriptors_calcul import calculate_descriptors
+from Descriptors_calcul import calculate_descriptors, get_pipeline
+from descriptor_store import binary_store_path, journal_path, open_descriptors
 
 # Import search implementations
+from batch_search import ExtractionPool
 from Simple_search_debug import ImageSimilaritySearch
 from contineous_SS_RF import SemiSupervisedImageSearch
 from descriptor_visualization import create_descriptor_visualization
+from query_cache import QueryDescriptorCache, ScoreCache
+from session_store import SQLiteSessionBackend
 # Create Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
 # Configuration
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
 DATASET_PATH = '../../Dataset/RSSCN7-master'
 
-# Create upload directory
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['QUERY_CACHE_BYTES'] = 64 * 1024 * 1024  # Memory budget for cached query descriptors
+app.config['SCORE_CACHE_BYTES'] = 64 * 1024 * 1024  # Memory budget for cached score arrays, per search system
+app.config['SEARCH_SHARDS'] = None  # Worker processes scanning the collection for simple search, None for in-process
+app.config['IVF_N_PROBE'] = None  # IVF lists visited per semi-supervised query, None for exact search
+app.config['CASCADE_SHORTLIST'] = None  # Images re-scored exactly after the cheap simple-search prefilter, None for exact search
+app.config['LOCAL_CANDIDATES'] = None  # First-pass candidates feedback is propagated over per query, None for the whole collection
+app.config['SESSION_TTL'] = 1800  # Seconds a feedback session is kept after its last use
+app.config['MAX_SESSIONS'] = 1000  # Feedback sessions kept in memory per worker
+app.config['SESSION_DB'] = None  # SQLite file sharing feedback sessions between worker processes, None for in-process only
+app.config['BATCH_WORKERS'] = None  # Processes extracting /batch_search queries, shared by all requests, None for the CPU count
 
-# Initialize search systems
-simple_search = ImageSimilaritySearch(DATASET_PATH)
-semi_supervised_search = SemiSupervisedImageSearch(DATASET_PATH)
+# Initialize search systems, sharing one cache of query descriptors
+query_cache = QueryDescriptorCache(max_bytes=app.config['QUERY_CACHE_BYTES'])
+simple_search = ImageSimilaritySearch(
+    DATASET_PATH, query_cache=query_cache,
+    score_cache=ScoreCache(max_bytes=app.config['SCORE_CACHE_BYTES']),
+    shards=app.config['SEARCH_SHARDS'],
+    cascade_shortlist=app.config['CASCADE_SHORTLIST']
+)
+semi_supervised_search = SemiSupervisedImageSearch(
+    DATASET_PATH, query_cache=query_cache,
+    score_cache=ScoreCache(max_bytes=app.config['SCORE_CACHE_BYTES']),
+    n_probe=app.config['IVF_N_PROBE'],
+    local_candidates=app.config['LOCAL_CANDIDATES'],
+    session_ttl=app.config['SESSION_TTL'],
+    max_sessions=app.config['MAX_SESSIONS'],
+    session_backend=SQLiteSessionBackend(app.config['SESSION_DB']) if app.config['SESSION_DB'] else None
+)
+# Started on the first batch and reused by every later one
+extraction_pool = ExtractionPool(workers=app.config['BATCH_WORKERS'])
 
 def allowed_file(filename):
     """
@@ -37,6 +62,34 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def parse_offset(form, page_size):
+    """
+    Read the result offset of a request, given as `offset` or as a 1-based `page`.
+    """
+    if 'page' in form:
+        return max(int(form['page']) - 1, 0) * page_size
+    return max(int(form.get('offset', 0)), 0)
+
+def indexed_path(image_path, path_rows):
+    """
+    Path of a dataset image as indexed, given as indexed or relative to the dataset.
+    """
+    if image_path in path_rows:
+        return image_path
+    return os.path.join(DATASET_PATH, image_path.lstrip('/'))
+
+def feedback_ids(feedback):
+    """
+    Convert semi-supervised feedback, images given by id or by path, to image ids.
+    """
+    return {
+        label: semi_supervised_search.image_ids(
+            image if isinstance(image, int) else indexed_path(image, semi_supervised_search.path_rows)
+            for image in feedback.get(label, [])
+        )
+        for label in ("relevant", "non_relevant")
+    }
+
 def convert_numpy_to_list(descriptors):
     """
     Convert numpy arrays to lists for JSON serialization.
@@ -63,17 +116,16 @@ def simple_image_search():
             return jsonify({"error": "No selected file"}), 400
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
             try:
                 top_k = int(request.form.get('top_k', 10))
-                similar_images = simple_search.find_similar_images(filepath, top_k=top_k)
+                offset = parse_offset(request.form, top_k)
+                # Uploads are decoded in memory, nothing is written to disk
+                similar_images = simple_search.find_similar_images(file.read(), top_k=top_k, offset=offset)
                 
                 # Optional: you might want to process paths to remove absolute path prefixes
                 processed_similar_images = [
                     {
+                        "image_id": img_result['image_id'],
                         "image_path": img_result['image_path'].replace(
                             f"{DATASET_PATH}\\", ""
                         ).replace("\\", "/"),
@@ -82,14 +134,13 @@ def simple_image_search():
                     for img_result in similar_images
                 ]
                 
-                os.remove(filepath)
                 return jsonify({
                     "search_type": "simple_similarity",
-                    "similar_images": processed_similar_images
+                    "similar_images": processed_similar_images,
+                    "offset": offset,
+                    "total_images": len(simple_search.image_paths)
                 })
             except Exception as e:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
                 return jsonify({"error": str(e)}), 500
         
         return jsonify({"error": "File type not allowed"}), 400
@@ -107,10 +158,6 @@ def semi_supervised_image_search():
         return jsonify({"error": "No selected file"}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         # Parse feedback from the request
         feedback = request.form.get('feedback')
         parsed_feedback = None
@@ -124,26 +171,116 @@ def semi_supervised_image_search():
                     parsed_feedback = eval(feedback)
             except Exception as e:
                 return jsonify({"error": f"Invalid feedback format: {e}"}), 400
+            try:
+                parsed_feedback = feedback_ids(parsed_feedback)
+            except KeyError as e:
+                return jsonify({"error": str(e.args[0])}), 400
+            except (AttributeError, TypeError) as e:
+                return jsonify({"error": f"Invalid feedback format: {e}"}), 400
 
         try:
-            # Perform image search
-            similar_images = semi_supervised_search.find_similar_images(
-                filepath, 
-                top_k=10, 
-                feedback=parsed_feedback
+            top_k = 10
+            offset = parse_offset(request.form, top_k)
+            # Feedback rounds of one user share a session, a new one is started without an id
+            session = semi_supervised_search.sessions.get(request.form.get('session_id'))
+            # Perform image search, decoding the upload in memory
+            similar_ids = semi_supervised_search.find_similar_images(
+                file.read(), 
+                top_k=top_k, 
+                feedback=parsed_feedback,
+                offset=offset,
+                session=session,
+                return_ids=True
             )
-            os.remove(filepath)
             return jsonify({
                 "search_type": "semi_supervised",
-                "similar_images": similar_images,
-                "feedback_applied": bool(parsed_feedback)
+                "session_id": session.id,
+                "similar_images": [semi_supervised_search.image_paths[idx] for idx in similar_ids],
+                # Feedback can name these images by id instead of path
+                "similar_image_ids": similar_ids,
+                "feedback_applied": bool(parsed_feedback),
+                # Iterations and time of the session's last label propagation rounds, and totals
+                "feedback_rounds": session.rounds,
+                "feedback_round_count": session.feedback_round,
+                "feedback_total_ms": session.total_ms,
+                "offset": offset,
+                "total_images": len(semi_supervised_search.image_paths)
             })
         except Exception as e:
-            if os.path.exists(filepath):
-                os.remove(filepath)
             return jsonify({"error": str(e)}), 500
     
     return jsonify({"error": "File type not allowed"}), 400
+@app.route('/search_by_id', methods=['POST'])
+def search_by_id():
+    """
+    "More like this" for a dataset image, given by its `image_id` (index row) or `image_path`.
+
+    Answers from the stored descriptors, or from the precomputed neighbour graph
+    when one was built, so the image is neither uploaded nor re-extracted.
+    """
+    data = request.get_json(silent=True) or request.form.to_dict()
+    try:
+        top_k = int(data.get('top_k', 10))
+        offset = parse_offset(data, top_k)
+        if 'image_id' in data:
+            similar_images = simple_search.find_similar_by_id(int(data['image_id']), top_k=top_k, offset=offset)
+        elif 'image_path' in data:
+            # Result paths may have been sent back relative to the dataset
+            image_path = indexed_path(data['image_path'], simple_search.path_rows)
+            similar_images = simple_search.find_similar_by_path(image_path, top_k=top_k, offset=offset)
+        else:
+            return jsonify({"error": "No image_id or image_path provided"}), 400
+    except KeyError as e:
+        return jsonify({"error": str(e.args[0])}), 404
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "search_type": "dataset_image",
+        "similar_images": similar_images,
+        "offset": offset,
+        "total_images": len(simple_search.image_paths)
+    })
+
+@app.route('/batch_search', methods=['POST'])
+def batch_image_search():
+    """
+    Rank the dataset against many query images in one request.
+
+    Takes several files under 'images' or one zip/tar file under 'archive',
+    and streams one JSON line per query back as results complete. Files of a
+    type not allowed get an error line each, ahead of the results.
+    """
+    files = request.files.getlist('images')
+    archive = request.files.get('archive')
+    if not files and archive is None:
+        return jsonify({"error": "No files uploaded"}), 400
+    try:
+        top_k = int(request.form.get('top_k', 10))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    rejected = []
+    if archive is not None:
+        source = archive.read()
+    else:
+        # Read the uploads now, the request is gone once the response streams
+        source = [(file.filename, file.read()) for file in files if allowed_file(file.filename)]
+        rejected = [file.filename for file in files if not allowed_file(file.filename)]
+        if not source:
+            return jsonify({"error": "File type not allowed"}), 400
+
+    def generate():
+        for name in rejected:
+            yield json.dumps({"query": name, "error": "File type not allowed"}) + "\n"
+        try:
+            for result in simple_search.find_similar_images_batch(source, top_k=top_k, pool=extraction_pool):
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route('/image/<path:filename>', methods=['GET'])
 def get_image(filename):
     """
@@ -168,13 +305,49 @@ def health_check():
     return jsonify({
         "status": "healthy",
         "simple_search_initialized": bool(simple_search.image_descriptors),
-        "semi_supervised_search_initialized": bool(semi_supervised_search.image_descriptors)
+        "semi_supervised_search_initialized": bool(semi_supervised_search.image_descriptors),
+        "query_cache": query_cache.stats()
     }), 200
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Hit/miss counters and memory usage of the query descriptor cache and of the score caches.
+    """
+    stats = query_cache.stats()
+    stats["score_caches"] = {
+        "simple_search": simple_search.score_cache.stats(),
+        "semi_supervised_search": semi_supervised_search.score_cache.stats()
+    }
+    return jsonify(stats), 200
+
+@app.route('/shortlist_stats', methods=['GET'])
+def shortlist_stats():
+    """
+    How often the simple-search shortlist (cascade or PQ) missed exact top-k results, over audited queries.
+    """
+    return jsonify(simple_search.shortlist_audit.stats()), 200
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats():
+    """
+    Feedback sessions held by this worker (and in the shared store), with expiry and eviction counters.
+    """
+    return jsonify(semi_supervised_search.sessions.stats()), 200
+
+@app.route('/extraction_stats', methods=['GET'])
+def extraction_stats():
+    """
+    Per-stage wall time of the descriptor pipeline used for query images.
+    """
+    params = simple_search.extraction_params
+    pipeline = get_pipeline(**params)
+    return jsonify(pipeline.timing_report()), 200
 # Load pre-computed descriptors
 # Load pre-computed descriptors
 def load_descriptors(json_path='image_descriptors.json'):
     """
-    Load pre-computed image descriptors from a JSON file.
+    Load pre-computed image descriptors from a JSON file or its binary store.
     
     Args:
         json_path (str): Path to the JSON file containing descriptors
@@ -182,19 +355,11 @@ def load_descriptors(json_path='image_descriptors.json'):
     Returns:
         dict: Loaded image descriptors
     """
-    try:
-        with open(json_path, 'r') as file:
-            descriptors = json.load(file)
-            
-        # Convert nested lists back to numpy arrays
-        for image_path, image_descriptors in descriptors.items():
-            for descriptor_type, descriptor_data in image_descriptors.items():
-                for sub_key, sub_value in descriptor_data.items():
-                    descriptors[image_path][descriptor_type][sub_key] = np.array(sub_value)
-        
-        return descriptors
-    except FileNotFoundError:
+    if not any(os.path.exists(path) for path in (json_path, journal_path(json_path), binary_store_path(json_path))):
         raise FileNotFoundError(f"Descriptors file not found at {json_path}")
+    try:
+        # Memory-maps the binary store when present, otherwise parses the JSON file and its journal
+        return open_descriptors(json_path)
     except json.JSONDecodeError:
         raise ValueError(f"Invalid JSON format in {json_path}")
 
@@ -0,0 +1,194 @@
+"""
+Inverted-file (IVF) approximate nearest-neighbour index.
+
+The standardized feature vectors of the dataset are clustered with k-means;
+every image is filed under its nearest centroid. A query only visits the
+`n_probe` lists whose centroids are closest to it, and only those candidates
+are scored with the full weighted distance, so a search touches a fraction
+of the collection instead of all of it.
+
+The index is persisted next to the descriptor store (<base>.ivf.npz) with
+the standardization it was trained with, and images indexed later are
+filed under the existing centroids instead of retraining.
+"""
+import os
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+
+def ivf_index_path(descriptors_file):
+    """
+    Return the path of the IVF index built for a descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.ivf.npz"
+
+
+def default_n_lists(count):
+    """
+    Number of inverted lists for a collection size, about 4 x sqrt(N).
+    """
+    return int(min(max(1, 4 * np.sqrt(count)), count))
+
+
+class IVFIndex:
+    """
+    Inverted lists of dataset rows, keyed by the nearest k-means centroid.
+    """
+    def __init__(self, centroids, mean, scale, assignments, paths, trained_count):
+        """
+        Args:
+            centroids (numpy.ndarray): n_lists x D centroids, in standardized space
+            mean (numpy.ndarray): Feature means used for standardization
+            scale (numpy.ndarray): Feature scales used for standardization
+            assignments (numpy.ndarray): List of every row
+            paths (list): Image path of every row
+            trained_count (int): Number of rows the centroids were trained on
+        """
+        self.centroids = centroids
+        self.mean = mean
+        self.scale = scale
+        self.assignments = assignments
+        self.paths = list(paths)
+        self.trained_count = trained_count
+        self._build_lists()
+
+    def _build_lists(self):
+        # Rows grouped by list: list i holds rows[offsets[i]:offsets[i + 1]]
+        self.rows = np.argsort(self.assignments, kind='stable')
+        self.offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(self.assignments, minlength=len(self.centroids))))
+        )
+
+    @classmethod
+    def build(cls, features, paths, n_lists=None, seed=0):
+        """
+        Train the centroids on a feature matrix and file every row.
+
+        Args:
+            features (numpy.ndarray): N x D raw feature matrix
+            paths (list): Image path of every row
+            n_lists (int, optional): Number of inverted lists, default_n_lists(N) by default
+            seed (int): Random state of k-means
+        """
+        scaler = StandardScaler().fit(features)
+        scaled = scaler.transform(features)
+        n_lists = min(n_lists or default_n_lists(len(features)), len(features))
+        if len(features) > 50000:
+            kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, n_init=3, random_state=seed)
+        else:
+            kmeans = KMeans(n_clusters=n_lists, n_init=1, random_state=seed)
+        assignments = kmeans.fit_predict(scaled)
+        return cls(kmeans.cluster_centers_, scaler.mean_, scaler.scale_,
+                   assignments.astype(np.int32), paths, len(features))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["mean"], data["scale"], data["assignments"],
+                       data["paths"].tolist(), int(data["trained_count"]))
+
+    def save(self, path):
+        """
+        Persist the index atomically.
+        """
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, mean=self.mean, scale=self.scale,
+                 assignments=self.assignments, paths=np.array(self.paths),
+                 trained_count=self.trained_count)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def transform(self, features):
+        """
+        Standardize raw features the way the centroids were trained.
+        """
+        return (np.asarray(features, dtype=float) - self.mean) / self.scale
+
+    def nearest_lists(self, scaled, count=1):
+        """
+        Indices of the `count` nearest centroids of every standardized row.
+        """
+        distances = (
+            np.einsum('ij,ij->i', scaled, scaled)[:, None]
+            - 2 * scaled @ self.centroids.T
+            + np.einsum('ij,ij->i', self.centroids, self.centroids)[None, :]
+        )
+        if count >= self.n_lists:
+            return np.argsort(distances, axis=1)
+        nearest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+        order = np.take_along_axis(distances, nearest, axis=1).argsort(axis=1)
+        return np.take_along_axis(nearest, order, axis=1)
+
+    def add(self, features, paths):
+        """
+        File new rows under the existing centroids.
+        """
+        if not len(paths):
+            return
+        assignments = self.nearest_lists(self.transform(features))[:, 0].astype(np.int32)
+        self.assignments = np.concatenate((self.assignments, assignments))
+        self.paths.extend(paths)
+        self._build_lists()
+
+    def candidates(self, query_features, n_probe):
+        """
+        Rows filed under the `n_probe` lists nearest to a query.
+
+        Args:
+            query_features (numpy.ndarray): Raw feature vector of the query
+            n_probe (int): Number of lists to visit
+
+        Returns:
+            numpy.ndarray: Sorted candidate rows
+        """
+        lists = self.nearest_lists(self.transform(np.reshape(query_features, (1, -1))), n_probe)[0]
+        return np.sort(np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in lists]))
+
+
+def load_or_build_ivf_index(index_path, features, paths, n_lists=None, retrain_growth=0.5):
+    """
+    Open the persisted IVF index of a collection, updating or rebuilding it as needed.
+
+    Images indexed since the last build are filed under the existing
+    centroids. The centroids are retrained when the collection has grown by
+    more than `retrain_growth` since they were trained, or when the persisted
+    index no longer matches the collection (images removed or reordered).
+
+    Args:
+        index_path (str): Path of the persisted index
+        features (numpy.ndarray): N x D raw feature matrix of the collection
+        paths (list): Image path of every row
+        n_lists (int, optional): Number of lists when (re)building
+        retrain_growth (float): Growth ratio beyond which the centroids are retrained
+
+    Returns:
+        IVFIndex: Index covering every row of `features`
+    """
+    if os.path.exists(index_path):
+        try:
+            index = IVFIndex.load(index_path)
+            known = len(index)
+            if known <= len(paths) and index.paths == list(paths[:known]) \
+                    and len(paths) <= index.trained_count * (1 + retrain_growth):
+                if known < len(paths):
+                    print(f"Adding {len(paths) - known} images to the IVF index")
+                    index.add(features[known:], list(paths[known:]))
+                    index.save(index_path)
+                return index
+            print("IVF index out of date, rebuilding...")
+        except Exception as e:
+            print(f"Could not load IVF index {index_path}: {e}")
+
+    print(f"Building IVF index over {len(paths)} images...")
+    index = IVFIndex.build(features, list(paths), n_lists)
+    index.save(index_path)
+    print(f"IVF index built with {index.n_lists} lists")
+    return index
@@ -0,0 +1,154 @@
+"""
+Precomputed k-nearest-neighbour lists of the indexed images.
+
+Searching "more like this" from a dataset image does not need its descriptors
+extracted again, they are in the index. With a neighbour graph built offline
+it does not need a scan either: the first `k` results of every image are
+stored (rows and distances, exactly as the full ranking orders them) and a
+query by id becomes a lookup.
+
+The graph is persisted next to the descriptor store (<base>.knn.npz). It is
+only valid for the collection it was built on: adding images can change the
+neighbours of existing ones, so a graph whose paths no longer match the index
+is ignored until it is rebuilt.
+
+Usage:
+    python knn_graph.py image_descriptors.json --k 50
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from descriptor_store import open_descriptors
+from ranking import RankingEngine, top_k_indices
+
+
+def knn_graph_path(descriptors_file):
+    """
+    Return the path of the neighbour graph built for a descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.knn.npz"
+
+
+class KNNGraph:
+    """
+    The `k` nearest images of every indexed image, best first.
+    """
+    def __init__(self, neighbors, distances, paths):
+        """
+        Args:
+            neighbors (numpy.ndarray): N x k rows of the nearest images, rows ordered like `paths`
+            distances (numpy.ndarray): N x k global distances of those images
+            paths (list): Image path of every row
+        """
+        self.neighbors = neighbors
+        self.distances = distances
+        self.paths = list(paths)
+
+    @property
+    def k(self):
+        return self.neighbors.shape[1]
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def build(cls, engine, image_descriptors, k=50, query_block=16, progress_every=1000):
+        """
+        Rank the collection against each of its own images, `query_block` images at a time.
+
+        Args:
+            engine (RankingEngine): Engine over the indexed images
+            image_descriptors: Stored descriptors of the same images, keyed by path
+            k (int): Neighbours kept per image
+            query_block (int): Images ranked together in one distance matrix
+            progress_every (int): Print progress after this many images
+        """
+        count = len(engine)
+        k = min(k, count)
+        neighbors = np.empty((count, k), dtype=np.int32)
+        distances = np.empty((count, k))
+        start_time = time.perf_counter()
+        for start in range(0, count, query_block):
+            stop = min(start + query_block, count)
+            block = engine.batch_distances([image_descriptors[path] for path in engine.paths[start:stop]])
+            for row, row_distances in enumerate(block, start):
+                neighbors[row] = top_k_indices(row_distances, k)
+                distances[row] = row_distances[neighbors[row]]
+            if stop % progress_every < query_block or stop == count:
+                print(f"[{stop}/{count}] {stop / (time.perf_counter() - start_time):.1f} images/s")
+        return cls(neighbors, distances, engine.paths)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["neighbors"], data["distances"], data["paths"].tolist())
+
+    def save(self, path):
+        """
+        Persist the graph atomically.
+        """
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, neighbors=self.neighbors, distances=self.distances, paths=np.array(self.paths))
+        os.replace(tmp_path, path)
+
+    def covers(self, count):
+        """
+        Whether the first `count` results of an image can be read from the graph.
+        """
+        return count <= self.k
+
+    def neighbors_of(self, row, top_k, offset=0):
+        """
+        Rows and distances of the ranks offset .. offset + top_k of an image.
+        """
+        return self.neighbors[row, offset:offset + top_k], self.distances[row, offset:offset + top_k]
+
+
+def load_knn_graph(graph_path, paths):
+    """
+    Open the persisted neighbour graph of a collection.
+
+    Returns:
+        KNNGraph or None: The graph, or None when it is missing or was built on other images
+    """
+    if not os.path.exists(graph_path):
+        return None
+    try:
+        graph = KNNGraph.load(graph_path)
+    except Exception as e:
+        print(f"Could not load neighbour graph {graph_path}: {e}")
+        return None
+    if graph.paths != list(paths):
+        print(f"Neighbour graph {graph_path} is out of date, rebuild it with knn_graph.py")
+        return None
+    print(f"Loaded neighbour graph, {graph.k} neighbours per image")
+    return graph
+
+
+def build_knn_graph(descriptors_file, k=50, query_block=16):
+    """
+    Build and persist the neighbour graph of an index.
+    """
+    image_descriptors = open_descriptors(descriptors_file)
+    engine = RankingEngine.from_descriptors(image_descriptors)
+    print(f"Building neighbour graph over {len(engine)} images, {k} neighbours each...")
+    graph = KNNGraph.build(engine, image_descriptors, k, query_block)
+    graph.save(knn_graph_path(descriptors_file))
+    print(f"Saved neighbour graph to {knn_graph_path(descriptors_file)}")
+    return graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the k nearest neighbours of every indexed image.")
+    parser.add_argument('descriptors_file', nargs='?', default='image_descriptors.json')
+    parser.add_argument('--k', type=int, default=50, help="Neighbours kept per image")
+    parser.add_argument('--query-block', type=int, default=16, help="Images ranked together")
+    args = parser.parse_args()
+    build_knn_graph(args.descriptors_file, args.k, args.query_block)
+
+
+if __name__ == '__main__':
+    main()
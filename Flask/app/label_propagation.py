@@ -0,0 +1,306 @@
+"""
+Label propagation over a sparse k-nearest-neighbour graph.
+
+LabelSpreading(kernel='rbf') builds a dense N x N affinity matrix on every
+fit, which costs O(N^2) time and memory per feedback round. Here the graph is
+built once per index: every image is linked to its `k` nearest images in the
+standardized feature space, with RBF weights, and the graph is normalized like
+LabelSpreading's (S = D^-1/2 W D^-1/2) and persisted next to the descriptor
+store (<base>.labelgraph.npz). A feedback round only iterates
+
+    F <- alpha S F + (1 - alpha) Y
+
+with sparse products, O(N k) per iteration, until F stops changing.
+
+F is linear in Y, so a later feedback round does not start over: it adds the
+propagation of the label change only, F + (1 - alpha) sum_t (alpha S)^t dY.
+Entries of the pushed residual below the tolerance are dropped, so the push
+only touches the neighbourhood of the images whose label changed and gets
+cheaper as a session settles.
+
+Dropped residuals add up, and P(relevant) is a ratio of masses that are tiny
+far from the labelled images, so the push alone gives no useful accuracy.
+Every round therefore ends with exact sweeps over the whole graph,
+F <- alpha S F + (1 - alpha) Y, each also giving the residual R of the current
+F. The error of F is (I - alpha S)^-1 R, at most |R|_max z elementwise with
+z = (I - alpha S)^-1 1 (computed once per graph, S being nonnegative), which
+bounds the error of every image's P(relevant). Sweeps stop once that bound is
+below `max_error`: update() guarantees P(relevant) within `max_error` of the
+converged solution, unless `max_sweeps` ran out first, and reports the bound.
+
+local_relevance() is the query-local alternative: the graph is built on the
+fly over a few hundred rows only (the best first-pass candidates of a query
+and the labelled images), so a round costs the same whatever the size of the
+collection, and no collection-wide graph is needed.
+
+Labels are +1 (relevant), -1 (non-relevant) and 0 (no feedback). Column 0 of
+F is the relevant mass reaching every image and column 1 the non-relevant
+mass; P(relevant) adds a small neutral prior mass to both, so images the
+feedback does not reach stay at 0.5.
+"""
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import cg
+
+
+def label_graph_path(descriptors_file):
+    """
+    Return the path of the label propagation graph built for a descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.labelgraph.npz"
+
+
+def knn_affinity(features, k=10, max_block_entries=1 << 24):
+    """
+    Symmetric sparse RBF affinity between every row and its k nearest rows (Euclidean).
+
+    Neighbours are found by brute force, a block of rows at a time, so at most
+    `max_block_entries` distances are held in memory. The RBF width is the mean
+    squared distance to the neighbours.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    count = len(features)
+    k = min(k, count - 1)
+    if k < 1:
+        return sparse.csr_matrix((count, count))
+
+    squared_norms = np.einsum('ij,ij->i', features, features)
+    block_size = max(1, max_block_entries // count)
+    neighbors = np.empty((count, k), dtype=np.int64)
+    squared_distances = np.empty((count, k))
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        block = squared_norms[start:stop, None] + squared_norms[None] - 2 * (features[start:stop] @ features.T)
+        # An image is not its own neighbour
+        block[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+        neighbors[start:stop] = nearest
+        squared_distances[start:stop] = np.maximum(np.take_along_axis(block, nearest, axis=1), 0)
+
+    width = squared_distances.mean() or 1.0
+    affinity = sparse.csr_matrix(
+        (np.exp(-squared_distances / width).ravel(), neighbors.ravel(), np.arange(0, count * k + 1, k)),
+        shape=(count, count)
+    )
+    return affinity.maximum(affinity.T).tocsr()
+
+
+def normalize_affinity(affinity):
+    """
+    Symmetric normalization D^-1/2 W D^-1/2 of an affinity matrix.
+    """
+    degrees = np.asarray(affinity.sum(axis=1)).ravel()
+    inverse_sqrt = np.zeros_like(degrees)
+    inverse_sqrt[degrees > 0] = 1 / np.sqrt(degrees[degrees > 0])
+    scaling = sparse.diags(inverse_sqrt)
+    return (scaling @ affinity @ scaling).tocsr()
+
+
+class LabelPropagator:
+    """
+    Diffuses relevance feedback over a normalized sparse kNN graph.
+    """
+    def __init__(self, graph, paths, k, alpha=0.8, prior_mass=1e-2):
+        """
+        Args:
+            graph (scipy.sparse.csr_matrix): Normalized N x N affinity S
+            paths (list): Image path of every row
+            k (int): Neighbours per image the graph was built with
+            alpha (float): Share of a node's value coming from its neighbours at each step
+            prior_mass (float): Neutral mass added to both classes before taking P(relevant)
+        """
+        self.graph = graph
+        self.paths = list(paths)
+        self.k = k
+        self.alpha = alpha
+        self.prior_mass = prior_mass
+        self._amplification = None
+
+    @classmethod
+    def build(cls, features, paths, k=10, alpha=0.8):
+        """
+        Build the graph of standardized features, one row per image.
+        """
+        return cls(normalize_affinity(knn_affinity(features, k)), paths, k, alpha)
+
+    @classmethod
+    def load(cls, path, alpha=0.8):
+        with np.load(path) as data:
+            graph = sparse.csr_matrix(
+                (data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"])
+            )
+            return cls(graph, data["paths"].tolist(), int(data["k"]), alpha)
+
+    def save(self, path):
+        """
+        Persist the graph atomically.
+        """
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, data=self.graph.data, indices=self.graph.indices, indptr=self.graph.indptr,
+                 shape=np.array(self.graph.shape), paths=np.array(self.paths), k=self.k)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def seeds(labels):
+        """
+        N x 2 one-hot relevant / non-relevant seeds of +1 / -1 / 0 labels.
+        """
+        return np.column_stack([labels > 0, labels < 0]).astype(float)
+
+    def amplification(self):
+        """
+        z = (I - alpha S)^-1 1: image i's mass is off by at most z_i times the largest residual.
+        """
+        if self._amplification is None:
+            system = sparse.identity(len(self), format='csr') - self.alpha * self.graph
+            z, _ = cg(system, np.ones(len(self)), rtol=1e-10, maxiter=1000)
+            # Slack for the solver's own tolerance, the bound must not be undercut
+            self._amplification = z * (1 + 1e-6)
+        return self._amplification
+
+    def propagate(self, labels, max_iter=50, tol=1e-7, max_error=1e-3, max_sweeps=200):
+        """
+        Spread the labelled images' classes over the graph, from scratch.
+
+        Args:
+            labels (numpy.ndarray): +1 relevant, -1 non-relevant, 0 unlabelled, one per image
+            max_iter (int): Maximum number of push steps
+            tol (float): Drop pushed changes smaller than this, stop pushing when none is left
+            max_error (float): Guaranteed bound on the P(relevant) error of every image
+            max_sweeps (int): Maximum number of exact sweeps spent reaching it
+
+        Returns:
+            tuple: (N x 2 relevant and non-relevant mass of every image, stats dict)
+        """
+        return self.update(None, np.zeros(len(labels)), labels, max_iter, tol, max_error, max_sweeps)
+
+    def update(self, distributions, previous_labels, labels, max_iter=50, tol=1e-7, max_error=1e-3,
+               max_sweeps=200):
+        """
+        Warm-start propagation: add the effect of a label change to earlier distributions.
+
+        Args:
+            distributions (numpy.ndarray or None): Result for `previous_labels`, None for no labels
+            previous_labels (numpy.ndarray): Labels `distributions` were propagated from
+            labels (numpy.ndarray): New labels
+            max_iter (int): Maximum number of push steps
+            tol (float): Drop pushed changes smaller than this, stop pushing when none is left
+            max_error (float): Guaranteed bound on the P(relevant) error of every image
+            max_sweeps (int): Maximum number of exact sweeps spent reaching it
+
+        Returns:
+            tuple: (N x 2 masses for `labels`, {"iterations", "touched", "sweeps", "error_bound"}),
+                touched being the number of images the push changed and error_bound the
+                largest possible P(relevant) error left, at most max_error unless
+                max_sweeps ran out
+        """
+        distributions = np.zeros((len(labels), 2)) if distributions is None else distributions.copy()
+        residual = (1 - self.alpha) * (self.seeds(labels) - self.seeds(previous_labels))
+        active = np.flatnonzero(labels != previous_labels)
+        touched = np.zeros(len(labels), dtype=bool)
+        iterations = 0
+        while len(active) and iterations < max_iter:
+            distributions[active] += residual[active]
+            touched[active] = True
+            # S is symmetric: S[:, active] @ r[active] == S[active].T @ r[active]
+            rows = self.graph[active]
+            residual = self.alpha * (rows.T @ residual[active])
+            # Only neighbours of the active rows can carry a residual
+            reached = np.zeros(len(labels), dtype=bool)
+            reached[rows.indices] = True
+            reached = np.flatnonzero(reached)
+            magnitude = np.abs(residual[reached])
+            active = reached[np.maximum(magnitude[:, 0], magnitude[:, 1]) >= tol]
+            iterations += 1
+
+        seeds = (1 - self.alpha) * self.seeds(labels)
+        amplification = self.amplification()
+        sweeps = 0
+        while True:
+            residual = seeds + self.alpha * (self.graph @ distributions) - distributions
+            error_bound = self.error_bound(distributions, np.abs(residual).max(axis=0), amplification)
+            if error_bound <= max_error or sweeps == max_sweeps:
+                break
+            # One Jacobi sweep, F <- alpha S F + (1 - alpha) Y
+            distributions += residual
+            sweeps += 1
+        return distributions, {"iterations": iterations, "touched": int(touched.sum()),
+                               "sweeps": sweeps, "error_bound": error_bound}
+
+    def error_bound(self, distributions, residual_max, amplification):
+        """
+        Largest P(relevant) error possible given the largest residual of each mass column.
+
+        With masses off by at most e_r and e_n, P(relevant) is off by at most
+        (e_r + e_n) / (true total mass + prior), the true total being at least
+        the computed one minus e_r + e_n.
+        """
+        errors = (residual_max[0] + residual_max[1]) * amplification
+        total = distributions.sum(axis=1) + self.prior_mass - errors
+        if np.any(total <= 0):
+            return 1.0
+        return float(np.max(errors / total))
+
+    def relevance(self, distributions):
+        """
+        P(relevant) of every image from the masses returned by propagate.
+        """
+        relevant = distributions[:, 0] + self.prior_mass / 2
+        return relevant / (distributions.sum(axis=1) + self.prior_mass)
+
+
+def local_relevance(features, rows, labels, k=10, alpha=0.8, max_iter=50, tol=1e-7):
+    """
+    Propagate labels over the kNN graph of a subset of the images only.
+
+    Args:
+        features (numpy.ndarray): Standardized N x D features, one row per image
+        rows (numpy.ndarray): Rows of the subgraph, the labelled images among them
+        labels (numpy.ndarray): +1 / -1 / 0 label of every image
+        k (int): Neighbours per image within the subgraph
+        alpha (float): Propagation alpha
+        max_iter (int): Maximum number of diffusion steps
+        tol (float): Drop pushed changes smaller than this
+
+    Returns:
+        tuple: (P(relevant) of every row of `rows`, stats dict)
+    """
+    propagator = LabelPropagator.build(features[rows], list(rows), k, alpha)
+    distributions, stats = propagator.propagate(labels[rows], max_iter, tol)
+    return propagator.relevance(distributions), stats
+
+
+def load_or_build_label_graph(graph_path, features, paths, k=10, alpha=0.8):
+    """
+    Open the persisted label propagation graph of a collection, rebuilding it when the images changed.
+
+    Args:
+        graph_path (str): Path of the persisted graph
+        features (numpy.ndarray): Standardized N x D features, one row per image
+        paths (list): Image path of every row
+        k (int): Neighbours per image when (re)building
+        alpha (float): Propagation alpha
+
+    Returns:
+        LabelPropagator: Propagator over every image
+    """
+    if os.path.exists(graph_path):
+        try:
+            propagator = LabelPropagator.load(graph_path, alpha)
+            if propagator.paths == list(paths) and propagator.k == k:
+                return propagator
+            # New images change the neighbours of existing ones, the graph is rebuilt as a whole
+            print("Label propagation graph out of date, rebuilding...")
+        except Exception as e:
+            print(f"Could not load label propagation graph {graph_path}: {e}")
+
+    print(f"Building label propagation graph over {len(paths)} images, {k} neighbours each...")
+    propagator = LabelPropagator.build(features, list(paths), k, alpha)
+    propagator.save(graph_path)
+    print(f"Label propagation graph built, {propagator.graph.nnz} edges")
+    return propagator
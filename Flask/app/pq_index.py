@@ -0,0 +1,261 @@
+"""
+Product-quantized (PQ) compressed descriptors.
+
+Every image is encoded into `n_subvectors` bytes: its vector is cut into
+n_subvectors pieces and each piece is replaced by the index of its nearest
+centroid among 256 learnt for that piece. A query builds one table of
+squared distances from its own pieces to every centroid (asymmetric distance
+computation), after which the approximate distance to any image is a sum of
+n_subvectors table lookups.
+
+The encoded vector is the concatenation of the min-max normalized
+sub-descriptors the ranking uses, each scaled by the square root of its
+weight in DEFAULT_WEIGHTS, so the PQ distance follows the weighted global
+distance closely enough to pick a shortlist. The shortlist is then re-scored
+exactly from the full-precision store, which stays on disk (memory-mapped);
+only the codes have to fit in RAM.
+
+The index is persisted next to the descriptor store (<base>.pq.npz) and
+images indexed later are encoded with the existing codebooks.
+"""
+import os
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from Global_distance_calcul import DEFAULT_WEIGHTS, indexed_weights, normalize_rows
+
+
+def pq_index_path(descriptors_file):
+    """
+    Return the path of the PQ index built for a descriptors file.
+    """
+    return f"{os.path.splitext(descriptors_file)[0]}.pq.npz"
+
+
+def sub_descriptor_scales(keys, weights=None):
+    """
+    Scale of every (descriptor_type, sub_descriptor) block in the encoded vector.
+    """
+    weights = indexed_weights(weights or DEFAULT_WEIGHTS, keys)
+    scales = []
+    for descriptor_type, sub_descriptor in keys:
+        descriptor_weights = weights.get(descriptor_type, {})
+        sub_count = max(len([name for name in descriptor_weights if name != "weight"]), 1)
+        weight = descriptor_weights.get("weight", 1.0) * descriptor_weights.get(sub_descriptor, 0.0) / sub_count
+        scales.append(np.sqrt(weight))
+    return scales
+
+
+class ProductQuantizer:
+    """
+    Codebooks of 256 (at most) centroids per subvector.
+    """
+    def __init__(self, codebooks, dim):
+        """
+        Args:
+            codebooks (numpy.ndarray): n_subvectors x n_centroids x sub_dim centroids
+            dim (int): Length of the encoded vectors, before padding to n_subvectors x sub_dim
+        """
+        self.codebooks = codebooks
+        self.dim = dim
+
+    @property
+    def n_subvectors(self):
+        return self.codebooks.shape[0]
+
+    @property
+    def sub_dim(self):
+        return self.codebooks.shape[2]
+
+    def _split(self, vectors):
+        # Zero-pad to a whole number of subvectors: N x n_subvectors x sub_dim
+        vectors = np.asarray(vectors, dtype=np.float32)
+        padded = np.zeros((len(vectors), self.n_subvectors * self.sub_dim), dtype=np.float32)
+        padded[:, :vectors.shape[1]] = vectors
+        return padded.reshape(len(vectors), self.n_subvectors, self.sub_dim)
+
+    @classmethod
+    def train(cls, vectors, n_subvectors=32, sample_size=100000, seed=0):
+        """
+        Learn the codebooks with k-means on (a sample of) the vectors.
+        """
+        rng = np.random.default_rng(seed)
+        if len(vectors) > sample_size:
+            vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        dim = vectors.shape[1]
+        sub_dim = -(-dim // n_subvectors)
+        n_centroids = min(256, len(vectors))
+
+        quantizer = cls(np.zeros((n_subvectors, n_centroids, sub_dim), dtype=np.float32), dim)
+        pieces = quantizer._split(vectors)
+        for j in range(n_subvectors):
+            kmeans = KMeans(n_clusters=n_centroids, n_init=1, max_iter=50, random_state=seed)
+            quantizer.codebooks[j] = kmeans.fit(pieces[:, j]).cluster_centers_
+        return quantizer
+
+    def encode(self, vectors, block_size=16384):
+        """
+        Encode vectors into N x n_subvectors uint8 codes.
+        """
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        centroid_norms = np.einsum('jcd,jcd->jc', self.codebooks, self.codebooks)
+        for start in range(0, len(vectors), block_size):
+            pieces = self._split(vectors[start:start + block_size])
+            # argmin over centroids of |c|^2 - 2 x.c, per subvector
+            distances = centroid_norms[None] - 2 * np.einsum('njd,jcd->njc', pieces, self.codebooks)
+            codes[start:start + block_size] = distances.argmin(axis=2)
+        return codes
+
+    def distance_table(self, query):
+        """
+        Squared distances from every query subvector to every centroid of its codebook.
+        """
+        pieces = self._split(np.reshape(query, (1, -1)))[0]
+        return ((self.codebooks - pieces[:, None, :]) ** 2).sum(axis=2)
+
+    def adc_distances(self, codes, table, block_size=65536):
+        """
+        Approximate squared distances of encoded vectors to the query of a distance table.
+        """
+        distances = np.empty(len(codes), dtype=np.float32)
+        subvectors = np.arange(self.n_subvectors)
+        for start in range(0, len(codes), block_size):
+            distances[start:start + block_size] = table[subvectors, codes[start:start + block_size]].sum(axis=1)
+        return distances
+
+
+class PQIndex:
+    """
+    PQ codes of every indexed image, used to shortlist candidates for exact re-scoring.
+    """
+    def __init__(self, quantizer, codes, paths, keys, scales):
+        """
+        Args:
+            quantizer (ProductQuantizer): Trained codebooks
+            codes (numpy.ndarray): N x n_subvectors codes, rows ordered like `paths`
+            paths (list): Image path of every row
+            keys (list): (descriptor_type, sub_descriptor) blocks of the encoded vector, in order
+            scales (list): Scale of every block
+        """
+        self.quantizer = quantizer
+        self.codes = codes
+        self.paths = list(paths)
+        self.keys = [tuple(key) for key in keys]
+        self.scales = list(scales)
+
+    @staticmethod
+    def vectors(normalized, keys, scales, start=0, stop=None):
+        """
+        Encoded-space vectors of rows start .. stop from RankingEngine-style normalized blocks.
+        """
+        return np.hstack([
+            scale * np.asarray(normalized[key][0][start:stop], dtype=np.float32)
+            for key, scale in zip(keys, scales)
+        ])
+
+    def query_vector(self, query_descriptors):
+        """
+        Encoded-space vector of a query.
+        """
+        return np.concatenate([
+            scale * normalize_rows(np.reshape(query_descriptors[descriptor_type][sub_descriptor], (1, -1)))[0]
+            for (descriptor_type, sub_descriptor), scale in zip(self.keys, self.scales)
+        ])
+
+    @classmethod
+    def build(cls, normalized, paths, n_subvectors=32, weights=None, seed=0, block_size=16384):
+        """
+        Train the codebooks on the normalized blocks of a RankingEngine and encode every row.
+        """
+        keys = sorted(normalized)
+        scales = sub_descriptor_scales(keys, weights)
+        count = len(paths)
+        sample = np.sort(np.random.default_rng(seed).choice(count, min(count, 100000), replace=False))
+        quantizer = ProductQuantizer.train(
+            np.hstack([scale * np.asarray(normalized[key][0][sample], dtype=np.float32)
+                       for key, scale in zip(keys, scales)]),
+            n_subvectors, seed=seed
+        )
+        index = cls(quantizer, np.empty((0, quantizer.n_subvectors), dtype=np.uint8), [], keys, scales)
+        index.add(normalized, paths, block_size=block_size)
+        return index
+
+    def add(self, normalized, paths, start=0, block_size=16384):
+        """
+        Encode rows `start` onwards of the normalized blocks with the existing codebooks.
+        """
+        codes = [self.codes]
+        for block_start in range(start, len(paths), block_size):
+            codes.append(self.quantizer.encode(
+                self.vectors(normalized, self.keys, self.scales, block_start, block_start + block_size)
+            ))
+        self.codes = np.concatenate(codes)
+        self.paths.extend(paths[start:])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            quantizer = ProductQuantizer(data["codebooks"], int(data["dim"]))
+            keys = [tuple(key) for key in data["keys"].tolist()]
+            return cls(quantizer, data["codes"], data["paths"].tolist(), keys, data["scales"].tolist())
+
+    def save(self, path):
+        """
+        Persist the index atomically.
+        """
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, codebooks=self.quantizer.codebooks, dim=self.quantizer.dim, codes=self.codes,
+                 paths=np.array(self.paths), keys=np.array(self.keys), scales=np.array(self.scales))
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def bytes_per_image(self):
+        return self.codes.shape[1] * self.codes.itemsize
+
+    def shortlist(self, query_descriptors, size):
+        """
+        Rows of the `size` images nearest to the query by PQ distance, sorted by row.
+        """
+        table = self.quantizer.distance_table(self.query_vector(query_descriptors))
+        distances = self.quantizer.adc_distances(self.codes, table)
+        if size >= len(distances):
+            return np.arange(len(distances))
+        return np.sort(np.argpartition(distances, size - 1)[:size])
+
+
+def load_or_build_pq_index(index_path, normalized, paths, n_subvectors=32):
+    """
+    Open the persisted PQ index of a collection, encoding new images or rebuilding it as needed.
+
+    Args:
+        index_path (str): Path of the persisted index
+        normalized (dict): Normalized blocks of a RankingEngine over the collection
+        paths (list): Image path of every row
+        n_subvectors (int): Bytes per image when (re)building
+
+    Returns:
+        PQIndex: Index covering every image
+    """
+    if os.path.exists(index_path):
+        try:
+            index = PQIndex.load(index_path)
+            known = len(index)
+            if known <= len(paths) and index.paths == list(paths[:known]) and set(index.keys) <= set(normalized):
+                if known < len(paths):
+                    print(f"Encoding {len(paths) - known} new images into the PQ index")
+                    index.add(normalized, list(paths), start=known)
+                    index.save(index_path)
+                return index
+            print("PQ index out of date, rebuilding...")
+        except Exception as e:
+            print(f"Could not load PQ index {index_path}: {e}")
+
+    print(f"Building PQ index over {len(paths)} images...")
+    index = PQIndex.build(normalized, list(paths), n_subvectors)
+    index.save(index_path)
+    print(f"PQ index built, {index.bytes_per_image} bytes per image")
+    return index
@@ -0,0 +1,181 @@
+"""
+Cache of query image descriptors, keyed by a hash of the image bytes.
+
+Relevance-feedback rounds re-upload the same query image, so caching its
+descriptors leaves only the ranking to redo on every round. Paging through
+the results of one query re-uploads it too; ScoreCache keeps the score array
+of recent queries so a further page is a selection, not a new ranking.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from Descriptors_calcul import calculate_descriptors
+
+
+def descriptors_nbytes(descriptors):
+    """
+    Approximate memory footprint of a descriptors dictionary.
+    """
+    return sum(
+        getattr(value, 'nbytes', 8 * len(value))
+        for descriptor_data in descriptors.values()
+        for value in descriptor_data.values()
+    )
+
+
+class QueryDescriptorCache:
+    """
+    Thread-safe LRU cache of query descriptors bounded by a memory budget.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int): Memory budget for the cached descriptors
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image_bytes, extraction_params=None):
+        """
+        Return the cache key of an image's raw bytes and the settings its descriptors use.
+        """
+        digest = hashlib.blake2b(image_bytes, digest_size=16)
+        if extraction_params:
+            digest.update(json.dumps(extraction_params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached descriptors for a key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    @staticmethod
+    def sizeof(descriptors):
+        """
+        Memory charged to the budget for one entry.
+        """
+        return descriptors_nbytes(descriptors)
+
+    def put(self, key, descriptors):
+        """
+        Cache descriptors, evicting the least recently used entries beyond the budget.
+        """
+        size = self.sizeof(descriptors)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (descriptors, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, image_bytes, compute, extraction_params=None):
+        """
+        Return the descriptors of an image, computing and caching them on a miss.
+
+        Args:
+            image_bytes (bytes): Raw (encoded) image bytes, used as the cache key
+            compute (callable): Called without arguments to compute the descriptors
+            extraction_params (dict, optional): Settings `compute` extracts with, part of the key
+
+        Returns:
+            dict: Image descriptors. Callers must not modify them in place.
+        """
+        key = self.key(image_bytes, extraction_params)
+        descriptors = self.get(key)
+        if descriptors is None:
+            descriptors = compute()
+            self.put(key, descriptors)
+        return descriptors
+
+    def stats(self):
+        """
+        Return hit/miss counters and memory usage.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class ScoreCache(QueryDescriptorCache):
+    """
+    LRU cache of per-query score arrays (one score per indexed image), bounded by a memory budget.
+    """
+    @staticmethod
+    def sizeof(scores):
+        return scores.nbytes
+
+
+def query_key(image, extraction_params=None):
+    """
+    Cache key of a query image and the settings its descriptors use.
+
+    Args:
+        image (str, bytes or numpy.ndarray): Path to the query image, its encoded bytes
+            or the decoded image
+        extraction_params (dict, optional): Keyword arguments for calculate_descriptors
+    """
+    if isinstance(image, np.ndarray):
+        image_bytes = f"{image.shape}{image.dtype}".encode() + np.ascontiguousarray(image).tobytes()
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        image_bytes = image
+    else:
+        with open(image, 'rb') as file:
+            image_bytes = file.read()
+    return QueryDescriptorCache.key(image_bytes, extraction_params)
+
+
+def cached_query_descriptors(cache, image, extraction_params=None, key=None):
+    """
+    Compute the descriptors of a query image through a cache.
+
+    Args:
+        cache (QueryDescriptorCache or None): Cache to use, None disables caching
+        image (str, bytes or numpy.ndarray): Path to the query image, its encoded bytes
+            or the decoded image
+        extraction_params (dict, optional): Keyword arguments for calculate_descriptors
+        key (str, optional): query_key of the image, if the caller already has it
+
+    Returns:
+        dict: Image descriptors
+    """
+    extraction_params = extraction_params or {}
+    if cache is None:
+        return calculate_descriptors(image, **extraction_params)
+
+    key = key or query_key(image, extraction_params)
+    descriptors = cache.get(key)
+    if descriptors is None:
+        descriptors = calculate_descriptors(image, **extraction_params)
+        cache.put(key, descriptors)
+    return descriptors
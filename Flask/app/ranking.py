@@ -0,0 +1,251 @@
+"""
+Vectorized ranking of the whole dataset against one query.
+
+calculate_global_distance scores a single pair of images and walks the weight
+dictionaries in Python, so ranking N images costs N x 6 calls to
+calculate_distance. RankingEngine keeps every sub-descriptor as an N x d
+matrix and scores all rows with the same arithmetic in a few array operations.
+
+calculate_distance min-max normalizes both of its vectors, but a dataset
+row's normalization depends only on that row. The engine therefore holds the
+rows already normalized, with their squared norms (precomputed in the binary
+store, or once at load), and a query only normalizes its own vectors: the
+cosine term is one matrix-vector product. A single query takes the Euclidean
+term from the row differences the Manhattan term needs anyway; a batch of
+queries gets it from the products and the norms, |a|^2 + |b|^2 - 2 a.b.
+
+Blocks are scored in the compute dtype of their storage precision (float32
+for float32 and float16 stores) instead of being widened to float64: the
+query is rounded to that dtype, while the row norms, the Euclidean term and
+the weighted global distance are accumulated in float64. For close pairs
+|a|^2 + |b|^2 - 2 a.b cancels down to the rounding error of the product,
+and its square root would be a spurious distance of up to 1e-2, even from an
+image to itself: the batch path rescores pairs closer than
+NEAR_SQUARED_DISTANCE with a direct difference. Farther, the Euclidean term
+is no less accurate than the cosine term.
+"""
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from Global_distance_calcul import DEFAULT_WEIGHTS, indexed_weights, normalize_rows
+from descriptor_store import DEFAULT_PRECISION, BinaryDescriptorStore, compute_dtype, normalize_matrix
+
+# Below this squared Euclidean distance, the batch path recomputes it from the difference of the vectors
+NEAR_SQUARED_DISTANCE = 1.0
+
+
+def combined_distances(query, rows):
+    """
+    Distance of calculate_distance between a normalized query and normalized rows.
+
+    Args:
+        query (numpy.ndarray): Normalized query vector of length d
+        rows (numpy.ndarray): Normalized M x d matrix
+
+    Returns:
+        numpy.ndarray: M distances
+    """
+    cosine_distance = 1 - rows @ query
+    difference = rows - query
+    # Squares of the differences themselves, exact for near-duplicates unlike the norms expansion
+    euclidean = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+    manhattan_distance = np.abs(difference, out=difference).sum(axis=1)
+    return 0.4 * euclidean + 0.3 * cosine_distance + 0.3 * manhattan_distance
+
+
+def top_k_indices(scores, k, offset=0):
+    """
+    Indices of the ranks offset .. offset + k of a score array, best (lowest) first.
+
+    Only the first offset + k scores are selected with argpartition and sorted,
+    instead of the whole array; ties keep the index order of a stable sort.
+    """
+    stop = min(offset + k, len(scores))
+    if offset >= stop:
+        return np.empty(0, dtype=np.intp)
+    if stop < len(scores):
+        candidates = np.argpartition(scores, stop - 1)[:stop]
+    else:
+        candidates = np.arange(len(scores))
+    ranked = candidates[np.lexsort((candidates, scores[candidates]))]
+    return ranked[offset:stop]
+
+
+class RankingEngine:
+    """
+    Scores a query against every indexed image at once.
+
+    Rows are processed in blocks of `block_size` so temporaries stay bounded
+    whatever the dataset size; the matrices themselves may be memory-mapped.
+    """
+    def __init__(self, paths, normalized, block_size=16384):
+        """
+        Args:
+            paths (list): Image paths, in row order
+            normalized (dict): {(descriptor_type, sub_descriptor): (row-normalized N x d matrix,
+                N squared row norms)}, as returned by normalize_matrix
+            block_size (int): Number of rows scored at once
+        """
+        self.paths = list(paths)
+        self.normalized = normalized
+        self.block_size = block_size
+
+    @classmethod
+    def from_matrices(cls, paths, matrices, block_size=16384, precision=None):
+        """
+        Build an engine from raw {(descriptor_type, sub_descriptor): N x d} matrices, normalizing them now.
+
+        The normalized blocks keep the dtype of each matrix unless a precision is given.
+        """
+        normalized = {
+            key: normalize_matrix(matrix, block_size, dtype=precision) for key, matrix in matrices.items()
+        }
+        return cls(paths, normalized, block_size)
+
+    @classmethod
+    def from_descriptors(cls, image_descriptors, block_size=16384, precision=DEFAULT_PRECISION):
+        """
+        Build an engine over a BinaryDescriptorStore (no copy) or a descriptors dictionary.
+
+        A store is used at the precision it was written at; `precision` applies to dictionaries.
+        """
+        if isinstance(image_descriptors, BinaryDescriptorStore):
+            normalized = {}
+            for descriptor_type, sub_descriptor, _ in image_descriptors.layout:
+                key = (descriptor_type, sub_descriptor)
+                normalized[key] = image_descriptors.normalized_matrix(descriptor_type, sub_descriptor) \
+                    or normalize_matrix(image_descriptors.matrix(descriptor_type, sub_descriptor), block_size)
+            return cls(image_descriptors.paths, normalized, block_size)
+
+        paths = list(image_descriptors.keys())
+        matrices = {}
+        if paths:
+            for descriptor_type, descriptor_data in image_descriptors[paths[0]].items():
+                for sub_descriptor in descriptor_data:
+                    matrices[(descriptor_type, sub_descriptor)] = np.array([
+                        image_descriptors[path][descriptor_type][sub_descriptor] for path in paths
+                    ], dtype=float)
+        return cls.from_matrices(paths, matrices, block_size, precision)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def sub_descriptor_distances(self, descriptor_type, sub_descriptor, query_value, rows=None):
+        """
+        calculate_distance between a query sub-descriptor and every row, or only the given rows.
+        """
+        normalized, _ = self.normalized[(descriptor_type, sub_descriptor)]
+        if rows is not None:
+            normalized = normalized[rows]
+        compute = compute_dtype(normalized.dtype)
+        query = normalize_rows(np.asarray(query_value, dtype=float).reshape(1, -1))[0].astype(compute)
+        if query.shape[0] != normalized.shape[1]:
+            # calculate_distance falls back to 1.0 when the vectors cannot be compared
+            print(f"Distance calculation error: {descriptor_type}.{sub_descriptor} has "
+                  f"{query.shape[0]} values, the index {normalized.shape[1]}")
+            return np.ones(len(normalized))
+
+        distances = np.empty(len(normalized))
+        for start in range(0, len(normalized), self.block_size):
+            stop = start + self.block_size
+            distances[start:stop] = combined_distances(query, np.asarray(normalized[start:stop], dtype=compute))
+        return distances
+
+    def distances(self, query_descriptors, weights=None, rows=None):
+        """
+        Global distance from the query to every image, as calculate_global_distance computes it.
+
+        Args:
+            query_descriptors (dict): Query descriptors
+            weights (dict, optional): Descriptor weights, DEFAULT_WEIGHTS by default; restricted
+                to the indexed descriptors, with default entries for plugins (see indexed_weights)
+            rows (numpy.ndarray, optional): Only score these rows (e.g. candidates of an
+                approximate index), preferably sorted
+
+        Returns:
+            numpy.ndarray: One distance per image in the order of `paths`, or per row of `rows`
+        """
+        # Only indexed descriptors are ranked, plugins included
+        weights = indexed_weights(DEFAULT_WEIGHTS if weights is None else weights, self.normalized)
+
+        global_distance = np.zeros(len(self) if rows is None else len(rows))
+        total_weight = 0.0
+        for descriptor, descriptor_weights in weights.items():
+            descriptor_weight = descriptor_weights.get("weight", 1.0)
+
+            sub_distances = []
+            for sub_desc, sub_weight in descriptor_weights.items():
+                if sub_desc == "weight":
+                    continue
+                value = query_descriptors[descriptor][sub_desc]
+                if value is not None:
+                    sub_distances.append(
+                        sub_weight * self.sub_descriptor_distances(descriptor, sub_desc, value, rows)
+                    )
+
+            if sub_distances:
+                global_distance += descriptor_weight * np.mean(sub_distances, axis=0)
+                total_weight += descriptor_weight
+
+        return global_distance / (total_weight + 1e-10)
+
+    def batch_sub_descriptor_distances(self, descriptor_type, sub_descriptor, query_values):
+        """
+        calculate_distance between Q query sub-descriptors and every row, as a Q x N matrix.
+        """
+        normalized, squared_norms = self.normalized[(descriptor_type, sub_descriptor)]
+        compute = compute_dtype(normalized.dtype)
+        queries = normalize_rows(np.asarray(query_values, dtype=float)).astype(compute)
+        if queries.shape[1] != normalized.shape[1]:
+            print(f"Distance calculation error: {descriptor_type}.{sub_descriptor} has "
+                  f"{queries.shape[1]} values, the index {normalized.shape[1]}")
+            return np.ones((len(queries), len(self)))
+
+        query_squared_norms = np.square(queries, dtype=np.float64).sum(axis=1)[:, None]
+        distances = np.empty((len(queries), len(self)))
+        for start in range(0, len(self), self.block_size):
+            stop = start + self.block_size
+            rows = np.asarray(normalized[start:stop], dtype=compute)
+            dot = queries @ rows.T
+            squared = squared_norms[start:stop] + query_squared_norms - 2 * dot
+            # Close pairs lose their Euclidean term to cancellation: rescore them with a direct difference
+            near_queries, near_rows = np.nonzero(squared < NEAR_SQUARED_DISTANCE)
+            difference = queries[near_queries] - rows[near_rows]
+            squared[near_queries, near_rows] = np.einsum('ij,ij->i', difference, difference)
+            euclidean = np.sqrt(np.maximum(squared, 0))
+            # cdist sums the absolute differences without a Q x B x d temporary
+            manhattan_distance = cdist(queries, rows, 'cityblock')
+            distances[:, start:stop] = 0.4 * euclidean + 0.3 * (1 - dot) + 0.3 * manhattan_distance
+        return distances
+
+    def batch_distances(self, queries_descriptors, weights=None):
+        """
+        Global distances from several queries to every image, one query per row.
+
+        Args:
+            queries_descriptors (list): Descriptors of the Q queries, as calculate_descriptors returns them
+            weights (dict, optional): Descriptor weights, DEFAULT_WEIGHTS by default
+
+        Returns:
+            numpy.ndarray: Q x N distances, columns in the order of `paths`
+        """
+        # Only indexed descriptors are ranked, plugins included
+        weights = indexed_weights(DEFAULT_WEIGHTS if weights is None else weights, self.normalized)
+
+        global_distance = np.zeros((len(queries_descriptors), len(self)))
+        total_weight = 0.0
+        for descriptor, descriptor_weights in weights.items():
+            descriptor_weight = descriptor_weights.get("weight", 1.0)
+
+            sub_distances = []
+            for sub_desc, sub_weight in descriptor_weights.items():
+                if sub_desc == "weight":
+                    continue
+                values = [query[descriptor][sub_desc] for query in queries_descriptors]
+                sub_distances.append(sub_weight * self.batch_sub_descriptor_distances(descriptor, sub_desc, values))
+
+            if sub_distances:
+                global_distance += descriptor_weight * np.mean(sub_distances, axis=0)
+                total_weight += descriptor_weight
+
+        return global_distance / (total_weight + 1e-10)
@@ -1,45 +1,91 @@
-from sklearn.semi_supervised import LabelSpreading
 from sklearn.preprocessing import StandardScaler
 import numpy as np
 import os
-import json
+import time
 from Descriptors_calcul import calculate_descriptors
-from Global_distance_calcul import calculate_global_distance
+from Global_distance_calcul import indexed_weights
+from ranking import RankingEngine, top_k_indices
+from batch_search import batch_search
+from ivf_index import ivf_index_path, load_or_build_ivf_index
+from label_propagation import label_graph_path, load_or_build_label_graph, local_relevance
+from feedback_session import FeedbackSession
+from session_store import SessionStore
+from query_cache import QueryDescriptorCache, ScoreCache, cached_query_descriptors, query_key
+from descriptor_store import (
+    DEFAULT_PRECISION, BinaryDescriptorStore, DescriptorJournal, binary_store_path, check_extraction_params,
+    compact_journal, convert_json_to_binary, iter_image_paths, load_descriptor_file,
+    open_descriptors, raw_dtype, read_extraction_params, serialize_descriptors, to_numpy
+)
 
 class SemiSupervisedImageSearch:
-    def __init__(self, dataset_path, descriptors_file='image_descriptors.json'):
+    def __init__(self, dataset_path, descriptors_file='image_descriptors.json', query_cache=None,
+                 extraction_params=None, score_cache=None, n_probe=None, ivf_lists=None,
+                 precision=DEFAULT_PRECISION, graph_neighbors=10, alpha=0.8,
+                 session_ttl=1800, max_sessions=1000, session_backend=None, local_candidates=None):
+        """
+        Args:
+            dataset_path (str): Path to the directory containing images
+            descriptors_file (str): Path to the JSON file storing precomputed descriptors
+            query_cache (QueryDescriptorCache, optional): Cache of query descriptors, a private one by default
+            extraction_params (dict, optional): Extraction settings used when building a new index
+            score_cache (ScoreCache, optional): Cache of per-query score arrays used for paging
+            n_probe (int, optional): Search through an IVF index visiting this many lists per
+                query; None scans the whole collection exactly
+            ivf_lists (int, optional): Number of IVF lists when the index is (re)built
+            precision (str): 'float32', 'float16' or 'float64' storage of the ranking blocks
+                when building a new index; an existing index keeps the precision it was built with
+            graph_neighbors (int): Neighbours per image of the label propagation graph
+            alpha (float): Share of an image's relevance propagated from its neighbours
+            session_ttl (float): Seconds a feedback session is kept after its last use
+            max_sessions (int): Feedback sessions kept in memory
+            session_backend (SQLiteSessionBackend, optional): Session store shared with the
+                other worker processes serving this index
+            local_candidates (int, optional): Propagate feedback over the subgraph of the query's
+                best first-pass candidates (this many) and the labelled images only, ranking
+                within it; None propagates over the whole collection
+        """
         self.dataset_path = dataset_path
         self.descriptors_file = descriptors_file
         self.image_descriptors = {}
         self.image_paths = []
+        self.query_cache = query_cache if query_cache is not None else QueryDescriptorCache()
+        self.score_cache = score_cache if score_cache is not None else ScoreCache()
+        self.extraction_params = extraction_params
+        self.precision = precision
+        # Initial descriptor weights, every session adjusts its own copy
         self.weights = {
             "color": {"weight": 0.4, "histogram": 0.6, "dominant_colors": 0.4},
             "texture": {"weight": 0.3, "gabor_filters": 0.5, "glcm_features": 0.5},
             "shape": {"weight": 0.3, "hu_moments": 0.7, "shape_descriptors": 0.3},
         }
         self.scaler = StandardScaler()
-        self.semi_supervised_model = LabelSpreading(kernel='rbf', alpha=0.8)
+        self.n_probe = n_probe
+        self.ivf_lists = ivf_lists
+        self.ivf_index = None
+        self.graph_neighbors = graph_neighbors
+        self.alpha = alpha
+        self.local_candidates = local_candidates
+        self.label_propagator = None
         self._load_or_precompute_descriptors()
+        # An image's id is its row in the index, which only ever appends
+        self.path_rows = {path: row for row, path in enumerate(self.image_paths)}
+        self.ranking_engine = RankingEngine.from_descriptors(self.image_descriptors, precision=self.precision)
+        # Descriptors the index was built with, in feature order; plugins get default weights
+        self.descriptor_types = list(self.extraction_params["descriptors"])
+        self.weights = indexed_weights(self.weights, self.ranking_engine.normalized)
         self._prepare_feature_matrix()
+        # Feedback state of callers that do not manage sessions
+        self.session = FeedbackSession(len(self.image_paths), self.weights)
+        self.sessions = SessionStore(len(self.image_paths), self.weights, session_ttl, max_sessions, session_backend)
     def _load_or_precompute_descriptors(self):
         """
         Load descriptors from a file or precompute them if not available.
         """
-        if os.path.exists(self.descriptors_file):
+        if os.path.exists(self.descriptors_file) or os.path.exists(binary_store_path(self.descriptors_file)):
             print("Loading descriptors from disk...")
-            with open(self.descriptors_file, 'r') as file:
-                data = json.load(file)
-                self.image_descriptors = {
-                    k: {
-                        descriptor_type: {
-                            sub_k: np.array(sub_v) 
-                            for sub_k, sub_v in descriptor_data.items()
-                        }
-                        for descriptor_type, descriptor_data in v.items()
-                    }
-                    for k, v in data.items()
-                }
-                self.image_paths = list(self.image_descriptors.keys())
+            self.image_descriptors = open_descriptors(self.descriptors_file)
+            self.image_paths = list(self.image_descriptors.keys())
+            self.extraction_params = read_extraction_params(self.descriptors_file)
             print(f"Loaded descriptors for {len(self.image_descriptors)} images")
         else:
             print("Descriptors file not found. Precomputing descriptors...")
@@ -49,65 +95,58 @@ class SemiSupervisedImageSearch:
     
     def _precompute_descriptors(self):
         """
-        Precompute descriptors for all images in the dataset and save incrementally.
+        Precompute descriptors for all images in the dataset and journal them incrementally.
         """
-        # Initialize or load existing descriptors
-        if os.path.exists(self.descriptors_file):
-            with open(self.descriptors_file, 'r') as file:
-                self.image_descriptors = json.load(file)
-        else:
-            self.image_descriptors = {}
+        # Resume from whatever the descriptors file and its journal already hold
+        self.extraction_params = check_extraction_params(self.descriptors_file, self.extraction_params)
+        self.image_descriptors = load_descriptor_file(self.descriptors_file)
 
-        # Process images and save descriptors incrementally
-        for root, _, files in os.walk(self.dataset_path):
-            for filename in files:
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                    full_path = os.path.join(root, filename)
-                    
-                    # Skip if already processed
-                    if full_path in self.image_descriptors:
-                        continue
+        with DescriptorJournal(self.descriptors_file) as journal:
+            for full_path in iter_image_paths(self.dataset_path):
+                # Skip if already processed
+                if full_path in self.image_descriptors:
+                    continue
+                
+                try:
+                    print(f"Calculating descriptors for {full_path}...")
+                    descriptors = calculate_descriptors(full_path, **self.extraction_params)
                     
-                    try:
-                        print(f"Calculating descriptors for {full_path}...")
-                        descriptors = calculate_descriptors(full_path)
-                        
-                        # Convert descriptors to JSON-serializable format
-                        serializable_descriptors = {
-                            descriptor_type: {
-                                k: v.tolist() if hasattr(v, 'tolist') else v 
-                                for k, v in descriptor_data.items()
-                            }
-                            for descriptor_type, descriptor_data in descriptors.items()
-                        }
-                        
-                        # Add to image descriptors
-                        self.image_descriptors[full_path] = serializable_descriptors
-                        self.image_paths.append(full_path)
-                        
-                        # Save to file after each image
-                        with open(self.descriptors_file, 'w') as file:
-                            json.dump(self.image_descriptors, file)
-                        
-                        print(f"Saved descriptors for {full_path}")
+                    # Convert descriptors to JSON-serializable format and journal them
+                    serializable_descriptors = serialize_descriptors(descriptors)
+                    self.image_descriptors[full_path] = serializable_descriptors
+                    journal.append(full_path, serializable_descriptors)
                     
-                    except Exception as e:
-                        print(f"Error processing {full_path}: {e}")
+                    print(f"Saved descriptors for {full_path}")
+                
+                except Exception as e:
+                    print(f"Error processing {full_path}: {e}")
 
+        self.image_descriptors = to_numpy(self.image_descriptors, raw_dtype(self.precision))
+        self.image_paths = list(self.image_descriptors.keys())
         print(f"Precomputed descriptors for {len(self.image_descriptors)} images")
+
+    def _save_descriptors(self):
+        """
+        Compact the descriptor journal into the descriptors file and build the binary store.
+        """
+        compact_journal(self.descriptors_file)
+        self.image_descriptors = BinaryDescriptorStore(
+            convert_json_to_binary(self.descriptors_file, precision=self.precision)
+        )
+        self.image_paths = list(self.image_descriptors.keys())
+
     def _prepare_feature_matrix(self):
         """Prepare feature matrix and initialize labels."""
-        feature_matrix = []
-        for path, descriptors in self.image_descriptors.items():
-            features = []
-            for desc_type in ['color', 'texture', 'shape']:
-                for sub_desc, values in descriptors[desc_type].items():
-                    if sub_desc != 'weight':
-                        features.extend(values)
-            feature_matrix.append(features)
+        if isinstance(self.image_descriptors, BinaryDescriptorStore):
+            # Stack the memory-mapped sub-descriptor matrices directly
+            feature_matrix = self.image_descriptors.feature_matrix(self.descriptor_types)
+        else:
+            feature_matrix = []
+            for path, descriptors in self.image_descriptors.items():
+                feature_matrix.append(self._features(descriptors))
 
         # Convert to numpy array and scale
-        self.feature_matrix = np.array(feature_matrix)
+        self.feature_matrix = np.array(feature_matrix, dtype=raw_dtype(self.precision))
 
         # Check for invalid values in the feature matrix
         if np.any(np.isnan(self.feature_matrix)):
@@ -124,94 +163,207 @@ class SemiSupervisedImageSearch:
             print("Feature matrix is all zeros. Check descriptors.")
             raise ValueError("Feature matrix is all zeros. Ensure descriptors are calculated correctly.")
 
+        # The IVF index keeps its own standardization so it stays valid as images are added
+        if self.n_probe is not None:
+            self.ivf_index = load_or_build_ivf_index(
+                ivf_index_path(self.descriptors_file), self.feature_matrix, self.image_paths, self.ivf_lists
+            )
+
         # Scale the feature matrix
         self.feature_matrix = self.scaler.fit_transform(self.feature_matrix)
 
-        # Initialize labels
-        self.labels = np.zeros(len(self.image_paths))  # Initial labels
+        # Feedback is propagated over a sparse kNN graph of the scaled features, built once,
+        # unless query-local subgraphs are built per query instead
+        if self.local_candidates is None:
+            self.label_propagator = load_or_build_label_graph(
+                label_graph_path(self.descriptors_file), self.feature_matrix, self.image_paths,
+                self.graph_neighbors, self.alpha
+            )
+
+
+    def image_ids(self, images):
+        """
+        Ids of images given by id or by indexed path.
+
+        Raises:
+            KeyError: If an image is not in the index
+        """
+        ids = []
+        for image in images:
+            if isinstance(image, (int, np.integer)):
+                if not 0 <= image < len(self.image_paths):
+                    raise KeyError(f"No indexed image with id {image}")
+                ids.append(int(image))
+            elif image in self.path_rows:
+                ids.append(self.path_rows[image])
+            else:
+                raise KeyError(f"Image not in the index: {image}")
+        return ids
 
+    def _features(self, descriptors):
+        """
+        Concatenated sub-descriptors of one image, in the order of the feature matrix columns.
+        """
+        features = []
+        for desc_type in self.descriptor_types:
+            for sub_desc, values in descriptors[desc_type].items():
+                if sub_desc != 'weight':
+                    features.extend(values)
+        return features
 
-    def _update_weights(self, feedback, Lc=0.5):
-        """Update descriptor weights based on user feedback."""
-        relevant_images = feedback.get("relevant", [])
-        non_relevant_images = feedback.get("non_relevant", [])
+    def _update_weights(self, session, relevant_ids, non_relevant_ids, Lc=0.5):
+        """Update a session's descriptor weights based on user feedback, given as image ids."""
+        # Every sub-descriptor is scaled by the same factors, computed once per round
+        rel_factor = np.prod(1 - np.minimum(1, Lc * session.labels[relevant_ids]))
+        non_rel_factor = np.prod(1 + np.maximum(1, Lc * session.labels[non_relevant_ids]))
 
-        for descriptor, sub_weights in self.weights.items():
-            for sub_desc, sub_weight in sub_weights.items():
+        for descriptor, sub_weights in session.weights.items():
+            for sub_desc in sub_weights:
                 if sub_desc == "weight":
                     continue
-                
-                # Adjust weights for relevant images
-                for img in relevant_images:
-                    idx = self.image_paths.index(img)
-                    rel_factor = 1 - min(1, Lc * self.labels[idx])
-                    self.weights[descriptor][sub_desc] *= rel_factor
-
-                # Adjust weights for non-relevant images
-                for img in non_relevant_images:
-                    idx = self.image_paths.index(img)
-                    non_rel_factor = 1 + max(1, Lc * self.labels[idx])
-                    self.weights[descriptor][sub_desc] *= non_rel_factor
-
-    def find_similar_images(self, query_image_path, top_k=5, feedback=None):
+                sub_weights[sub_desc] = float(sub_weights[sub_desc] * rel_factor * non_rel_factor)
+
+    def _record_round(self, session, report):
+        print(f"Feedback round {report['round']}: {report['iterations']} iterations, "
+              f"{report['touched']} images updated, {report['sweeps']} sweeps in {report['ms']:.1f} ms "
+              f"(P(relevant) within {report['error_bound']:.1e})")
+        self.sessions.save(session)
+
+    def _local_scores(self, query_descriptors, first_pass, session):
+        """
+        Re-score the query's best first-pass candidates and the labelled images with feedback
+        propagated over their subgraph only; other images are not results.
+
+        Returns:
+            tuple: (score of every image, propagation stats)
+        """
+        ranked = top_k_indices(first_pass, self.local_candidates)
+        rows = np.union1d(ranked[np.isfinite(first_pass[ranked])], np.flatnonzero(session.labels))
+        relevance, stats = local_relevance(
+            self.feature_matrix, rows, session.labels, self.graph_neighbors, self.alpha
+        )
+        distances = self.ranking_engine.distances(query_descriptors, session.weights, rows=rows)
+        scores = np.full(len(self.image_paths), np.inf)
+        scores[rows] = 0.7 * distances + 0.3 * (1 - relevance)
+        return scores, stats
+
+    def _ranked(self, scores, top_k, offset, return_ids):
+        """
+        Ids or paths of the ranks offset .. offset + top_k, skipping images left unscored by the IVF index.
+        """
+        ranked = [int(idx) for idx in top_k_indices(scores, top_k, offset) if np.isfinite(scores[idx])]
+        return ranked if return_ids else [self.image_paths[idx] for idx in ranked]
+
+    def find_similar_images_batch(self, images, top_k=5, workers=None, query_block=16, session=None, pool=None):
+        """
+        Rank the dataset against many query images, yielding results per query as they complete.
+        
+        Args:
+            images: Query images: a directory, a zip/tar archive (path or bytes), or a list
+                of image paths, encoded images or (name, image) pairs
+            top_k (int): Number of similar images to return per query
+            workers (int, optional): Descriptor extraction processes, defaults to the CPU count
+            query_block (int): Number of queries ranked together in one distance matrix
+            session (FeedbackSession, optional): Session whose weights are used, the default one if None
+            pool (ExtractionPool, optional): Long-lived extraction pool shared between batches
+        
+        Yields:
+            dict: {"query": name, "similar_images": [...]} or {"query": name, "error": message}
+        """
+        return batch_search(
+            self.ranking_engine, images, top_k, (session or self.session).weights, self.extraction_params,
+            workers, query_block, pool
+        )
+
+    def find_similar_images(self, query_image, top_k=5, feedback=None, offset=0, session=None, return_ids=False):
+        """
+        Rank the dataset against a query image, refined by relevance feedback.
+        
+        Args:
+            query_image (str, bytes or numpy.ndarray): Path to the query image, its encoded
+                bytes (e.g. an upload) or the decoded image
+            top_k (int): Number of similar images to return
+            feedback (dict, optional): {"relevant": [...], "non_relevant": [...]}, images given
+                by id or by path
+            offset (int): Number of better-ranked images to skip, for paging. Without new
+                feedback, further pages reuse the cached scores of the query.
+            session (FeedbackSession, optional): Feedback state to read and update, the default
+                one if None. Relevance propagated in earlier rounds keeps applying to its queries.
+            return_ids (bool): Return image ids instead of paths
+        
+        Returns:
+            list: Paths (or ids) of the most similar images
+        """
+        session = session or self.session
+        # Requests of one session are serialized, the shared index is only read
+        with session.lock:
+            return self._find_similar_images(query_image, top_k, feedback, offset, session, return_ids)
+
+    def _find_similar_images(self, query_image, top_k, feedback, offset, session, return_ids):
         try:
+            key = query_key(query_image, self.extraction_params)
+            if not feedback:
+                scores = self.score_cache.get(f"{key}:{session.id}:{session.feedback_round}")
+                if scores is not None:
+                    return self._ranked(scores, top_k, offset, return_ids)
+
             # If feedback is provided, update weights and model
             if feedback:
-                relevant_images = feedback.get("relevant", [])
-                non_relevant_images = feedback.get("non_relevant", [])
+                relevant_ids = self.image_ids(feedback.get("relevant", []))
+                non_relevant_ids = self.image_ids(feedback.get("non_relevant", []))
                 
                 # Update labels
-                for img in relevant_images:
-                    idx = self.image_paths.index(img)
-                    self.labels[idx] = 1
-                
-                for img in non_relevant_images:
-                    idx = self.image_paths.index(img)
-                    self.labels[idx] = -1
+                session.labels[relevant_ids] = 1
+                session.labels[non_relevant_ids] = -1
 
                 # Update weights
-                self._update_weights(feedback, Lc=0.5)
+                self._update_weights(session, relevant_ids, non_relevant_ids, Lc=0.5)
 
-                # Fit semi-supervised model
-                self.semi_supervised_model.fit(self.feature_matrix, self.labels)
-                
-                # Get predicted probabilities
-                predicted_probs = self.semi_supervised_model.predict_proba(self.feature_matrix)
+                if self.local_candidates is None:
+                    # Spread the label changes over the kNN graph, from the session's last distributions
+                    self._record_round(session, session.propagate(self.label_propagator))
             
             # Calculate descriptors for query image
-            query_descriptors = calculate_descriptors(query_image_path)
-            query_features = []
-            for desc_type in ['color', 'texture', 'shape']:
-                for sub_desc, values in query_descriptors[desc_type].items():
-                    if sub_desc != 'weight':
-                        query_features.extend(values)
+            query_descriptors = cached_query_descriptors(
+                self.query_cache, query_image, self.extraction_params, key=key
+            )
+            query_features = self._features(query_descriptors)
             
             # Scale query features
             scaled_query_features = self.scaler.transform([query_features])
             
-            # Calculate distances
-            distances = []
-            for idx, path in enumerate(self.image_paths):
-                dataset_descriptors = self.image_descriptors[path]
-                
-                # Calculate global distance
-                distance = calculate_global_distance(
-                    query_descriptors, 
-                    dataset_descriptors, 
-                    self.weights
-                )
-                
-                # Combine distance with label probability
+            # Calculate global distances to every dataset image at once, or only to
+            # the candidates of the IVF lists nearest to the query
+            candidates = None
+            if self.ivf_index is not None:
+                candidates = self.ivf_index.candidates(query_features, self.n_probe)
+            distances = self.ranking_engine.distances(query_descriptors, session.weights, rows=candidates)
+            
+            # Combine distance with label probability, likely relevant images moving closer
+            relevance = None
+            if self.local_candidates is None:
+                relevance = session.relevance(self.label_propagator)
+            if relevance is not None:
+                if candidates is not None:
+                    relevance = relevance[candidates]
+                distances = 0.7 * distances + 0.3 * (1 - relevance)
+            
+            if candidates is None:
+                scores = distances
+            else:
+                # Images outside the probed lists are not results
+                scores = np.full(len(self.image_paths), np.inf)
+                scores[candidates] = distances
+
+            if self.local_candidates is not None and np.any(session.labels):
+                start = time.perf_counter()
+                scores, stats = self._local_scores(query_descriptors, scores, session)
                 if feedback:
-                    label_prob = predicted_probs[idx][1]  # Probability of positive class
-                    combined_score = 0.7 * distance + 0.3 * label_prob
-                    distances.append((path, combined_score))
-                else:
-                    distances.append((path, distance))
+                    self._record_round(session, session.record_round(stats, start))
             
-            # Sort and return top-k images
-            distances.sort(key=lambda x: x[1])
-            return [path for path, _ in distances[:top_k]]
+            # Select and sort only the requested ranks
+            self.score_cache.put(f"{key}:{session.id}:{session.feedback_round}", scores)
+            return self._ranked(scores, top_k, offset, return_ids)
         
         except Exception as e:
             print(f"Error finding similar images: {e}")
@@ -0,0 +1,207 @@
+"""
+Relevance feedback sessions, keyed by session id.
+
+The index, its ranking engine and its label propagation graph are shared by
+every session and only read while serving, so they need no lock. What one
+user's feedback changes is a FeedbackSession, kept here:
+
+- In process, an LRU of at most `max_sessions` sessions, each dropped `ttl`
+  seconds after its last use. A session keeps its propagated distributions
+  in memory so its next round only pushes the label change.
+- Optionally in a SQLiteSessionBackend file shared by the worker processes
+  serving the same index. It stores the compact state of every session
+  (labelled rows, weights, recent round reports), so a request can land on any
+  worker: a worker that has an older copy of the session in memory takes
+  over the new labels and propagates the difference, one that has none
+  propagates the labels from scratch.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from feedback_session import FeedbackSession
+
+
+class SQLiteSessionBackend:
+    """
+    Session states in a SQLite file, shared between processes.
+    """
+    def __init__(self, path, timeout=10.0):
+        """
+        Args:
+            path (str): SQLite database file, created if missing
+            timeout (float): Seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.timeout = timeout
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def _connect(self):
+        # One connection per call: connections cannot be shared between threads or forks
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def get(self, session_id, not_before=0.0):
+        """
+        Return the state of a session used since `not_before` and mark it used, or None.
+        """
+        with self._connect() as connection:
+            updated = connection.execute(
+                "UPDATE sessions SET updated = ? WHERE id = ? AND updated >= ?", (time.time(), session_id, not_before)
+            ).rowcount
+            if not updated:
+                return None
+            row = connection.execute("SELECT state FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, session_id, state):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions (id, state, updated) VALUES (?, ?, ?)",
+                (session_id, json.dumps(state, separators=(',', ':')), time.time())
+            )
+
+    def delete(self, session_id):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def expire(self, before):
+        """
+        Delete the sessions unused since `before`, returning how many were deleted.
+        """
+        with self._connect() as connection:
+            return connection.execute("DELETE FROM sessions WHERE updated < ?", (before,)).rowcount
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class SessionStore:
+    """
+    Thread-safe store of feedback sessions with TTL and LRU eviction.
+    """
+    def __init__(self, image_count, weights, ttl=1800, max_sessions=1000, backend=None):
+        """
+        Args:
+            image_count (int): Number of indexed images
+            weights (dict): Initial descriptor weights of new sessions
+            ttl (float): Seconds after its last use a session is dropped
+            max_sessions (int): Sessions kept in memory, least recently used dropped first
+            backend (SQLiteSessionBackend, optional): Store shared with other worker processes
+        """
+        self.image_count = image_count
+        self.weights = weights
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.backend = backend
+        self.created = 0
+        self.expired = 0
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire_local(self, now):
+        # Least recently used first, so expired sessions are at the front
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_access >= now - self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def _keep(self, session):
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, session_id=None):
+        """
+        Return the session with this id, or a new session if it is unknown or expired.
+
+        A new session always gets a fresh random id: ids are only ever issued
+        here, never taken from the client.
+
+        Args:
+            session_id (str, optional): Id given to the client earlier; None starts a new session
+
+        Returns:
+            FeedbackSession: The session, up to date with the shared backend
+        """
+        now = time.time()
+        with self._lock:
+            self._expire_local(now)
+            session = self._sessions.get(session_id) if session_id else None
+
+        state = None
+        if session_id and self.backend is not None:
+            state = self.backend.get(session_id, now - self.ttl)
+            if state is None:
+                # Expired or unknown to the other workers as well
+                session = None
+
+        with self._lock:
+            if session is None:
+                if state is not None:
+                    session = FeedbackSession.from_state(state, self.image_count)
+                else:
+                    session = FeedbackSession(self.image_count, self.weights)
+                    self.created += 1
+                state = None
+            session.last_access = now
+            self._keep(session)
+
+        if state is not None and state["feedback_round"] > session.feedback_round:
+            # Another worker ran later rounds
+            with session.lock:
+                session.restore(state)
+        return session
+
+    def save(self, session):
+        """
+        Record a session after a feedback round, sharing it with the other workers.
+        """
+        session.last_access = time.time()
+        with self._lock:
+            self._keep(session)
+        if self.backend is not None:
+            self.backend.put(session.id, session.to_state())
+            self.backend.expire(session.last_access - self.ttl)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        """
+        Return the number of sessions in memory (and shared) and eviction counters.
+        """
+        with self._lock:
+            stats = {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                "created": self.created,
+                "expired": self.expired,
+                "evictions": self.evictions
+            }
+        if self.backend is not None:
+            stats["shared_sessions"] = len(self.backend)
+        return stats
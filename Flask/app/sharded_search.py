@@ -0,0 +1,135 @@
+"""
+Multi-process sharded ranking.
+
+One query's scan runs on a single core. ShardedSearch splits the rows into
+`shards` contiguous ranges and scans them in a pool of worker processes;
+every worker returns the local top-k of its range and the parent merges
+them.
+
+Workers never receive the descriptor matrices. Memory-mapped blocks of a
+binary store are reopened by path (the OS page cache is shared), and
+in-memory blocks are copied once into multiprocessing shared memory that
+every worker attaches to at start-up.
+"""
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ranking import RankingEngine, top_k_indices
+
+# Per-worker state, set by _attach
+_worker_block_size = 16384
+_worker_arrays = {}
+_worker_segments = []
+_worker_engines = {}
+
+
+def _share(array):
+    """
+    Describe an array so a worker can map it without copying, moving it into shared memory if needed.
+
+    Returns:
+        tuple: (spec, SharedMemory or None)
+    """
+    if isinstance(array, np.memmap) and array.filename:
+        return ('memmap', array.filename, array.dtype.str, array.shape, array.offset), None
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+    return ('shm', segment.name, array.dtype.str, array.shape, 0), segment
+
+
+def _open_shared(spec):
+    kind, name, dtype, shape, offset = spec
+    if kind == 'memmap':
+        return np.memmap(name, dtype=dtype, mode='r', shape=shape, offset=offset)
+    segment = shared_memory.SharedMemory(name=name)
+    _worker_segments.append(segment)
+    return np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def _attach(specs, block_size):
+    """
+    Worker initializer: map every shared block once.
+    """
+    global _worker_block_size
+    _worker_block_size = block_size
+    for key, (matrix_spec, norms_spec) in specs.items():
+        _worker_arrays[key] = (_open_shared(matrix_spec), _open_shared(norms_spec))
+
+
+def _search_shard(start, stop, query_descriptors, weights, k):
+    """
+    Worker task: local top-k of rows start .. stop.
+
+    Returns:
+        tuple: (global rows, their distances), best first
+    """
+    engine = _worker_engines.get((start, stop))
+    if engine is None:
+        # Views of the shared blocks, nothing is copied
+        engine = RankingEngine(
+            range(start, stop),
+            {key: (matrix[start:stop], norms[start:stop]) for key, (matrix, norms) in _worker_arrays.items()},
+            _worker_block_size
+        )
+        _worker_engines[(start, stop)] = engine
+    distances = engine.distances(query_descriptors, weights)
+    local = top_k_indices(distances, k)
+    return local + start, distances[local]
+
+
+class ShardedSearch:
+    """
+    Pool of worker processes, each scanning one row range of a RankingEngine.
+    """
+    def __init__(self, engine, shards=None):
+        """
+        Args:
+            engine (RankingEngine): Engine whose normalized blocks are shared with the workers
+            shards (int, optional): Number of row ranges and worker processes, defaults to the CPU count
+        """
+        self.paths = engine.paths
+        self.shards = max(1, min(shards or os.cpu_count() or 1, len(engine) or 1))
+        bounds = np.linspace(0, len(engine), self.shards + 1).astype(int)
+        self.ranges = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        self._segments = []
+        specs = {}
+        for key, (matrix, norms) in engine.normalized.items():
+            matrix_spec, matrix_segment = _share(matrix)
+            norms_spec, norms_segment = _share(norms)
+            self._segments.extend(segment for segment in (matrix_segment, norms_segment) if segment)
+            specs[key] = (matrix_spec, norms_spec)
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.shards, initializer=_attach, initargs=(specs, engine.block_size)
+        )
+        atexit.register(self.close)
+
+    def top_k(self, query_descriptors, k, weights=None):
+        """
+        Rows and distances of the k images nearest to a query, best first.
+        """
+        futures = [
+            self.executor.submit(_search_shard, start, stop, query_descriptors, weights, k)
+            for start, stop in self.ranges
+        ]
+        rows, distances = zip(*(future.result() for future in futures))
+        rows, distances = np.concatenate(rows), np.concatenate(distances)
+        best = top_k_indices(distances, k)
+        return rows[best], distances[best]
+
+    def close(self):
+        """
+        Stop the workers and release the shared memory.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []